@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pcapreader import iter_records, open_capture
+from packets import StreamTracker
+from native import iter_handshakes, pair_handshakes
+from pairing import HandshakePairer
+from prefilter import Prefilter
+from writers import open_writer, WRITERS
+from synthetic import iter_synthetic_records, write_capture
+from sessions import get_native_session
+import whatls
+
+try:
+    import resource
+except ImportError:
+    # Peak memory isn't available on Windows
+    resource = None
+
+STAGES = ("read", "prefilter", "dissect", "pair", "extract", "write")
+# Stages rated by the packets they go through, the rest by sessions
+PACKET_STAGES = ("read", "prefilter", "dissect")
+# How much slower than the baseline counts as a regression
+DEFAULT_TOLERANCE = 0.2
+# Settings that change the input of only some stages. A baseline measured
+# with any other setting different, or on another capture, isn't compared.
+STAGE_SETTINGS = {
+    "dissect": ("prefilter",),
+    "write": ("format",),
+    "end to end": ("prefilter", "format"),
+}
+# Settings that don't change what is measured
+IGNORED_SETTINGS = ("repeat", "python")
+
+
+def get_peak_rss():
+    # MB, or None where it isn't known
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def run_end_to_end(cap_file, options, output):
+    # The pipeline as the command line runs it, streaming from the capture to
+    # the report. Returns the number of sessions.
+    prefilter = whatls.get_prefilter(options)
+    sessions = 0
+    with open_writer(
+        output,
+        options.format,
+        whatls.get_fields(options),
+        **whatls.get_writer_options(options),
+    ) as writer:
+        for session_data in whatls.iter_session_data(cap_file, options, prefilter):
+            writer.write(session_data)
+            sessions += 1
+    return sessions
+
+
+def run_stages(cap_file, options, output):
+    # Runs the native pipeline a stage at a time, each one over the complete
+    # output of the one before, so they can be timed separately. Returns
+    # ({stage: seconds}, packets, sessions).
+    seconds = {}
+    with open_capture(cap_file) as capture:
+        seconds["read"], records = timed(lambda: list(iter_records(capture)))
+    prefilter = whatls.get_prefilter(options) or Prefilter()
+    seconds["prefilter"], kept = timed(lambda: list(prefilter.filter(records)))
+    # Only part of the pipeline with --prefilter, timed either way
+    dissected = kept if options.prefilter else records
+    seconds["dissect"], handshakes = timed(
+        lambda: list(
+            iter_handshakes(
+                dissected, StreamTracker(), whatls.get_reassembler(options)
+            )
+        )
+    )
+    pairer = HandshakePairer(options.flow_timeout, options.max_flows)
+    seconds["pair"], pairs = timed(lambda: list(pair_handshakes(handshakes, pairer)))
+    hello_text_limit = whatls.get_hello_text_limit(options)
+    seconds["extract"], rows = timed(
+        lambda: [
+            get_native_session(cap_file, client_hello, server_hello, hello_text_limit)
+            for client_hello, server_hello in pairs
+        ]
+    )
+
+    def write():
+        with open_writer(
+            output,
+            options.format,
+            whatls.get_fields(options),
+            **whatls.get_writer_options(options),
+        ) as writer:
+            for session_data in rows:
+                writer.write(session_data)
+
+    seconds["write"], _ = timed(write)
+    return seconds, len(records), len(rows)
+
+
+def run_benchmark(cap_file, options, repeat, workdir):
+    # Best of `repeat` runs. The end to end runs go first, so the peak RSS is
+    # theirs and not that of the staged runs, which hold every stage's output.
+    output = os.path.join(workdir, f"report.{options.format}")
+    end_to_end = []
+    for _ in range(repeat):
+        elapsed, sessions = timed(lambda: run_end_to_end(cap_file, options, output))
+        end_to_end.append(elapsed)
+    peak_rss = get_peak_rss()
+    stages = {}
+    packets = None
+    if options.backend == "native":
+        for _ in range(repeat):
+            seconds, packets, _ = run_stages(cap_file, options, output)
+            for stage, elapsed in seconds.items():
+                stages[stage] = min(elapsed, stages.get(stage, elapsed))
+    else:
+        # tshark does everything up to pairing in one go
+        with open_capture(cap_file) as capture:
+            packets = sum(1 for _ in iter_records(capture))
+    elapsed = min(end_to_end)
+    return {
+        "capture": {
+            "path": cap_file,
+            "bytes": os.path.getsize(cap_file),
+            "packets": packets,
+            "sessions": sessions,
+        },
+        "settings": {
+            "backend": options.backend,
+            "format": options.format,
+            "prefilter": bool(options.prefilter),
+            "repeat": repeat,
+            "python": platform.python_version(),
+        },
+        "stages": {
+            stage: {
+                "seconds": stages[stage],
+                "rate": (packets if stage in PACKET_STAGES else sessions)
+                / stages[stage],
+            }
+            for stage in STAGES
+            if stage in stages
+        },
+        "end_to_end": {
+            "seconds": elapsed,
+            "packets_per_second": packets / elapsed,
+            "sessions_per_second": sessions / elapsed,
+        },
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def format_results(results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    # The report lines, and the names of what got slower than the baseline
+    # allows
+    capture = results["capture"]
+    lines = [
+        f"{capture['path']}: {capture['packets']} packets, "
+        f"{capture['sessions']} sessions, {capture['bytes'] / 1e6:.1f} MB"
+    ]
+    regressions = []
+    changed = {}
+    other_capture = False
+    if baseline is not None:
+        changed = get_changed_settings(results["settings"], baseline["settings"])
+        other_capture = baseline["capture"]["packets"] != capture["packets"]
+    timings = [
+        (stage, timing["seconds"], timing["rate"], stage in PACKET_STAGES)
+        for stage, timing in results["stages"].items()
+    ]
+    end_to_end = results["end_to_end"]
+    timings.append(
+        ("end to end", end_to_end["seconds"], end_to_end["packets_per_second"], True)
+    )
+    for name, seconds, rate, per_packet in timings:
+        unit = "packets/s" if per_packet else "sessions/s"
+        line = f"  {name:<11} {seconds:9.3f}s {rate:14,.0f} {unit}"
+        if baseline is not None and (other_capture or not is_comparable(name, changed)):
+            line += "  not compared"
+        elif baseline is not None:
+            if name == "end to end":
+                previous = baseline["end_to_end"]["seconds"]
+            else:
+                previous = baseline["stages"].get(name, {}).get("seconds")
+            if previous:
+                change = seconds / previous - 1
+                line += f"  {change:+7.1%} vs {previous:.3f}s"
+                if change > tolerance:
+                    regressions.append(name)
+                    line += "  slower"
+        lines.append(line)
+    lines.append(f"  {'sessions/s':<11} {end_to_end['sessions_per_second']:25,.0f}")
+    if results["peak_rss_mb"] is not None:
+        lines.append(f"  {'peak RSS':<11} {results['peak_rss_mb']:21.1f} MB")
+    if other_capture:
+        lines.append("Warning: the baseline was measured on a different capture")
+    if changed:
+        settings = ", ".join(f"{name}={value}" for name, value in changed.items())
+        lines.append(f"Warning: the baseline was measured with {settings}")
+    return lines, regressions
+
+
+def get_changed_settings(settings, previous):
+    # {name: baseline value} of the settings that differ
+    return {
+        name: previous.get(name)
+        for name in sorted(set(settings) | set(previous))
+        if name not in IGNORED_SETTINGS and settings.get(name) != previous.get(name)
+    }
+
+
+def is_comparable(name, changed):
+    # Only when the settings that differ are some that other stages depend on
+    partial = {setting for settings in STAGE_SETTINGS.values() for setting in settings}
+    return all(
+        setting in partial and setting not in STAGE_SETTINGS.get(name, ())
+        for setting in changed
+    )
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(args[0]),
+        description="Time each stage of the analysis of a capture, by default a "
+        "synthetic one.",
+    )
+    parser.add_argument(
+        "capture", nargs="?", help="capture to analyze instead of a synthetic one"
+    )
+    parser.add_argument(
+        "--flows",
+        type=int,
+        default=20000,
+        help="connections in the synthetic capture (default: 20000)",
+    )
+    parser.add_argument(
+        "--noise",
+        type=int,
+        default=4,
+        help="application data packets per connection (default: 4)",
+    )
+    parser.add_argument(
+        "--split",
+        type=float,
+        default=0.1,
+        help="share of Client Hellos larger than a segment (default: 0.1)",
+    )
+    parser.add_argument(
+        "--missing",
+        type=float,
+        default=0.05,
+        help="share of handshakes without a Server Hello (default: 0.05)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs to take the best time of (default: 3)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["native", "pyshark"],
+        default="native",
+        help="backend to time, only the native one is timed per stage",
+    )
+    parser.add_argument(
+        "--format", choices=sorted(WRITERS), default="csv", help="report format"
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="dissect only the packets that pass the prefilter",
+    )
+    parser.add_argument("--save", metavar="PATH", help="save the results as JSON")
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="compare with results saved earlier, and fail if slower",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="how much slower than the baseline is still fine (default: 0.2)",
+    )
+    return parser.parse_args(args[1:])
+
+
+def main(args):
+    options = parse_args(args)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory(prefix="whatls-benchmark-") as workdir:
+        cap_file = options.capture
+        if cap_file is None:
+            cap_file = os.path.join(workdir, "synthetic.pcap")
+            records = iter_synthetic_records(
+                options.flows,
+                noise=options.noise,
+                split=options.split,
+                missing=options.missing,
+                seed=options.seed,
+            )
+            write_capture(cap_file, records)
+        whatls_args = ["whatls", cap_file, "--backend", options.backend]
+        whatls_args += ["--format", options.format]
+        whatls_args.append("--prefilter" if options.prefilter else "--no-prefilter")
+        results = run_benchmark(
+            cap_file, whatls.parse_args(whatls_args), options.repeat, workdir
+        )
+    if options.capture is None:
+        results["capture"]["path"] = "synthetic"
+        results["settings"]["synthetic"] = {
+            "flows": options.flows,
+            "noise": options.noise,
+            "split": options.split,
+            "missing": options.missing,
+            "seed": options.seed,
+        }
+    lines, regressions = format_results(results, baseline, options.tolerance)
+    print("\n".join(lines))
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
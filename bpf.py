@@ -0,0 +1,176 @@
+import ctypes
+import os
+import socket
+import struct
+import subprocess
+import tempfile
+from packets import LINKTYPE_ETHERNET
+
+SO_ATTACH_FILTER = 26
+SSL_FILTER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ssl_filter.bpf"
+)
+SSL_FILTER = "tcp[((tcp[12] & 0xf0) >> 2)] = 0x16"
+
+# `tcpdump -ddd` of SSL_FILTER on ethernet, used when tcpdump isn't installed
+SSL_FILTER_PROGRAM = [
+    (0x28, 0, 0, 12),  # ldh [12]
+    (0x15, 0, 13, 0x0800),  # jeq #0x800, ipv4 only like tcp[] in libpcap
+    (0x30, 0, 0, 23),  # ldb [23]
+    (0x15, 0, 11, 6),  # jeq #6, tcp
+    (0x28, 0, 0, 20),  # ldh [20]
+    (0x45, 9, 0, 0x1FFF),  # jset #0x1fff, not a later fragment
+    (0xB1, 0, 0, 14),  # ldxb 4*([14]&0xf), ip header length
+    (0x50, 0, 0, 26),  # ldb [x + 26], tcp[12]
+    (0x54, 0, 0, 0xF0),  # and #0xf0
+    (0x74, 0, 0, 2),  # rsh #2
+    (0x0C, 0, 0, 0),  # add x
+    (0x07, 0, 0, 0),  # tax
+    (0x50, 0, 0, 14),  # ldb [x + 14], first byte of the tcp payload
+    (0x15, 0, 1, 0x16),  # jeq #0x16
+    (0x06, 0, 0, 262144),  # ret #262144
+    (0x06, 0, 0, 0),  # ret #0
+]
+
+
+def read_filter_file(path=SSL_FILTER_FILE):
+    with open(path) as f:
+        return " ".join(f.read().split())
+
+
+def compile_filter(expression, linktype=LINKTYPE_ETHERNET):
+    # libpcap is the only thing that can compile a filter expression, so have
+    # tcpdump do it against an empty capture of the right link type.
+    with tempfile.NamedTemporaryFile(suffix=".pcap") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype))
+        f.flush()
+        try:
+            result = subprocess.run(
+                ["tcpdump", "-ddd", "-r", f.name, expression],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+        except FileNotFoundError:
+            result = None
+    if result is None or result.returncode != 0:
+        if normalize_filter(expression) == normalize_filter(SSL_FILTER) and (
+            linktype == LINKTYPE_ETHERNET
+        ):
+            return list(SSL_FILTER_PROGRAM)
+        if result is None:
+            raise ValueError("tcpdump is needed to compile filter expressions")
+        raise ValueError(f"Invalid filter expression: {result.stderr.strip()}")
+    lines = result.stdout.split("\n")
+    return [
+        tuple(int(value) for value in line.split())
+        for line in lines[1 : int(lines[0]) + 1]
+    ]
+
+
+def normalize_filter(expression):
+    expression = "".join(expression.split())
+    while expression.startswith("(") and expression.endswith(")"):
+        expression = expression[1:-1]
+    return expression
+
+
+def attach_filter(sock, program):
+    # struct sock_fprog points at an array of struct sock_filter, the kernel
+    # copies it so the buffer only has to outlive the call
+    instructions = b"".join(struct.pack("HBBI", *insn) for insn in program)
+    buffer = ctypes.create_string_buffer(instructions)
+    fprog = struct.pack("HP", len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def run_filter(program, data):
+    # Classic BPF interpreter for filters compiled by tcpdump, returns the
+    # snap length the filter accepted the packet with (0 to reject it)
+    a = x = 0
+    mem = [0] * 16
+    pc = 0
+    size = len(data)
+    while pc < len(program):
+        code, jt, jf, k = program[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls in (0x00, 0x01):  # ld, ldx
+            mode = code & 0xE0
+            if mode == 0x00:  # imm
+                value = k
+            elif mode == 0x80:  # len
+                value = size
+            elif mode == 0x60:  # mem
+                value = mem[k]
+            elif mode == 0xA0:  # msh, 4*([k]&0xf)
+                if k >= size:
+                    return 0
+                value = (data[k] & 0x0F) * 4
+            else:  # abs, ind
+                offset = k + x if mode == 0x40 else k
+                width = {0x00: 4, 0x08: 2, 0x10: 1}[code & 0x18]
+                if offset + width > size:
+                    return 0
+                value = int.from_bytes(data[offset : offset + width], "big")
+            if cls == 0x00:
+                a = value
+            else:
+                x = value
+        elif cls == 0x02:  # st
+            mem[k] = a
+        elif cls == 0x03:  # stx
+            mem[k] = x
+        elif cls == 0x04:  # alu
+            operand = x if code & 0x08 else k
+            op = code & 0xF0
+            if op == 0x00:
+                a = a + operand
+            elif op == 0x10:
+                a = a - operand
+            elif op == 0x20:
+                a = a * operand
+            elif op == 0x30:
+                if not operand:
+                    return 0
+                a = a // operand
+            elif op == 0x90:
+                if not operand:
+                    return 0
+                a = a % operand
+            elif op == 0x40:
+                a = a | operand
+            elif op == 0x50:
+                a = a & operand
+            elif op == 0xA0:
+                a = a ^ operand
+            elif op == 0x60:
+                a = a << operand
+            elif op == 0x70:
+                a = a >> operand
+            elif op == 0x80:
+                a = -a
+            a &= 0xFFFFFFFF
+        elif cls == 0x05:  # jmp
+            op = code & 0xF0
+            if op == 0x00:
+                pc += k
+                continue
+            operand = x if code & 0x08 else k
+            if op == 0x10:
+                taken = a == operand
+            elif op == 0x20:
+                taken = a > operand
+            elif op == 0x30:
+                taken = a >= operand
+            else:
+                taken = bool(a & operand)
+            pc += jt if taken else jf
+        elif cls == 0x06:  # ret
+            return a if code & 0x10 else k
+        else:  # misc
+            if code & 0xF8 == 0x80:
+                a = x
+            else:
+                x = a
+    return 0
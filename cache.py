@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from sessions import Session
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "whatls", "results.sqlite"
+)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    digest TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    rows BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (digest, variant)
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+"""
+
+
+class ResultCache:
+    # Stores the session rows of each capture keyed by a hash of its contents
+    # and a variant naming the parser version and the options that shape the
+    # rows. Files are only rehashed when their size or mtime changed since
+    # they were last seen.
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size=1024 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def file_digest(self, cap_file):
+        path = os.path.abspath(cap_file)
+        stat = os.stat(path)
+        row = self.db.execute(
+            "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        digest = f"{digest.hexdigest()}:{stat.st_size}"
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest),
+            )
+        return digest
+
+    def contains(self, cap_file, variant):
+        row = self.db.execute(
+            "SELECT 1 FROM results WHERE digest = ? AND variant = ?",
+            (self.file_digest(cap_file), variant),
+        ).fetchone()
+        return row is not None
+
+    def get(self, cap_file, variant):
+        # Returns the cached rows of the capture, or None
+        key = (self.file_digest(cap_file), variant)
+        row = self.db.execute(
+            "SELECT rows FROM results WHERE digest = ? AND variant = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute(
+                "UPDATE results SET accessed = ? WHERE digest = ? AND variant = ?",
+                (time.time(),) + key,
+            )
+        return _iter_rows(row[0], cap_file)
+
+    def entry(self, cap_file, variant):
+        return CacheEntry(self, self.file_digest(cap_file), variant)
+
+    def store(self, digest, variant, blob):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (digest, variant, blob, len(blob), time.time()),
+            )
+        self.evict()
+
+    def evict(self):
+        # Drops the least recently used results until the cache fits
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results")
+        total = total.fetchone()[0]
+        if total <= self.max_size:
+            return
+        with self.db:
+            for digest, variant, size in self.db.execute(
+                "SELECT digest, variant, size FROM results ORDER BY accessed"
+            ).fetchall():
+                self.db.execute(
+                    "DELETE FROM results WHERE digest = ? AND variant = ?",
+                    (digest, variant),
+                )
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def invalidate(self, cap_files=None):
+        # Forgets the given captures, or everything
+        with self.db:
+            if cap_files is None:
+                self.db.execute("DELETE FROM results")
+                self.db.execute("DELETE FROM files")
+            for cap_file in cap_files or []:
+                path = os.path.abspath(cap_file)
+                row = self.db.execute(
+                    "SELECT digest FROM files WHERE path = ?", (path,)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute("DELETE FROM results WHERE digest = ?", row)
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.close()
+
+
+class CacheEntry:
+    # Compresses rows as they go by, so nothing but the compressed result is
+    # held, and stores them only once the whole capture has been processed
+    def __init__(self, cache, digest, variant):
+        self.cache = cache
+        self.digest = digest
+        self.variant = variant
+        self.compressor = zlib.compressobj()
+        self.chunks = []
+
+    def add(self, row):
+        # Sessions are stored as arrays, their field names are implied by the
+        # parser version in the variant
+        line = json.dumps(row, separators=(",", ":")) + "\n"
+        chunk = self.compressor.compress(line.encode())
+        if chunk:
+            self.chunks.append(chunk)
+
+    def commit(self):
+        self.chunks.append(self.compressor.flush())
+        self.cache.store(self.digest, self.variant, b"".join(self.chunks))
+
+
+def _iter_rows(blob, cap_file):
+    # The same capture may be cached under another name
+    decompressor = zlib.decompressobj()
+    pending = b""
+    for start in range(0, len(blob), HASH_BLOCK_SIZE):
+        pending += decompressor.decompress(blob[start : start + HASH_BLOCK_SIZE])
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            row = Session(*json.loads(line))
+            yield row._replace(capture_file=cap_file)
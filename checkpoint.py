@@ -0,0 +1,138 @@
+import os
+import pickle
+from pcapreader import read_header, iter_records, open_capture, is_gzip_magic
+from packets import StreamTracker
+from pairing import HandshakePairer
+from native import iter_pairs
+from reassembly import HandshakeReassembler, DEFAULT_MAX_FLOW_BYTES, DEFAULT_MAX_BYTES
+
+CHECKPOINT_VERSION = 6
+# Enough of the start of a capture to tell it from another file that got the
+# same inode: the file header and the first record's timestamp
+FINGERPRINT_LEN = 64
+
+
+class CaptureProgress:
+    # How far a capture has been read: the reader state, which holds the
+    # offset to continue from, and the stream ids, half collected hellos and
+    # half-open handshakes as they were at that offset.
+
+    def __init__(self, path, identity, fingerprint):
+        self.path = path
+        self.identity = identity
+        self.fingerprint = fingerprint
+        self.state = None
+        self.tracker = StreamTracker()
+        self.pairer = HandshakePairer()
+        self.reassembler = HandshakeReassembler()
+
+
+class Checkpoint:
+    # Progress through a set of captures, saved to `path` so a later run picks
+    # up where this one stopped. Captures are identified by device and inode
+    # so one that is renamed by log rotation is still recognized. The report
+    # size is recorded too: rows written after the last save are dropped and
+    # written again on resume instead of being reported twice. So is the
+    # summary of the sessions in the report, if there is one.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.captures = {}
+        self.report = None
+        self.summary = None
+        self.seen = set()
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                version, *saved = pickle.load(f)
+            if version != CHECKPOINT_VERSION:
+                raise ValueError(f"{path} was written by another version of whatls")
+            self.captures, self.report, self.summary = saved
+
+    def progress(
+        self,
+        cap_file,
+        timeout=None,
+        max_flows=None,
+        max_hello_bytes=DEFAULT_MAX_FLOW_BYTES,
+        reassembly_bytes=DEFAULT_MAX_BYTES,
+    ):
+        cap_file = os.path.abspath(cap_file)
+        stat = os.stat(cap_file)
+        identity = (stat.st_dev, stat.st_ino)
+        with open(cap_file, "rb") as f:
+            fingerprint = f.read(FINGERPRINT_LEN)
+        progress = self.captures.get(identity)
+        # Offsets into gzipped captures count decompressed bytes
+        truncated = (
+            progress is not None
+            and progress.state is not None
+            and not is_gzip_magic(fingerprint)
+            and stat.st_size < progress.state.offset
+        )
+        if progress is not None and (
+            not fingerprint.startswith(progress.fingerprint) or truncated
+        ):
+            # Truncated, rewritten, or a new file that reused the inode
+            progress = None
+        if progress is None:
+            progress = CaptureProgress(cap_file, identity, fingerprint)
+            self.captures[identity] = progress
+        self.seen.add(identity)
+        progress.path = cap_file
+        progress.fingerprint = fingerprint
+        # Limits come from the current run
+        progress.pairer.timeout = timeout
+        progress.pairer.max_flows = max_flows
+        progress.reassembler.max_flow_bytes = max_hello_bytes
+        progress.reassembler.max_bytes = reassembly_bytes
+        return progress
+
+    def save(self, report=None, summary=None):
+        if report is not None:
+            self.report = (os.path.abspath(report), os.path.getsize(report))
+        self.summary = summary
+        if self.path is None:
+            return
+        temp = f"{self.path}.tmp"
+        with open(temp, "wb") as f:
+            pickle.dump(
+                (CHECKPOINT_VERSION, self.captures, self.report, self.summary), f
+            )
+        os.replace(temp, self.path)
+
+    def prune(self):
+        # Called after going over all the captures, forgets the ones that
+        # weren't among them and have since been deleted
+        for identity, progress in list(self.captures.items()):
+            if identity not in self.seen and not os.path.exists(progress.path):
+                del self.captures[identity]
+        self.seen = set()
+
+    def resume_report(self, report):
+        # Cuts the report back to its size at the last save and returns True,
+        # or False if the checkpoint was saved along with another report
+        if self.report is None or not os.path.exists(report):
+            return False
+        path, size = self.report
+        if path != os.path.abspath(report):
+            return False
+        os.truncate(report, size)
+        return True
+
+
+def iter_resumed_pairs(cap_file, progress, prefilter=None, stats=None):
+    # Pairs the hellos past the offset the capture was last read to. Between
+    # two pairs the progress is consistent and can be saved. The capture is
+    # read rather than mapped, it may be truncated and rewritten meanwhile.
+    with open_capture(cap_file, mapped=False) as capture:
+        if progress.state is None:
+            progress.state, _ = read_header(capture)
+        records = iter_records(capture, progress.state, progress.state.offset)
+        yield from iter_pairs(
+            records,
+            progress.tracker,
+            progress.reassembler,
+            progress.pairer,
+            prefilter,
+            stats,
+        )
@@ -0,0 +1,196 @@
+import select
+import socket
+import struct
+import time
+from collections import Counter
+from pcapreader import iter_records, open_capture
+from packets import decode_tcp, conversation_key, LINKTYPE_ETHERNET
+from tlsparser import (
+    parse_hello,
+    is_hello_retry_request,
+    get_negotiated_version,
+    tls_version_name,
+    cipher_suite_name,
+    ClientHello,
+)
+from pairing import HandshakePairer
+from bpf import attach_filter
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+MAX_FRAME = 65535
+
+
+class LiveCapture:
+    # Reads frames straight off an interface with the filter running in the
+    # kernel. Nothing is queued in userspace: if we fall behind the socket
+    # buffer fills up and the kernel counts the drops for us.
+
+    def __init__(self, interface, program=None, buffer_size=64 * 1024 * 1024):
+        self.interface = interface
+        self.received = 0
+        self.dropped = 0
+        self.sock = socket.socket(
+            socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL)
+        )
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        if program is not None:
+            attach_filter(self.sock, program)
+        self.sock.bind((interface, 0))
+        self.sock.setblocking(False)
+
+    def frames(self, idle=0.5):
+        # Yields (timestamp, linktype, frame), or None after `idle` seconds
+        # without traffic so the caller still gets to run periodic work. The
+        # socket is drained without blocking and only polled once it's empty.
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_FRAME)
+            except BlockingIOError:
+                ready, _, _ = select.select([self.sock], [], [], idle)
+                if not ready:
+                    yield None
+                continue
+            # The loopback device shows every packet twice, as sent and as
+            # received, libpcap drops the outgoing copy and so do we
+            if address[2] == PACKET_OUTGOING and address[3] == ARPHRD_LOOPBACK:
+                continue
+            yield time.time(), LINKTYPE_ETHERNET, data
+
+    def stats(self):
+        # The kernel resets its counters each time they are read
+        packets, drops = struct.unpack(
+            "II", self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8)
+        )
+        self.received += packets
+        self.dropped += drops
+        return self.received, self.dropped
+
+    def close(self):
+        self.sock.close()
+
+
+class ReplayCapture:
+    # Stand-in for an interface that plays back a saved capture, optionally
+    # at `speed` times the recorded rate, to try live mode without traffic.
+
+    def __init__(self, path, speed=None):
+        self.path = path
+        self.speed = speed
+        self.received = 0
+
+    def frames(self, idle=0.5):
+        start = None
+        with open_capture(self.path) as capture:
+            for record in iter_records(capture):
+                if self.speed:
+                    if start is None:
+                        start = (time.monotonic(), record.timestamp)
+                    delay = (record.timestamp - start[1]) / self.speed
+                    remaining = delay - (time.monotonic() - start[0])
+                    while remaining > 0:
+                        time.sleep(min(idle, remaining))
+                        yield None
+                        remaining = delay - (time.monotonic() - start[0])
+                self.received += 1
+                yield record.timestamp, record.linktype, record.data
+
+    def stats(self):
+        return self.received, 0
+
+    def close(self):
+        pass
+
+
+class PostureCounters:
+    # Counts raw ids, they are only named when reported. Captures count
+    # packets since they were opened, the packets and drops at the last
+    # report are kept to tell those of each interval.
+
+    def __init__(self):
+        self.versions = Counter()
+        self.cipher_suites = Counter()
+        self.total_versions = Counter()
+        self.total_cipher_suites = Counter()
+        self.sessions = 0
+        self.received = 0
+        self.dropped = 0
+
+    def add(self, server_hello):
+        self.versions[get_negotiated_version(server_hello)] += 1
+        self.cipher_suites[server_hello.cipher_suite] += 1
+        self.sessions += 1
+
+    def report(self, received, dropped, pending, totals=False):
+        # Reports the current window and rolls it over into the totals, or
+        # reports the totals once the capture is over. received and dropped
+        # are the capture's, since it was opened.
+        self.total_versions.update(self.versions)
+        self.total_cipher_suites.update(self.cipher_suites)
+        if totals:
+            label = "total"
+            versions = self.total_versions
+            cipher_suites = self.total_cipher_suites
+            packets, drops = received, dropped
+        else:
+            label = "interval"
+            versions = self.versions
+            cipher_suites = self.cipher_suites
+            packets, drops = received - self.received, dropped - self.dropped
+        self.received, self.dropped = received, dropped
+        lines = [
+            f"{time.strftime('%Y-%m-%d %H:%M:%S')} {label}:"
+            f" sessions={sum(versions.values())} packets={packets}"
+            f" dropped={drops} half_open={pending}"
+        ]
+        for version, count in versions.most_common():
+            lines.append(f"  {tls_version_name(version)}: {count}")
+        for cipher_suite, count in cipher_suites.most_common():
+            lines.append(f"  {cipher_suite_name(cipher_suite)}: {count}")
+        self.versions = Counter()
+        self.cipher_suites = Counter()
+        return "\n".join(lines)
+
+
+def run_live(capture, pairer=None, interval=10.0, out=print):
+    # Pairs hellos as they arrive and reports the counters for each interval.
+    # Flows are keyed by their addresses as there are no tcp stream ids here.
+    if pairer is None:
+        pairer = HandshakePairer(timeout=300.0, max_flows=100000)
+    counters = PostureCounters()
+    next_report = time.monotonic() + interval
+    try:
+        for frame in capture.frames():
+            if frame is not None:
+                timestamp, linktype, data = frame
+                segment = decode_tcp(linktype, data)
+                hello = parse_hello(segment.payload) if segment else None
+                if isinstance(hello, ClientHello):
+                    key = conversation_key(segment)
+                    pairer.client_hello(
+                        key, hello, hello.random, timestamp, hello.raw
+                    )
+                elif hello is not None:
+                    key = conversation_key(segment)
+                    pair = pairer.server_hello(
+                        key,
+                        hello,
+                        hello.random,
+                        timestamp,
+                        retry=is_hello_retry_request(hello),
+                    )
+                    if pair is not None:
+                        counters.add(pair[1])
+            if time.monotonic() >= next_report:
+                received, dropped = capture.stats()
+                out(counters.report(received, dropped, len(pairer.pending())))
+                next_report = time.monotonic() + interval
+    finally:
+        received, dropped = capture.stats()
+        pending = len(pairer.pending())
+        out(counters.report(received, dropped, pending, totals=True))
+        capture.close()
+    return counters
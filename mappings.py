@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 TLS_VERSION_MAPPING = {
     "0x00000300": "SSLv3",
     "0x00000301": "TLSv1.0",
@@ -354,3 +356,67 @@ CIPHER_SUITE_MAPPING = {
     "0xd003": "TLS_ECDHE_PSK_WITH_AES_128_CCM_8_SHA256",
     "0xd005": "TLS_ECDHE_PSK_WITH_AES_128_CCM_SHA256",
 }
+
+# The tables above indexed by the 16-bit ids found on the wire, so the hot
+# path looks ids up directly and names are only needed for output. Unknown ids
+# map to None.
+CipherSuite = namedtuple(
+    "CipherSuite",
+    ["id", "name", "kx", "cipher", "mac", "aead", "forward_secrecy", "insecure"],
+)
+TlsVersion = namedtuple("TlsVersion", ["id", "name", "deprecated"])
+
+AEAD_MODES = ("GCM", "CCM", "CCM_8", "POLY1305")
+# Key exchanges with an ephemeral key, "any" being TLS 1.3's key_share
+EPHEMERAL_KX = ("DHE", "ECDHE", "PSK_DHE", "ECCPWD", "any")
+# Export grade, unauthenticated or signalling only
+INSECURE_KX = ("EXPORT", "anon", "NULL")
+# Broken ciphers, or 64-bit blocks open to Sweet32
+INSECURE_CIPHERS = ("NULL", "RC4", "RC2", "DES", "DES40", "3DES", "IDEA")
+
+
+def _cipher_suite(cipher_suite_id, name):
+    if name.endswith("_SCSV"):
+        return CipherSuite(cipher_suite_id, name, None, None, None, False, False, False)
+    body = name[len("TLS_") :]
+    if "_WITH_" in body:
+        kx, body = body.split("_WITH_")
+    else:
+        kx = "any"
+    if body.endswith(("_CCM", "_CCM_8")):
+        # CCM suites name no hash
+        cipher, mac = body, None
+    else:
+        cipher, mac = body.rsplit("_", 1)
+    if cipher == mac:
+        # TLS_SHA256_SHA256 and friends only authenticate
+        cipher = "NULL"
+    aead = cipher.endswith(AEAD_MODES)
+    if aead:
+        mac = "AEAD"
+    kx_parts = kx.split("_")
+    forward_secrecy = kx_parts[0] in EPHEMERAL_KX or kx in EPHEMERAL_KX
+    insecure = (
+        any(part in INSECURE_KX for part in kx_parts)
+        or cipher.split("_")[0] in INSECURE_CIPHERS
+        or mac in ("MD5", "NULL")
+    )
+    return CipherSuite(
+        cipher_suite_id, name, kx, cipher, mac, aead, forward_secrecy, insecure
+    )
+
+
+CIPHER_SUITES = [None] * 0x10000
+for _key, _name in CIPHER_SUITE_MAPPING.items():
+    _cipher_suite_id = int(_key, 16)
+    CIPHER_SUITES[_cipher_suite_id] = _cipher_suite(_cipher_suite_id, _name)
+
+TLS_VERSIONS = [None] * 0x10000
+for _key, _name in TLS_VERSION_MAPPING.items():
+    # Everything before TLS 1.2 is deprecated by RFC 8996
+    _version = int(_key, 16)
+    TLS_VERSIONS[_version] = TlsVersion(_version, _name, _version < 0x0303)
+
+# For output that only carries the names
+CIPHER_SUITES_BY_NAME = {entry.name: entry for entry in CIPHER_SUITES if entry}
+TLS_VERSIONS_BY_NAME = {entry.name: entry for entry in TLS_VERSIONS if entry}
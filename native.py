@@ -0,0 +1,130 @@
+from collections import namedtuple
+from packets import decode_tcp, conversation_key
+from tlsparser import (
+    parse_hello,
+    is_handshake_record,
+    is_hello_retry_request,
+    ClientHello,
+)
+
+# offset and timestamp are those of the record the hello starts in, end is
+# the offset of the record it was complete with, if it took several
+Handshake = namedtuple(
+    "Handshake", ["stream", "offset", "end", "timestamp", "segment", "hello"]
+)
+
+
+def iter_handshakes(records, tracker, reassembler=None):
+    # Every TCP segment goes through the stream tracker so stream ids line up
+    # with wireshark's, only payloads starting a handshake record are parsed.
+    for record in records:
+        segment = decode_tcp(record.linktype, record.data)
+        if segment is None:
+            continue
+        stream = tracker.stream_id(segment)
+        if reassembler is not None and (
+            reassembler.flows or is_handshake_record(segment.payload)
+        ):
+            yield from _iter_reassembled(reassembler, stream, segment, record)
+            continue
+        hello = parse_hello(segment.payload)
+        if hello is None:
+            continue
+        yield Handshake(
+            stream,
+            record.offset,
+            record.offset,
+            record.timestamp,
+            _strip(segment),
+            hello,
+        )
+
+
+def iter_continued_handshakes(records, tracker, reassembler):
+    # Finishes the hellos left half collected at the end of a chunk of a
+    # capture. Only streams the chunk knows are looked at and nothing new is
+    # started, the next chunk takes care of that.
+    for record in records:
+        if not reassembler.flows:
+            return
+        reassembler.expire(record.timestamp)
+        segment = decode_tcp(record.linktype, record.data)
+        if segment is None:
+            continue
+        state = tracker.streams.get(conversation_key(segment))
+        if state is not None:
+            yield from _iter_reassembled(
+                reassembler, state[0], segment, record, continued=True
+            )
+
+
+def _iter_reassembled(reassembler, stream, segment, record, continued=False):
+    if reassembler.flows and segment.payload:
+        # The peer only answers a complete hello, if we still wait for some of
+        # it those segments weren't captured
+        partial = reassembler.take((stream, segment.dst, segment.dport))
+        if partial is not None:
+            first, offset, timestamp, payload = partial
+            hello = parse_hello(payload)
+            if hello is not None:
+                yield Handshake(stream, offset, record.offset, timestamp, first, hello)
+    key = (stream, segment.src, segment.sport)
+    if continued and key not in reassembler.flows:
+        return
+    collected = reassembler.feed(key, segment, record.timestamp, record.offset)
+    if collected is None or not collected[2]:
+        return
+    offset, timestamp, payload = collected
+    hello = parse_hello(payload)
+    if hello is not None:
+        yield Handshake(
+            stream, offset, record.offset, timestamp, _strip(segment), hello
+        )
+
+
+def _strip(segment):
+    # Handshakes outlive their record, and are pickled with checkpoints and
+    # results of parallel runs, so they don't hold on to its data
+    return segment._replace(payload=b"")
+
+
+def iter_pairs(records, tracker, reassembler, pairer, prefilter=None, stats=None):
+    # Capture records to matched hellos, with each stage timed by stats
+    if stats is not None:
+        records = stats.read(records)
+    upstream = "read"
+    if prefilter is not None:
+        records = prefilter.filter(records)
+        if stats is not None:
+            records = stats.stage("prefilter", records, upstream)
+            upstream = "prefilter"
+    handshakes = iter_handshakes(records, tracker, reassembler)
+    if stats is not None:
+        handshakes = stats.dissect(handshakes, upstream)
+    pairs = pair_handshakes(handshakes, pairer)
+    if stats is not None:
+        pairs = stats.pair(pairs, "dissect")
+    return pairs
+
+
+def pair_handshakes(handshakes, pairer):
+    for handshake in handshakes:
+        hello = handshake.hello
+        if isinstance(hello, ClientHello):
+            pairer.client_hello(
+                handshake.stream,
+                handshake,
+                hello.random,
+                handshake.timestamp,
+                hello.raw,
+            )
+            continue
+        pair = pairer.server_hello(
+            handshake.stream,
+            handshake,
+            hello.random,
+            handshake.timestamp,
+            retry=is_hello_retry_request(hello),
+        )
+        if pair is not None:
+            yield pair
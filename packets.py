@@ -0,0 +1,166 @@
+import socket
+import struct
+from collections import namedtuple
+
+# Link types, see https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+# DLT_RAW has a different value on some BSDs
+DLT_RAW_ALIASES = (12, 14)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_TCP = 6
+# IPv6 extension headers that can sit between the fixed header and TCP
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+Segment = namedtuple(
+    "Segment", ["src", "sport", "dst", "dport", "seq", "flags", "payload"]
+)
+
+
+def format_ip(address):
+    if len(address) == 4:
+        return socket.inet_ntop(socket.AF_INET, address)
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def decode_tcp(linktype, data):
+    # data may be a memoryview of the capture, the payload is then a slice of
+    # it. Addresses are copied, they end up in keys that are compared.
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        ethertype = struct.unpack_from("!H", data, 12)[0]
+        pos = 14
+        while ethertype in ETHERTYPE_VLAN and len(data) >= pos + 4:
+            ethertype = struct.unpack_from("!H", data, pos + 2)[0]
+            pos += 4
+        return _decode_ethertype(ethertype, data, pos)
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6) + DLT_RAW_ALIASES:
+        return _decode_ip(data, 0)
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # The address family is in host byte order for NULL, network for LOOP
+        return _decode_ip(data, 4)
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None
+        return _decode_ethertype(struct.unpack_from("!H", data, 14)[0], data, 16)
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return None
+        return _decode_ethertype(struct.unpack_from("!H", data, 0)[0], data, 20)
+    return None
+
+
+def _decode_ethertype(ethertype, data, pos):
+    if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+        return None
+    return _decode_ip(data, pos)
+
+
+def _decode_ip(data, pos):
+    if len(data) < pos + 1:
+        return None
+    version = data[pos] >> 4
+    if version == 4:
+        if len(data) < pos + 20:
+            return None
+        ihl = (data[pos] & 0x0F) * 4
+        total_len, _, frag = struct.unpack_from("!HHH", data, pos + 2)
+        # Only the first fragment carries the TCP header
+        if data[pos + 9] != IPPROTO_TCP or frag & 0x1FFF:
+            return None
+        src = bytes(data[pos + 12 : pos + 16])
+        dst = bytes(data[pos + 16 : pos + 20])
+        # Trim ethernet padding, but tolerate TSO captures with a zero length
+        end = pos + total_len if total_len >= ihl else len(data)
+        return _decode_tcp_header(src, dst, data, pos + ihl, end)
+    if version == 6:
+        if len(data) < pos + 40:
+            return None
+        payload_len = struct.unpack_from("!H", data, pos + 4)[0]
+        next_header = data[pos + 6]
+        src = bytes(data[pos + 8 : pos + 24])
+        dst = bytes(data[pos + 24 : pos + 40])
+        end = pos + 40 + payload_len if payload_len else len(data)
+        pos += 40
+        while next_header in IPV6_EXTENSION_HEADERS and len(data) >= pos + 2:
+            next_header = data[pos]
+            pos += (data[pos + 1] + 1) * 8
+        if next_header == IPV6_FRAGMENT_HEADER and len(data) >= pos + 8:
+            if struct.unpack_from("!H", data, pos + 2)[0] & 0xFFF8:
+                return None
+            next_header = data[pos]
+            pos += 8
+        if next_header != IPPROTO_TCP:
+            return None
+        return _decode_tcp_header(src, dst, data, pos, end)
+    return None
+
+
+def _decode_tcp_header(src, dst, data, pos, end):
+    if len(data) < pos + 20:
+        return None
+    sport, dport, seq, _, offset_flags = struct.unpack_from("!HHIIH", data, pos)
+    header_len = (offset_flags >> 12) * 4
+    if header_len < 20:
+        return None
+    payload = data[pos + header_len : end]
+    return Segment(src, sport, dst, dport, seq, offset_flags & 0xFF, payload)
+
+
+def conversation_key(segment):
+    a = (segment.src, segment.sport)
+    b = (segment.dst, segment.dport)
+    return (a, b) if a <= b else (b, a)
+
+
+class StreamTracker:
+    # Numbers TCP conversations in order of first appearance, the same way
+    # wireshark assigns tcp.stream, so rows can be cross referenced.
+
+    def __init__(self, record_history=False):
+        self.streams = {}
+        self.next_stream = 0
+        # (conversation, opened by a SYN, conditional) per stream, kept when a
+        # chunk of a capture is analyzed on its own and renumbered afterwards
+        self.history = [] if record_history else None
+
+    def stream_id(self, segment):
+        key = conversation_key(segment)
+        state = self.streams.get(key)
+        syn_only = segment.flags & (TCP_SYN | TCP_ACK) == TCP_SYN
+        if state is None:
+            # Whether the conversation was torn down before a chunk started is
+            # unknown until the chunks are merged
+            state = [self.next_stream, False, self.history is None or syn_only]
+            self._new_stream(key, state, syn_only, False)
+        elif syn_only and (state[1] or not state[2]):
+            # A new SYN on a conversation that was torn down is a new stream
+            conditional = not state[1]
+            state = [self.next_stream, False, True]
+            self._new_stream(key, state, syn_only, conditional)
+        if segment.flags & (TCP_FIN | TCP_RST):
+            state[1] = True
+        return state[0]
+
+    def _new_stream(self, key, state, syn_only, conditional):
+        self.streams[key] = state
+        self.next_stream += 1
+        if self.history is not None:
+            self.history.append((key, syn_only, conditional))
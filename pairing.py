@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+
+class _Flow:
+    __slots__ = (
+        "pending",
+        "pending_ident",
+        "pending_raw",
+        "paired_ident",
+        "last_seen",
+        "retry",
+    )
+
+    def __init__(self):
+        self.pending = None
+        self.pending_ident = None
+        self.pending_raw = None
+        self.paired_ident = None
+        self.last_seen = None
+        self.retry = False
+
+
+class HandshakePairer:
+    # Matches Client Hellos with the Server Hello of the same flow as packets
+    # stream past. Flows are kept in least recently used order so half-open
+    # handshakes can be evicted by age or once there are too many of them.
+    #
+    # Idents are whatever uniquely identifies a hello (its random), they let
+    # retransmitted hellos be told apart from a new handshake on the flow.
+    # The Client Hello answering a HelloRetryRequest keeps the random of the
+    # first one (RFC 8446 4.1.2), so after one the raw bytes of the hellos
+    # are compared instead, where callers have them.
+
+    def __init__(self, timeout=None, max_flows=None):
+        self.timeout = timeout
+        self.max_flows = max_flows
+        self.flows = OrderedDict()
+        self.pairs = 0
+        self.orphaned = 0
+        self.evicted = 0
+
+    def client_hello(self, key, item, ident=None, timestamp=None, raw=None):
+        flow = self._touch(key, timestamp)
+        if ident is not None and ident in (flow.pending_ident, flow.paired_ident):
+            retried = (
+                flow.retry
+                and ident == flow.pending_ident
+                and raw is not None
+                and raw != flow.pending_raw
+            )
+            if not retried:
+                # Retransmission of a hello we already have
+                return
+        if flow.pending is not None and not flow.retry:
+            self.orphaned += 1
+        flow.pending = item
+        flow.pending_ident = ident
+        flow.pending_raw = raw
+        flow.retry = False
+
+    def server_hello(self, key, item, ident=None, timestamp=None, retry=False):
+        flow = self.flows.get(key)
+        if flow is None or flow.pending is None:
+            # Retransmission after the pair was emitted, or we never saw the
+            # Client Hello of this flow
+            return None
+        self._touch(key, timestamp)
+        if retry:
+            # HelloRetryRequest, the client answers with a second Client Hello
+            flow.retry = True
+            return None
+        pair = (flow.pending, item)
+        flow.paired_ident = flow.pending_ident
+        flow.pending = None
+        flow.pending_ident = None
+        flow.pending_raw = None
+        self.pairs += 1
+        return pair
+
+    def pending(self):
+        # Client Hellos still waiting for a Server Hello, oldest flow first
+        return [
+            (key, flow.pending)
+            for key, flow in self.flows.items()
+            if flow.pending is not None
+        ]
+
+    def flow_state(self, key):
+        return self.flows.get(key)
+
+    def restore_flow(self, key, flow):
+        # Replaces the state of a flow with one carried over from another
+        # pairer, e.g. the one that analyzed the next chunk of a capture
+        self.flows.pop(key, None)
+        if flow is not None:
+            self.flows[key] = flow
+
+    def _touch(self, key, timestamp):
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = _Flow()
+            self.flows[key] = flow
+            if self.max_flows is not None and len(self.flows) > self.max_flows:
+                self._evict()
+        else:
+            self.flows.move_to_end(key)
+        if timestamp is not None:
+            flow.last_seen = timestamp
+            if self.timeout is not None:
+                self._expire(timestamp - self.timeout)
+        return flow
+
+    def _expire(self, cutoff):
+        while self.flows:
+            flow = next(iter(self.flows.values()))
+            if flow.last_seen is None or flow.last_seen >= cutoff:
+                return
+            self._evict()
+
+    def _evict(self):
+        _, flow = self.flows.popitem(last=False)
+        if flow.pending is not None:
+            self.orphaned += 1
+            self.evicted += 1
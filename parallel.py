@@ -0,0 +1,390 @@
+import os
+from collections import namedtuple
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from pcapreader import (
+    iter_records,
+    open_capture,
+    scan_chunks,
+    is_capture_magic,
+    is_gzip_magic,
+    read_capture_magic,
+)
+from packets import StreamTracker
+from pairing import HandshakePairer
+from native import iter_handshakes, iter_continued_handshakes, pair_handshakes
+from tlsparser import ClientHello
+from reassembly import HandshakeReassembler, DEFAULT_MAX_FLOW_BYTES, DEFAULT_MAX_BYTES
+from prefilter import Prefilter
+from stats import get_capture_counts
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+ChunkTask = namedtuple(
+    "ChunkTask",
+    [
+        "path",
+        "start",
+        "end",
+        "state",
+        "timeout",
+        "max_flows",
+        "prefilter",
+        "max_hello_bytes",
+        "reassembly_bytes",
+    ],
+)
+ChunkResult = namedtuple(
+    "ChunkResult",
+    [
+        "history",
+        "closed",
+        "heads",
+        "settled",
+        "pairs",
+        "kept",
+        "dropped",
+        "counts",
+        "continued",
+        "rebuilt",
+    ],
+)
+
+
+def expand_captures(paths, compressed=True):
+    # Directories are expanded to the captures they contain, in name order so
+    # rotated files are reported in sequence. Gzipped captures are left out
+    # without compressed.
+    captures = []
+    for path in paths:
+        if not os.path.isdir(path):
+            captures.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            candidate = os.path.join(path, name)
+            if os.path.isfile(candidate) and _is_capture(candidate, compressed):
+                captures.append(candidate)
+    return captures
+
+
+def _is_capture(path, compressed=True):
+    if compressed:
+        return is_capture_magic(read_capture_magic(path))
+    with open(path, "rb") as f:
+        return is_capture_magic(f.read(4))
+
+
+class _ChunkPairer(HandshakePairer):
+    # A stream's first pair in a chunk can depend on hellos from the previous
+    # chunk, so it is held back with the hellos leading up to it and settled
+    # when the chunks are merged. Later pairs on the stream are final.
+    #
+    # Hellos are numbered in the order they were paired, which is the order
+    # a serial run sees them in. Their offsets aren't: a hello put together
+    # from several segments has the offset of the first one.
+
+    def __init__(self, timeout=None, max_flows=None):
+        super().__init__(timeout, max_flows)
+        self.heads = {}
+        self.settled = set()
+        self.sequence = 0
+        self.client_hellos = 0
+
+    def client_hello(self, key, item, ident=None, timestamp=None, raw=None):
+        self.sequence += 1
+        self.client_hellos += 1
+        if key in self.settled:
+            super().client_hello(key, item, ident, timestamp, raw)
+            return
+        # The raw bytes are those of the item's hello
+        self.heads.setdefault(key, []).append(
+            (self.sequence, False, item, ident, timestamp, False)
+        )
+        orphaned = self.orphaned - self.evicted
+        super().client_hello(key, item, ident, timestamp, raw)
+        # The merger pairs held back hellos again and counts them then, only
+        # flows evicted meanwhile are counted here
+        self.orphaned = orphaned + self.evicted
+
+    def server_hello(self, key, item, ident=None, timestamp=None, retry=False):
+        self.sequence += 1
+        pair = super().server_hello(key, item, ident, timestamp, retry)
+        if key in self.settled:
+            return pair
+        self.heads.setdefault(key, []).append(
+            (self.sequence, True, item, ident, timestamp, retry)
+        )
+        if pair is not None:
+            self.settled.add(key)
+        return None
+
+
+def analyze_chunk(task):
+    tracker = StreamTracker(record_history=True)
+    pairer = _ChunkPairer(task.timeout, task.max_flows)
+    reassembler = HandshakeReassembler(task.max_hello_bytes, task.reassembly_bytes)
+    prefilter = Prefilter(task.prefilter) if task.prefilter else None
+    with open_capture(task.path) as capture:
+        records = iter_records(capture, task.state, task.start)
+        counts = {}
+        records, overrun = _split_records(records, task.end, counts)
+        if prefilter is not None:
+            records = prefilter.filter(records)
+        rebuilt = set()
+        handshakes = _note_rebuilt(
+            iter_handshakes(records, tracker, reassembler), rebuilt
+        )
+        # Numbered by their Server Hello to be put in order with the held back
+        # pairs when merged
+        pairs = [
+            (pairer.sequence, pair) for pair in pair_handshakes(handshakes, pairer)
+        ]
+        continued = {}
+        if reassembler.flows:
+            # Hellos split over the end of the chunk are finished here, the
+            # next chunk only sees the rest of them
+            if prefilter is not None:
+                overrun = prefilter.filter(overrun, count=False)
+            handshakes = _note_continued(
+                iter_continued_handshakes(overrun, tracker, reassembler),
+                reassembler,
+                continued,
+            )
+            pairs.extend(
+                (pairer.sequence, pair) for pair in pair_handshakes(handshakes, pairer)
+            )
+    # For --stats. Hellos still waiting at the end may be answered in the
+    # next chunk, the merger counts the ones that never are.
+    counts.update(get_capture_counts(pairer, reassembler))
+    counts["client_hellos"] = pairer.client_hellos
+    counts["server_hellos"] = pairer.sequence - pairer.client_hellos
+    counts["dropped_hellos"] += len(reassembler.flows)
+    return ChunkResult(
+        tracker.history,
+        {key: state[1] for key, state in tracker.streams.items()},
+        pairer.heads,
+        {key: pairer.flow_state(key) for key in pairer.settled},
+        pairs,
+        prefilter.kept if prefilter else 0,
+        prefilter.dropped if prefilter else 0,
+        counts,
+        continued,
+        rebuilt,
+    )
+
+
+def _note_rebuilt(handshakes, rebuilt):
+    # Where the hellos of several segments were complete. If the first one
+    # was sent again right after the start of the chunk, the previous chunk
+    # may have finished the same hello from the original.
+    for handshake in handshakes:
+        if handshake.end != handshake.offset:
+            rebuilt.add(handshake.end)
+        yield handshake
+
+
+def _note_continued(handshakes, reassembler, continued):
+    # Where the hellos finished past the end of the chunk were complete, and
+    # the counters they went into
+    reassembled = reassembler.reassembled
+    for handshake in handshakes:
+        kind = "server_hellos"
+        if isinstance(handshake.hello, ClientHello):
+            kind = "client_hellos"
+        if reassembler.reassembled != reassembled:
+            continued[handshake.end] = (kind, "reassembled_hellos")
+            reassembled = reassembler.reassembled
+        else:
+            # Handed over as far as it got
+            continued[handshake.end] = (kind, "partial_hellos")
+        yield handshake
+
+
+def _split_records(records, end, counts):
+    # The records starting before `end`, and the ones after, from one pass.
+    # The records and bytes before `end` are counted in counts.
+    boundary = []
+
+    def head():
+        packets = size = 0
+        try:
+            for record in records:
+                if end is not None and record.offset >= end:
+                    boundary.append(record)
+                    return
+                packets += 1
+                size += len(record.data)
+                yield record
+        finally:
+            counts["packets"] = packets
+            counts["bytes"] = size
+
+    def tail():
+        yield from boundary
+        yield from records
+
+    return head(), tail()
+
+
+class ChunkMerger:
+    # Stitches the chunks of one capture back together in order: local stream
+    # ids are renumbered the way a single pass would have numbered them, and
+    # the held back hellos are paired against state from earlier chunks.
+
+    def __init__(self, timeout=None, max_flows=None):
+        self.streams = {}
+        self.next_stream = 0
+        self.pairer = HandshakePairer(timeout, max_flows)
+
+    def merge(self, result):
+        streams = []
+        seen = set()
+        for key, syn_only, conditional in result.history:
+            state = self.streams.get(key)
+            if conditional:
+                # The chunk saw a SYN without knowing whether the conversation
+                # had been torn down before it started
+                split = state[1]
+            else:
+                split = key in seen or state is None or (syn_only and state[1])
+            if split:
+                state = [self.next_stream, False]
+                self.streams[key] = state
+                self.next_stream += 1
+            seen.add(key)
+            streams.append(state[0])
+        for key, closed in result.closed.items():
+            self.streams[key][1] = self.streams[key][1] or closed
+
+        events = []
+        for local, head in result.heads.items():
+            for event in head:
+                events.append((event[0], local, event))
+        events.sort(key=lambda event: event[0])
+        remaining = {local: len(head) for local, head in result.heads.items()}
+
+        pairs = []
+        for sequence, local, (_, is_server, item, ident, timestamp, retry) in events:
+            stream = streams[local]
+            item = item._replace(stream=stream)
+            if is_server:
+                pair = self.pairer.server_hello(stream, item, ident, timestamp, retry)
+                if pair is not None:
+                    pairs.append((sequence, pair))
+            else:
+                self.pairer.client_hello(
+                    stream, item, ident, timestamp, item.hello.raw
+                )
+            remaining[local] -= 1
+            if not remaining[local] and local in result.settled:
+                # Past its first pair the stream no longer depends on earlier
+                # chunks, carry on from where the chunk's own pairer got to
+                flow = result.settled[local]
+                if flow is not None and flow.pending is not None:
+                    flow.pending = flow.pending._replace(stream=stream)
+                self.pairer.restore_flow(stream, flow)
+
+        for sequence, (client_hello, server_hello) in result.pairs:
+            stream = streams[client_hello.stream]
+            pairs.append(
+                (
+                    sequence,
+                    (
+                        client_hello._replace(stream=stream),
+                        server_hello._replace(stream=stream),
+                    ),
+                )
+            )
+        pairs.sort(key=lambda pair: pair[0])
+        return [pair for _, pair in pairs]
+
+
+def get_chunk_tasks(
+    path,
+    chunk_size,
+    timeout=None,
+    max_flows=None,
+    prefilter=None,
+    max_hello_bytes=DEFAULT_MAX_FLOW_BYTES,
+    reassembly_bytes=DEFAULT_MAX_BYTES,
+):
+    limits = (timeout, max_flows, prefilter, max_hello_bytes, reassembly_bytes)
+    if os.path.getsize(path) <= chunk_size:
+        return [ChunkTask(path, None, None, None, *limits)]
+    with open(path, "rb") as f:
+        if is_gzip_magic(f.read(2)):
+            # Only read front to back
+            return [ChunkTask(path, None, None, None, *limits)]
+        f.seek(0)
+        return [
+            ChunkTask(path, start, end, state, *limits)
+            for start, end, state in scan_chunks(f, chunk_size)
+        ]
+
+
+def iter_parallel_captures(
+    captures,
+    jobs,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    timeout=None,
+    max_flows=None,
+    prefilter=None,
+    max_hello_bytes=DEFAULT_MAX_FLOW_BYTES,
+    reassembly_bytes=DEFAULT_MAX_BYTES,
+    stats=None,
+):
+    # Yields (capture, pairs) for each capture in order, where pairs yields
+    # (client hello, server hello) in the order a serial run would. Like
+    # itertools.groupby, each capture's pairs have to be consumed before
+    # moving on to the next one. Flow eviction happens per chunk, so results
+    # only differ from a serial run when flows are being evicted. The chunks'
+    # prefilter counts are added to the given prefilter, their counters to
+    # the given stats.
+    expression = prefilter.expression if prefilter is not None else None
+    capture_tasks = [
+        get_chunk_tasks(
+            path,
+            chunk_size,
+            timeout,
+            max_flows,
+            expression,
+            max_hello_bytes,
+            reassembly_bytes,
+        )
+        for path in captures
+    ]
+    tasks = [task for chunk_tasks in capture_tasks for task in chunk_tasks]
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(analyze_chunk, tasks)
+        pairs = None
+        for path, chunk_tasks in zip(captures, capture_tasks):
+            if pairs is not None:
+                # Catch up if the previous capture wasn't read to the end
+                for _ in pairs:
+                    pass
+            pairs = _merge_chunks(
+                islice(results, len(chunk_tasks)), timeout, max_flows, prefilter, stats
+            )
+            yield path, pairs
+
+
+def _merge_chunks(results, timeout, max_flows, prefilter, stats):
+    merger = ChunkMerger(timeout, max_flows)
+    continued = {}
+    for result in results:
+        if prefilter is not None:
+            prefilter.kept += result.kept
+            prefilter.dropped += result.dropped
+        if stats is not None:
+            counts = dict(result.counts)
+            for end in result.rebuilt.intersection(continued):
+                # Already counted by the previous chunk, the pairer takes the
+                # second one for a retransmission
+                for name in continued[end]:
+                    counts[name] -= 1
+            stats.add_counts(counts)
+        continued = result.continued
+        yield from merger.merge(result)
+    if stats is not None:
+        stats.add_capture(merger.pairer)
+
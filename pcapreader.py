@@ -0,0 +1,408 @@
+import copy
+import gzip
+import mmap
+import os
+import struct
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Classic pcap magic numbers mapped to (byte order, timestamp resolution)
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Types iter_records slices records out of instead of reading them
+BUFFER_TYPES = (mmap.mmap, bytes, bytearray, memoryview)
+# Pages of a memory mapped capture this far behind the reader are dropped
+MAP_RELEASE_WINDOW = 16 * 1024 * 1024
+
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+# pcapng block types we care about
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_IF_TSRESOL = 9
+
+Record = namedtuple("Record", ["offset", "timestamp", "linktype", "data"])
+
+
+class CaptureState:
+    # What is needed to decode records from an arbitrary offset: the file
+    # header for pcap, the current section's byte order and interfaces for
+    # pcapng. The offset is where reading stopped, right after the last
+    # complete block, so a capture that is still being written can be read
+    # again from there once it has grown.
+
+    def __init__(self, format, endian, resolution=1e-6, linktype=None):
+        self.format = format
+        self.endian = endian
+        self.resolution = resolution
+        self.linktype = linktype
+        self.interfaces = []
+        self.offset = None
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+
+def is_capture_magic(magic):
+    return magic == PCAPNG_MAGIC or magic in PCAP_MAGIC
+
+
+def read_header(f):
+    # Returns the capture state and the offset of the first record
+    magic = f.read(4)
+    if magic in PCAP_MAGIC:
+        endian, resolution = PCAP_MAGIC[magic]
+        header = f.read(PCAP_HEADER_LEN - 4)
+        if len(header) < PCAP_HEADER_LEN - 4:
+            raise ValueError("Truncated pcap header")
+        # The upper bits of the network field carry FCS information
+        linktype = struct.unpack(endian + "I", header[16:20])[0] & 0xFFFF
+        state = CaptureState("pcap", endian, resolution, linktype)
+        state.offset = PCAP_HEADER_LEN
+        return state, PCAP_HEADER_LEN
+    if magic == PCAPNG_MAGIC:
+        state = CaptureState("pcapng", "<")
+        block_len = _read_section_header(f, state)
+        if block_len is None:
+            raise ValueError("Truncated pcapng section header")
+        state.offset = block_len
+        return state, block_len
+    if not magic:
+        raise ValueError("Empty capture")
+    raise ValueError("Unsupported capture format")
+
+
+def is_gzip_magic(magic):
+    return magic[:2] == GZIP_MAGIC
+
+
+def read_capture_magic(path):
+    # The magic of a capture, looking inside gzipped ones
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        if not is_gzip_magic(magic):
+            return magic
+        f.seek(0)
+        try:
+            with gzip.GzipFile(fileobj=f) as decompressed:
+                return decompressed.read(4)
+        except (OSError, EOFError):
+            return b""
+
+
+@contextmanager
+def open_capture(path, mapped=True):
+    # Opens a capture for iter_records. Plain captures are memory mapped, so
+    # records are slices of the map and nothing is copied until a hello is
+    # parsed. Gzipped ones are decompressed as they are read. Captures that
+    # may still be written to are read without mapped: a mapped file that is
+    # truncated under the reader, as by tcpdump -W rotating its ring of
+    # files, kills the process with SIGBUS instead of ending the records.
+    with open(path, "rb") as f:
+        if is_gzip_magic(f.read(2)):
+            f.seek(0)
+            with gzip.GzipFile(fileobj=f) as decompressed:
+                yield decompressed
+            return
+        f.seek(0)
+        if not mapped:
+            yield f
+            return
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files, pipes and the like can't be mapped
+            yield f
+            return
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            yield mapped
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # Records are still referenced, the map goes away with them
+                pass
+
+
+def check_capture(path):
+    # Raises ValueError unless path starts like a pcap or pcapng capture,
+    # gzipped or not, and OSError when it can't be read
+    with open_capture(path, mapped=False) as f:
+        try:
+            read_header(f)
+        except EOFError:
+            raise ValueError("Truncated gzip stream")
+
+
+def iter_records(f, state=None, start=None, end=None):
+    # Yields the records of a capture, or only those starting in [start, end)
+    # when resuming from a known state, e.g. one returned by scan_chunks. f is
+    # a file object, or a buffer such as a memory map, whose records are
+    # memoryview slices of it.
+    if isinstance(f, BUFFER_TYPES):
+        return _iter_buffer(f, state, start, end)
+    if state is None:
+        state, offset = read_header(f)
+    else:
+        offset = start
+        f.seek(start)
+    if state.format == "pcap":
+        return _iter_pcap(f, state, offset, end)
+    return _iter_pcapng(f, state, offset, end)
+
+
+def _iter_pcap(f, state, offset, end):
+    record_header = struct.Struct(state.endian + "IIII")
+    resolution = state.resolution
+    linktype = state.linktype
+    while end is None or offset < end:
+        header = f.read(PCAP_RECORD_HEADER_LEN)
+        if len(header) < PCAP_RECORD_HEADER_LEN:
+            return
+        ts_sec, ts_frac, incl_len, _ = record_header.unpack(header)
+        data = f.read(incl_len)
+        if len(data) < incl_len:
+            # Truncated final record, e.g. a capture that is still being written
+            return
+        record = Record(offset, ts_sec + ts_frac * resolution, linktype, data)
+        offset += PCAP_RECORD_HEADER_LEN + incl_len
+        state.offset = offset
+        yield record
+
+
+def _iter_pcapng(f, state, offset, end):
+    while end is None or offset < end:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        block_type, block_len = struct.unpack(state.endian + "II", header)
+        if block_type == PCAPNG_SHB:
+            block_len = _read_section_header(f, state, header)
+            if block_len is None:
+                return
+            offset += block_len
+            state.offset = offset
+            continue
+        if block_len < 12:
+            return
+        body = f.read(block_len - 8)
+        if len(body) < block_len - 8:
+            return
+        record = _parse_block(state, block_type, body[:-4], offset)
+        offset += block_len
+        state.offset = offset
+        if record is not None:
+            yield record
+
+
+def _iter_buffer(buffer, state, offset, end):
+    view = memoryview(buffer)
+    if state is None:
+        state, offset = read_header(_BufferReader(view))
+    mapped = None
+    if isinstance(buffer, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+        mapped = buffer
+    if state.format == "pcap":
+        return _iter_buffer_pcap(view, state, offset, end, mapped)
+    return _iter_buffer_pcapng(view, state, offset, end, mapped)
+
+
+def _iter_buffer_pcap(view, state, offset, end, mapped):
+    unpack_header = struct.Struct(state.endian + "IIII").unpack_from
+    resolution = state.resolution
+    linktype = state.linktype
+    size = len(view)
+    if end is None or end > size:
+        end = size
+    released = offset - offset % mmap.PAGESIZE
+    release_after = 2 * MAP_RELEASE_WINDOW if mapped is not None else float("inf")
+    while offset < end and offset + PCAP_RECORD_HEADER_LEN <= size:
+        ts_sec, ts_frac, incl_len, _ = unpack_header(view, offset)
+        start = offset + PCAP_RECORD_HEADER_LEN
+        if start + incl_len > size:
+            # Truncated final record, e.g. a capture that is still being written
+            return
+        data = view[start : start + incl_len]
+        record = Record(offset, ts_sec + ts_frac * resolution, linktype, data)
+        offset = start + incl_len
+        state.offset = offset
+        if offset - released >= release_after:
+            released = _release_pages(mapped, released, offset)
+        yield record
+
+
+def _iter_buffer_pcapng(view, state, offset, end, mapped):
+    unpack_from = struct.unpack_from
+    size = len(view)
+    if end is None or end > size:
+        end = size
+    released = offset - offset % mmap.PAGESIZE
+    release_after = 2 * MAP_RELEASE_WINDOW if mapped is not None else float("inf")
+    while offset < end and offset + 8 <= size:
+        block_type, block_len = unpack_from(state.endian + "II", view, offset)
+        if block_type == PCAPNG_SHB:
+            reader = _BufferReader(view, offset + 8)
+            header = bytes(view[offset : offset + 8])
+            block_len = _read_section_header(reader, state, header)
+            if block_len is None:
+                return
+            offset += block_len
+            state.offset = offset
+            continue
+        if block_len < 12 or offset + block_len > size:
+            return
+        body = view[offset + 8 : offset + block_len - 4]
+        record = _parse_block(state, block_type, body, offset)
+        offset += block_len
+        state.offset = offset
+        if offset - released >= release_after:
+            released = _release_pages(mapped, released, offset)
+        if record is not None:
+            yield record
+
+
+def _release_pages(mapped, released, offset):
+    # Drops the pages well behind the reader from the process, so memory use
+    # stays flat however large the capture. Anything still looking at them
+    # gets them back from the page cache.
+    while offset - released >= 2 * MAP_RELEASE_WINDOW:
+        mapped.madvise(mmap.MADV_DONTNEED, released, MAP_RELEASE_WINDOW)
+        released += MAP_RELEASE_WINDOW
+    return released
+
+
+class _BufferReader:
+    # Reads a buffer like a file, for the headers of captures in memory
+
+    def __init__(self, buffer, pos=0):
+        self.buffer = buffer
+        self.pos = pos
+
+    def read(self, size):
+        data = bytes(self.buffer[self.pos : self.pos + size])
+        self.pos += len(data)
+        return data
+
+
+def _read_section_header(f, state, header=None):
+    # The byte order magic follows the block length, so the length can only be
+    # decoded once the section's byte order is known.
+    if header is None:
+        header = PCAPNG_MAGIC + f.read(4)
+    bom = f.read(4)
+    if len(header) < 8 or len(bom) < 4:
+        return None
+    if struct.unpack("<I", bom)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+        state.endian = "<"
+    else:
+        state.endian = ">"
+    block_len = struct.unpack(state.endian + "I", header[4:8])[0]
+    if block_len < 16 or len(f.read(block_len - 12)) < block_len - 12:
+        return None
+    # Interface ids are scoped to their section
+    state.interfaces = []
+    return block_len
+
+
+def _parse_block(state, block_type, body, offset):
+    endian = state.endian
+    if block_type == PCAPNG_EPB:
+        if_id, ts_high, ts_low, cap_len, _ = struct.unpack(endian + "IIIII", body[:20])
+        linktype, resolution = state.interfaces[if_id]
+        timestamp = ((ts_high << 32) | ts_low) * resolution
+        return Record(offset, timestamp, linktype, body[20 : 20 + cap_len])
+    if block_type == PCAPNG_SPB:
+        linktype, _ = state.interfaces[0]
+        orig_len = struct.unpack(endian + "I", body[:4])[0]
+        return Record(offset, 0.0, linktype, body[4 : 4 + orig_len])
+    if block_type == PCAPNG_PB:
+        if_id, _, ts_high, ts_low, cap_len, _ = struct.unpack(
+            endian + "HHIIII", body[:20]
+        )
+        linktype, resolution = state.interfaces[if_id]
+        timestamp = ((ts_high << 32) | ts_low) * resolution
+        return Record(offset, timestamp, linktype, body[20 : 20 + cap_len])
+    if block_type == PCAPNG_IDB:
+        state.interfaces.append(_parse_idb(body, endian))
+    return None
+
+
+def _parse_idb(body, endian):
+    linktype = struct.unpack(endian + "H", body[:2])[0]
+    resolution = 1e-6
+    pos = 8
+    while pos + 4 <= len(body):
+        code, length = struct.unpack(endian + "HH", body[pos : pos + 4])
+        if code == 0:
+            break
+        if code == PCAPNG_IF_TSRESOL and length >= 1:
+            value = body[pos + 4]
+            if value & 0x80:
+                resolution = 2 ** -(value & 0x7F)
+            else:
+                resolution = 10 ** -value
+        pos += 4 + ((length + 3) & ~3)
+    return linktype, resolution
+
+
+def scan_chunks(f, chunk_size):
+    # Splits a capture into byte ranges of roughly chunk_size that start on a
+    # record boundary. Only record headers are read, packet data is skipped.
+    size = os.fstat(f.fileno()).st_size
+    state, offset = read_header(f)
+    chunks = []
+    chunk_start = offset
+    chunk_state = state.copy()
+    while True:
+        if offset - chunk_start >= chunk_size:
+            chunks.append((chunk_start, offset, chunk_state))
+            chunk_start = offset
+            chunk_state = state.copy()
+        block_len = _skip_block(f, state)
+        # Seeking past the end succeeds, so make sure the record is complete
+        if block_len is None or offset + block_len > size:
+            break
+        offset += block_len
+    if offset > chunk_start:
+        chunks.append((chunk_start, offset, chunk_state))
+    return chunks
+
+
+def _skip_block(f, state):
+    if state.format == "pcap":
+        header = f.read(PCAP_RECORD_HEADER_LEN)
+        if len(header) < PCAP_RECORD_HEADER_LEN:
+            return None
+        incl_len = struct.unpack(state.endian + "I", header[8:12])[0]
+        f.seek(incl_len, 1)
+        return PCAP_RECORD_HEADER_LEN + incl_len
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    block_type, block_len = struct.unpack(state.endian + "II", header)
+    if block_type == PCAPNG_SHB:
+        return _read_section_header(f, state, header)
+    if block_len < 12:
+        return None
+    if block_type == PCAPNG_IDB:
+        body = f.read(block_len - 8)
+        if len(body) < block_len - 8:
+            return None
+        state.interfaces.append(_parse_idb(body[:-4], state.endian))
+    else:
+        f.seek(block_len - 8, 1)
+    return block_len
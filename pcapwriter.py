@@ -0,0 +1,69 @@
+import struct
+from pcapreader import PCAPNG_SHB, PCAPNG_IDB, PCAPNG_EPB, PCAPNG_BYTE_ORDER_MAGIC
+from packets import LINKTYPE_ETHERNET
+
+PCAP_SNAPLEN = 262144
+
+
+class PcapWriter:
+    # Writes records to a classic pcap stream, which has a single link type
+    # for all of them
+
+    def __init__(self, f, linktype=LINKTYPE_ETHERNET):
+        self.f = f
+        self.linktype = linktype
+        # Little endian, version 2.4, microsecond timestamps
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, PCAP_SNAPLEN, linktype))
+
+    def write(self, record):
+        if record.linktype != self.linktype:
+            raise ValueError(f"Can't write link type {record.linktype} to this pcap")
+        timestamp = int(round(record.timestamp * 1e6))
+        data = record.data
+        self.f.write(
+            struct.pack(
+                "<IIII", timestamp // 1000000, timestamp % 1000000, len(data), len(data)
+            )
+        )
+        self.f.write(data)
+
+
+class PcapngWriter:
+    # Writes records to a pcapng stream. Records can come from captures with
+    # different link types, an interface is declared for each one seen.
+
+    def __init__(self, f):
+        self.f = f
+        self.interfaces = {}
+        # Version 1.0, section length unknown
+        header = struct.pack("<IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+        self._block(PCAPNG_SHB, header)
+
+    def write(self, record):
+        interface = self.interfaces.get(record.linktype)
+        if interface is None:
+            interface = len(self.interfaces)
+            self.interfaces[record.linktype] = interface
+            # Default microsecond resolution, snap length unlimited
+            self._block(PCAPNG_IDB, struct.pack("<HHI", record.linktype, 0, 0))
+        timestamp = int(round(record.timestamp * 1e6))
+        data = record.data
+        self._block(
+            PCAPNG_EPB,
+            struct.pack(
+                "<IIIII",
+                interface,
+                timestamp >> 32,
+                timestamp & 0xFFFFFFFF,
+                len(data),
+                len(data),
+            )
+            + bytes(data),
+        )
+
+    def _block(self, block_type, body):
+        padding = -len(body) % 4
+        block_len = 12 + len(body) + padding
+        self.f.write(struct.pack("<II", block_type, block_len))
+        self.f.write(body)
+        self.f.write(b"\x00" * padding + struct.pack("<I", block_len))
@@ -0,0 +1,177 @@
+import os
+import threading
+from collections import OrderedDict
+from bpf import SSL_FILTER, compile_filter, run_filter, normalize_filter
+from packets import (
+    LINKTYPE_ETHERNET,
+    LINKTYPE_RAW,
+    LINKTYPE_IPV4,
+    LINKTYPE_IPV6,
+    LINKTYPE_NULL,
+    LINKTYPE_LOOP,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+    DLT_RAW_ALIASES,
+    IPPROTO_TCP,
+    decode_tcp,
+)
+from pcapwriter import PcapngWriter
+from tlsparser import is_handshake_record, get_handshake_length
+
+# Directions waiting for the rest of a hello split over several segments
+MAX_CONTINUATIONS = 10000
+
+# Where the IP header starts, and where the ethertype is if there is one
+LINK_LAYOUTS = {
+    LINKTYPE_ETHERNET: (14, 12),
+    LINKTYPE_LINUX_SLL: (16, 14),
+    LINKTYPE_LINUX_SLL2: (20, 0),
+    LINKTYPE_NULL: (4, None),
+    LINKTYPE_LOOP: (4, None),
+    LINKTYPE_RAW: (0, None),
+    LINKTYPE_IPV4: (0, None),
+    LINKTYPE_IPV6: (0, None),
+}
+for _linktype in DLT_RAW_ALIASES:
+    LINK_LAYOUTS[_linktype] = (0, None)
+
+
+def ssl_filter_match(linktype, data):
+    # ssl_filter.bpf evaluated directly: the TCP payload starts with 0x16.
+    # Unlike libpcap's tcp[] this also looks at IPv6 without extension headers.
+    layout = LINK_LAYOUTS.get(linktype)
+    if layout is None:
+        return False
+    ip, ethertype = layout
+    if ethertype is not None and data[ethertype : ethertype + 2] not in (
+        b"\x08\x00",
+        b"\x86\xdd",
+    ):
+        return False
+    if len(data) <= ip:
+        return False
+    version = data[ip] >> 4
+    if version == 4:
+        if len(data) < ip + 20 or data[ip + 9] != IPPROTO_TCP:
+            return False
+        # Later fragments don't carry the TCP header
+        if (data[ip + 6] & 0x1F) or data[ip + 7]:
+            return False
+        tcp = ip + (data[ip] & 0x0F) * 4
+    elif version == 6:
+        if len(data) < ip + 40 or data[ip + 6] != IPPROTO_TCP:
+            return False
+        tcp = ip + 40
+    else:
+        return False
+    if len(data) < tcp + 13:
+        return False
+    payload = tcp + ((data[tcp + 12] & 0xF0) >> 2)
+    return len(data) > payload and data[payload] == 0x16
+
+
+# Programs compiled by tcpdump, by (expression, linktype), so a process that
+# prefilters many captures, e.g. a service worker, compiles each just once
+_programs = {}
+
+
+class Prefilter:
+    # Drops records that don't pass the capture filter before anything else
+    # looks at them, the built-in equivalent of running the capture through
+    # tcpdump with ssl_filter.bpf first. Other expressions are compiled with
+    # tcpdump and interpreted, which is a lot slower.
+    #
+    # Segments carrying the rest of a hello that doesn't fit in the first one
+    # are kept too, so it can be put back together.
+
+    def __init__(self, expression=SSL_FILTER):
+        self.expression = expression
+        self.kept = 0
+        self.dropped = 0
+        # (src, sport, dst, dport) -> bytes of the hello still to come
+        self._continuations = OrderedDict()
+        if normalize_filter(expression) == normalize_filter(SSL_FILTER):
+            self.match = ssl_filter_match
+        else:
+            self.match = self._match_program
+
+    def _match_program(self, linktype, data):
+        program = _programs.get((self.expression, linktype))
+        if program is None:
+            program = compile_filter(self.expression, linktype)
+            _programs[(self.expression, linktype)] = program
+        return run_filter(program, data) > 0
+
+    def filter(self, records, count=True):
+        match = self.match
+        continuations = self._continuations
+        for record in records:
+            if match(record.linktype, record.data):
+                self._matched(record)
+            elif not continuations or not self._continues(record):
+                if count:
+                    self.dropped += 1
+                continue
+            if count:
+                self.kept += 1
+            yield record
+
+    def _matched(self, record):
+        segment = decode_tcp(record.linktype, record.data)
+        if segment is None:
+            return
+        payload = segment.payload
+        key = (segment.src, segment.sport, segment.dst, segment.dport)
+        continuations = self._continuations
+        if key in continuations:
+            self._continues(record, segment)
+        elif is_handshake_record(payload):
+            remaining = get_handshake_length(payload) - len(payload)
+            if remaining > 0:
+                continuations[key] = remaining
+                if len(continuations) > MAX_CONTINUATIONS:
+                    continuations.popitem(last=False)
+
+    def _continues(self, record, segment=None):
+        if segment is None:
+            segment = decode_tcp(record.linktype, record.data)
+            if segment is None or not segment.payload:
+                return False
+        continuations = self._continuations
+        key = (segment.src, segment.sport, segment.dst, segment.dport)
+        remaining = continuations.get(key)
+        if remaining is None:
+            # The peer answering means the hello is complete
+            reverse = (segment.dst, segment.dport, segment.src, segment.sport)
+            continuations.pop(reverse, None)
+            return False
+        remaining -= len(segment.payload)
+        if remaining > 0:
+            continuations[key] = remaining
+        else:
+            del continuations[key]
+        return True
+
+    def summary(self):
+        total = self.kept + self.dropped
+        return f"Prefilter kept {self.kept} of {total} packets ({self.dropped} dropped)"
+
+
+def open_prefiltered_pipe(records, prefilter):
+    # Streams the records that pass the prefilter as pcapng into a pipe, for
+    # tshark to read from stdin without an intermediate file
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        try:
+            with os.fdopen(write_fd, "wb") as f:
+                writer = PcapngWriter(f)
+                for record in prefilter.filter(records):
+                    writer.write(record)
+        except BrokenPipeError:
+            # tshark went away, it reports why itself
+            pass
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return read_fd, thread
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from tlsparser import is_handshake_record, get_handshake_message
+
+DEFAULT_MAX_FLOW_BYTES = 16 * 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TIMEOUT = 60.0
+
+
+class _Buffer:
+    __slots__ = (
+        "segment",
+        "offset",
+        "timestamp",
+        "next_seq",
+        "data",
+        "out_of_order",
+        "size",
+        "last_seen",
+    )
+
+    def __init__(self, segment, offset, timestamp, next_seq, data):
+        # The first segment, for its addresses, and the offset and timestamp of
+        # its record, which the hello is reported with
+        self.segment = segment
+        self.offset = offset
+        self.timestamp = timestamp
+        self.next_seq = next_seq
+        self.data = bytearray(data)
+        self.out_of_order = {}
+        # Bytes held, in order or not
+        self.size = len(data)
+        self.last_seen = timestamp
+
+
+class HandshakeReassembler:
+    # Puts hellos that span several TCP segments back together. Only a
+    # direction whose payload starts a handshake record that doesn't fit in
+    # the segment is buffered, and only up to max_flow_bytes of it, after
+    # which what was collected is handed over as is. Buffers are dropped
+    # oldest first past max_bytes in total, or after `timeout` seconds of
+    # capture time without a segment, and counted in evicted. Segments that
+    # show up before the start of their hello can't be told from any other
+    # data and are lost, the hello is then only handed over as far as it got
+    # once the peer answers, which is counted in taken.
+    #
+    # Keys are (stream, source address, source port), one per direction.
+
+    def __init__(
+        self,
+        max_flow_bytes=DEFAULT_MAX_FLOW_BYTES,
+        max_bytes=DEFAULT_MAX_BYTES,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        self.max_flow_bytes = max_flow_bytes
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.flows = OrderedDict()
+        self.size = 0
+        self.reassembled = 0
+        self.overflowed = 0
+        self.taken = 0
+        self.evicted = 0
+
+    def feed(self, key, segment, timestamp=None, offset=None):
+        # Returns the payload to look for a hello in, the segment's own or a
+        # reassembled one, with the offset and timestamp of the record it
+        # started in, or None while a hello is still being collected
+        if self.flows and timestamp is not None:
+            self.expire(timestamp)
+        payload = segment.payload
+        buffer = self.flows.get(key)
+        if buffer is None:
+            if not is_handshake_record(payload):
+                return offset, timestamp, payload
+            if get_handshake_message(payload) is not None:
+                return offset, timestamp, payload
+            if len(payload) >= self.max_flow_bytes:
+                self.overflowed += 1
+                return offset, timestamp, payload
+            next_seq = (segment.seq + len(payload)) & 0xFFFFFFFF
+            first = segment._replace(payload=b"")
+            self.flows[key] = _Buffer(first, offset, timestamp, next_seq, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.flows)))
+                self.evicted += 1
+            return None
+        self.flows.move_to_end(key)
+        buffer.last_seen = timestamp
+        if payload and self._add(buffer, segment.seq, payload):
+            message = get_handshake_message(buffer.data)
+            if message is not None:
+                self._drop(key)
+                self.reassembled += 1
+                return buffer.offset, buffer.timestamp, message
+        if buffer.size >= self.max_flow_bytes:
+            self._drop(key)
+            self.overflowed += 1
+            return buffer.offset, buffer.timestamp, bytes(buffer.data)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.flows)))
+            self.evicted += 1
+        return None
+
+    def take(self, key):
+        # Gives up on a buffered hello and returns its first segment, the
+        # offset and timestamp of its record and what there is of it, e.g.
+        # once the peer answers, which means the hello is complete and the
+        # missing segments weren't captured
+        buffer = self.flows.get(key)
+        if buffer is None:
+            return None
+        self._drop(key)
+        self.taken += 1
+        return buffer.segment, buffer.offset, buffer.timestamp, bytes(buffer.data)
+
+    def _add(self, buffer, seq, payload):
+        # Returns whether the in order data grew. Sequence numbers wrap, so
+        # they are compared as distances from next_seq.
+        ahead = (seq - buffer.next_seq) & 0xFFFFFFFF
+        if ahead >= 0x80000000:
+            # Retransmission of bytes we have, maybe with some new ones
+            payload = payload[(buffer.next_seq - seq) & 0xFFFFFFFF :]
+            if not payload:
+                return False
+        elif ahead:
+            if seq not in buffer.out_of_order:
+                # The payload may be a view of the capture
+                buffer.out_of_order[seq] = bytes(payload)
+                buffer.size += len(payload)
+                self.size += len(payload)
+            return False
+        self._append(buffer, payload)
+        while buffer.next_seq in buffer.out_of_order:
+            payload = buffer.out_of_order.pop(buffer.next_seq)
+            buffer.size -= len(payload)
+            self.size -= len(payload)
+            self._append(buffer, payload)
+        return True
+
+    def _append(self, buffer, payload):
+        buffer.data += payload
+        buffer.next_seq = (buffer.next_seq + len(payload)) & 0xFFFFFFFF
+        buffer.size += len(payload)
+        self.size += len(payload)
+
+    def expire(self, timestamp):
+        if self.timeout is None:
+            return
+        cutoff = timestamp - self.timeout
+        while self.flows:
+            buffer = next(iter(self.flows.values()))
+            if buffer.last_seen is None or buffer.last_seen >= cutoff:
+                return
+            self._drop(next(iter(self.flows)))
+            self.evicted += 1
+
+    def _drop(self, key):
+        self.size -= self.flows.pop(key).size
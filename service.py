@@ -0,0 +1,551 @@
+import http.server
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
+from parallel import expand_captures
+from pcapreader import check_capture
+from prefilter import Prefilter
+from sessions import iter_sessions
+from summary import SessionSummary
+from writers import open_writer, WRITERS, pyarrow
+
+DEFAULT_PORT = 8750
+DEFAULT_QUEUE_SIZE = 100
+# Finished jobs kept around for status requests, the oldest are forgotten
+MAX_FINISHED_JOBS = 1000
+# Seconds clients are told to wait when the queue is full
+RETRY_AFTER = 5
+
+# What a worker needs to analyze a capture, options shared by every job of a
+# service come from its settings
+JobTask = namedtuple(
+    "JobTask",
+    [
+        "capture",
+        "output",
+        "format",
+        "fields",
+        "writer_options",
+        "session_options",
+        "prefilter",
+        "top",
+    ],
+)
+ServiceSettings = namedtuple(
+    "ServiceSettings",
+    [
+        "format",
+        "fields",
+        "writer_options",
+        "session_options",
+        "prefilter",
+        "top",
+        "report_dir",
+    ],
+)
+
+
+def _block_interrupts():
+    # Ctrl-C reaches the whole process group. Only the service handles it, by
+    # letting the running jobs finish, so workers must not die of it. Workers
+    # are started by the thread submitting jobs and inherit its signal mask,
+    # which works before Python 3.7 and its pool initializers too.
+    if hasattr(signal, "pthread_sigmask"):
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+
+
+def run_job(task):
+    # Runs in a worker process. Workers outlive jobs, so imports, name tables
+    # and compiled filters are only paid for once per worker. Everything a job
+    # changes is its own, several run at once without sharing anything.
+    started = time.monotonic()
+    prefilter = Prefilter(task.prefilter) if task.prefilter else None
+    summary = SessionSummary(task.top)
+    writer_options = task.writer_options
+    if task.format != "parquet":
+        writer_options = dict(writer_options)
+        writer_options.pop("row_group_size", None)
+    # The report only takes the place of the output once it is complete, a
+    # failed job leaves nothing behind
+    partial = _create_partial(task.output)
+    try:
+        with open_writer(partial, task.format, task.fields, **writer_options) as writer:
+            sessions = iter_sessions(
+                task.capture, prefilter=prefilter, **task.session_options
+            )
+            for session in sessions:
+                writer.write(session)
+                summary.add(session)
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, task.output)
+    result = {
+        "sessions": summary.sessions,
+        "seconds": round(time.monotonic() - started, 3),
+        "summary": summary.to_dict(),
+    }
+    if prefilter is not None:
+        result["prefilter"] = {"kept": prefilter.kept, "dropped": prefilter.dropped}
+    return result
+
+
+def _create_partial(output):
+    # A new hidden file next to the output, with the permissions of any other
+    # file unlike tempfile's
+    directory, name = os.path.split(output)
+    while True:
+        partial = os.path.join(directory, f".{name}.{os.urandom(4).hex()}.partial")
+        try:
+            os.close(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        except FileExistsError:
+            continue
+        return partial
+
+
+class Job:
+    __slots__ = (
+        "id",
+        "capture",
+        "output",
+        "format",
+        "source",
+        "state",
+        "submitted",
+        "started",
+        "finished",
+        "result",
+        "error",
+        "on_finished",
+    )
+
+    def __init__(self, job_id, capture, output, output_format, source, on_finished):
+        self.id = job_id
+        self.capture = capture
+        self.output = output
+        self.format = output_format
+        self.source = source
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.on_finished = on_finished
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "capture": self.capture,
+            "output": self.output,
+            "format": self.format,
+            "source": self.source,
+            "state": self.state,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class AnalysisService:
+    # Analyzes captures submitted over HTTP or dropped in a spool directory on
+    # a pool of worker processes. At most `workers` jobs run at once and at
+    # most `queue_size` wait, submitting more raises queue.Full until there is
+    # room again, which HTTP clients get as a 503. on_finished is called with
+    # every job that is over.
+
+    def __init__(
+        self, settings, workers=1, queue_size=DEFAULT_QUEUE_SIZE, on_finished=None
+    ):
+        self.settings = settings
+        self.workers = workers
+        self.on_finished = on_finished
+        self.executor = self._new_executor()
+        self.queue = queue.Queue(queue_size)
+        self.slots = threading.Semaphore(workers)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # Reports being written by queued or running jobs, and the real paths
+        # of those written, which later jobs may replace
+        self.outputs = set()
+        self.written = set()
+        self.sessions = 0
+        self.started = time.time()
+        self.stopping = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self.workers)
+
+    def submit(
+        self, capture, output=None, output_format=None, source="http", on_finished=None
+    ):
+        # Queues a capture and returns its Job. Raises ValueError for jobs that
+        # can't run, and queue.Full when too many are waiting.
+        if self.stopping.is_set():
+            raise ValueError("The service is shutting down")
+        if not isinstance(capture, str) or not os.path.isfile(capture):
+            raise ValueError(f"No such capture: {capture}")
+        try:
+            check_capture(capture)
+        except OSError as e:
+            raise ValueError(f"Can't read {capture}: {e.strerror or e}")
+        except ValueError as e:
+            raise ValueError(f"Can't analyze {capture}: {e}")
+        output_format = output_format or self.settings.format
+        if output_format not in WRITERS:
+            raise ValueError(f"Unknown format {output_format}")
+        if output_format == "parquet" and pyarrow is None:
+            raise ValueError("Parquet reports require pyarrow")
+        capture = os.path.abspath(capture)
+        output = self._get_output(capture, output, output_format)
+        with self.lock:
+            if output in self.outputs:
+                raise ValueError(f"{output} is already being written by another job")
+            if os.path.lexists(output) and os.path.realpath(output) not in self.written:
+                raise ValueError(f"{output} already exists")
+            job = Job(
+                self.next_id, capture, output, output_format, source, on_finished
+            )
+            # Raises queue.Full before anything is recorded
+            self.queue.put_nowait(job)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.outputs.add(output)
+        return job
+
+    def _get_output(self, capture, output, output_format):
+        # Reports only go to the report directory, or next to the capture
+        # without one, so clients can't have any file overwritten. output is
+        # relative to that directory. Reports never replace the capture, nor
+        # any file but those written by earlier jobs, see submit.
+        directory = os.path.abspath(
+            self.settings.report_dir or os.path.dirname(capture)
+        )
+        if output is None:
+            name, _ = os.path.splitext(os.path.basename(capture))
+            output = f"{name}.{output_format}"
+        elif not isinstance(output, str) or os.path.isabs(output):
+            raise ValueError(f"Expected an output path relative to {directory}")
+        output = os.path.join(directory, output)
+        real_directory = os.path.realpath(directory)
+        real_output = os.path.realpath(output)
+        if (
+            os.path.commonpath([real_directory, real_output]) != real_directory
+            or real_output == real_directory
+        ):
+            raise ValueError(f"Output paths must be inside {directory}")
+        if real_output == os.path.realpath(capture):
+            raise ValueError("The report can't replace the capture")
+        return os.path.normpath(output)
+
+    def _dispatch(self):
+        # Hands queued jobs to the pool as workers become free, so waiting
+        # jobs stay in the queue, where they count against its size
+        _block_interrupts()
+        while not self.stopping.is_set():
+            if not self.slots.acquire(timeout=0.5):
+                continue
+            job = None
+            while job is None and not self.stopping.is_set():
+                try:
+                    job = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    pass
+            if job is None:
+                self.slots.release()
+                return
+            self._start(job)
+
+    def _start(self, job):
+        settings = self.settings
+        task = JobTask(
+            job.capture,
+            job.output,
+            job.format,
+            settings.fields,
+            settings.writer_options,
+            settings.session_options,
+            settings.prefilter,
+            settings.top,
+        )
+        with self.lock:
+            job.state = "running"
+            job.started = time.time()
+        try:
+            future = self.executor.submit(run_job, task)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for running out of memory, which
+            # takes the whole pool with it
+            self.executor = self._new_executor()
+            future = self.executor.submit(run_job, task)
+        except RuntimeError as e:
+            # The pool was shut down in the meantime
+            self._finish(job, None, e)
+            return
+        future.add_done_callback(lambda future: self._finished(job, future))
+
+    def _finished(self, job, future):
+        error = future.exception()
+        self._finish(job, None if error else future.result(), error)
+
+    def _finish(self, job, result, error):
+        with self.lock:
+            job.finished = time.time()
+            if error is None:
+                job.state = "done"
+                job.result = result
+                self.sessions += result["sessions"]
+                self.written.add(os.path.realpath(job.output))
+            else:
+                job.state = "failed"
+                job.error = str(error) or type(error).__name__
+            self.outputs.discard(job.output)
+            self._forget_finished()
+        self.slots.release()
+        if job.on_finished is not None:
+            job.on_finished(job)
+        if self.on_finished is not None:
+            self.on_finished(job)
+
+    def _forget_finished(self):
+        finished = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.state in ("done", "failed")
+        ]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def status(self):
+        with self.lock:
+            states = dict.fromkeys(("queued", "running", "done", "failed"), 0)
+            for job in self.jobs.values():
+                states[job.state] += 1
+            return {
+                "state": "stopping" if self.stopping.is_set() else "running",
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "workers": self.workers,
+                "queue_size": self.queue.maxsize,
+                "jobs": states,
+                "sessions": self.sessions,
+            }
+
+    def close(self):
+        # Waits for the running jobs, queued ones are dropped
+        self.stopping.set()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        dropped = 0
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return dropped
+            dropped += 1
+
+
+class SpoolWatcher:
+    # Queues the captures that show up in a directory once they stopped
+    # growing between two polls, and moves them to done/ or failed/ next to
+    # their report when their job is over. When the queue is full, captures
+    # wait in the directory.
+
+    def __init__(self, service, directory, poll_interval=5.0):
+        self.service = service
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.done = os.path.join(directory, "done")
+        self.failed = os.path.join(directory, "failed")
+        os.makedirs(self.done, exist_ok=True)
+        os.makedirs(self.failed, exist_ok=True)
+        # Size and mtime of captures when last seen
+        self.seen = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def poll(self):
+        for path in expand_captures([self.directory]):
+            path = os.path.abspath(path)
+            with self.lock:
+                if path in self.pending:
+                    continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.seen.get(path) != signature:
+                # New, or still being written
+                self.seen[path] = signature
+                continue
+            output = None
+            if self.service.settings.report_dir is None:
+                # Relative to the spool directory, where the capture is
+                name, _ = os.path.splitext(os.path.basename(path))
+                output = os.path.join("done", f"{name}.{self.service.settings.format}")
+            with self.lock:
+                try:
+                    self.service.submit(
+                        path, output, source="spool", on_finished=self._finished
+                    )
+                except queue.Full:
+                    return
+                except ValueError as e:
+                    if self.service.stopping.is_set():
+                        return
+                    # Otherwise it would be skipped again on every poll
+                    print(f"Skipping {path}: {e}")
+                    self._move(path, self.failed)
+                    del self.seen[path]
+                    continue
+                self.pending.add(path)
+            del self.seen[path]
+
+    def _finished(self, job):
+        self._move(job.capture, self.done if job.state == "done" else self.failed)
+        with self.lock:
+            self.pending.discard(job.capture)
+
+    def _move(self, path, directory):
+        try:
+            os.replace(path, os.path.join(directory, os.path.basename(path)))
+        except OSError as e:
+            print(f"Couldn't move {path}: {e}")
+
+    def run(self, stopping):
+        while not stopping.is_set():
+            self.poll()
+            stopping.wait(self.poll_interval)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # GET /status, GET /jobs, GET /jobs/<id> and POST /jobs with a JSON object
+    # holding the capture path, and optionally the output path and format
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlsplit(self.path).path.rstrip("/")
+        if path in ("", "/status"):
+            self._send(200, service.status())
+        elif path == "/jobs":
+            self._send(200, service.list_jobs())
+        elif path.startswith("/jobs/") and path[6:].isdigit():
+            job = service.get(int(path[6:]))
+            if job is None:
+                self._send(404, {"error": "No such job"})
+            else:
+                self._send(200, job)
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != "/jobs":
+            self._send(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            job = self.server.service.submit(
+                request.get("capture"), request.get("output"), request.get("format")
+            )
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+            return
+        except queue.Full:
+            self._send(
+                503,
+                {"error": "Too many jobs waiting, try again later"},
+                {"Retry-After": str(RETRY_AFTER)},
+            )
+            return
+        self._send(202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+
+    def _send(self, code, data, headers=None):
+        body = json.dumps(data).encode() + b"\n"
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Jobs are reported as they finish instead
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def format_job(job):
+    if job.state == "done":
+        sessions = job.result["sessions"]
+        return f"Job {job.id}: {sessions} sessions from {job.capture} in {job.output}"
+    return f"Job {job.id} failed on {job.capture}: {job.error}"
+
+
+def parse_address(address):
+    # PORT or HOST:PORT, on localhost unless a host is given
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError(f"Invalid address {address}, expected [HOST:]PORT")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+def run_service(service, address=None, spool=None, poll_interval=5.0, out=print):
+    # Serves until interrupted, then waits for the running jobs
+    server = None
+    threads = []
+    if address is not None:
+        server = _Server(parse_address(address), _Handler)
+        server.service = service
+        threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+        host, port = server.server_address[:2]
+        out(f"Serving job status on http://{host}:{port}/status")
+    if spool is not None:
+        watcher = SpoolWatcher(service, spool, poll_interval)
+        threads.append(
+            threading.Thread(target=watcher.run, args=(service.stopping,), daemon=True)
+        )
+        out(f"Watching {spool} for captures")
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out("Waiting for running jobs to finish...")
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        dropped = service.close()
+        if dropped:
+            out(f"Dropped {dropped} queued jobs")
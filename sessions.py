@@ -0,0 +1,404 @@
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from pcapreader import Record, iter_records, open_capture, BUFFER_TYPES
+from packets import StreamTracker, format_ip, LINKTYPE_ETHERNET
+from tlsparser import (
+    format_hello,
+    get_server_name,
+    get_alpn,
+    get_supported_versions,
+    get_negotiated_version,
+    get_ja3,
+    get_ja3s,
+    is_grease,
+    tls_version_name,
+    cipher_suite_name,
+)
+from pairing import HandshakePairer
+from native import iter_pairs
+from prefilter import Prefilter, open_prefiltered_pipe
+from reassembly import HandshakeReassembler, DEFAULT_MAX_FLOW_BYTES, DEFAULT_MAX_BYTES
+from writers import truncate_hello_text
+
+try:
+    import pyshark
+except ImportError:
+    # pyshark is only needed for the tshark backend
+    pyshark = None
+
+DEFAULT_FLOW_TIMEOUT = 300.0
+DEFAULT_MAX_FLOWS = 100000
+
+# Everything known about a session. The hello text is None unless asked for,
+# the ids are the numbers behind the negotiated version and cipher suite.
+Session = namedtuple(
+    "Session",
+    [
+        "capture_file",
+        "tcp_stream_id",
+        "timestamp",
+        "client_ip",
+        "client_port",
+        "server_ip",
+        "server_port",
+        "server_name",
+        "negotiated_tls_version",
+        "negotiated_cipher_suite",
+        "negotiated_alpn",
+        "handshake_rtt_ms",
+        "offered_tls_versions",
+        "offered_cipher_suites",
+        "offered_alpn",
+        "ja3",
+        "ja3s",
+        "client_hello",
+        "server_hello",
+        "negotiated_tls_version_id",
+        "negotiated_cipher_suite_id",
+    ],
+)
+
+
+def iter_sessions(
+    source,
+    name=None,
+    backend="native",
+    linktype=LINKTYPE_ETHERNET,
+    prefilter=None,
+    flow_timeout=DEFAULT_FLOW_TIMEOUT,
+    max_flows=DEFAULT_MAX_FLOWS,
+    max_hello_bytes=DEFAULT_MAX_FLOW_BYTES,
+    reassembly_bytes=DEFAULT_MAX_BYTES,
+    hello_text_limit=0,
+    stats=None,
+):
+    # Lazily yields a Session for every handshake in source, which is the
+    # path of a pcap or pcapng capture, maybe gzipped, a binary file object or
+    # buffer holding one, or an iterable of packets: Records or (timestamp,
+    # frame) tuples of the given linktype. name is reported as capture_file,
+    # by default the path. prefilter is a Prefilter, a BPF expression or True
+    # for the bundled one. hello_text_limit is 0 to leave out the hello text,
+    # None for all of it, or how many characters to keep. Files opened here
+    # are closed once the sessions run out or the generator is closed.
+    if backend not in ("native", "pyshark"):
+        raise ValueError(f"Unknown backend {backend}")
+    if backend == "pyshark" and pyshark is None:
+        raise ValueError("The pyshark backend requires pyshark")
+    if name is None and _is_path(source):
+        name = os.fspath(source)
+    if prefilter is True:
+        prefilter = Prefilter()
+    elif isinstance(prefilter, str):
+        prefilter = Prefilter(prefilter)
+    pairer = HandshakePairer(flow_timeout, max_flows)
+    if backend == "pyshark":
+        if prefilter is None and not _is_path(source):
+            raise ValueError("pyshark reads captures from a path unless prefiltered")
+        sessions = _iter_pyshark_sessions(
+            source, name, linktype, pairer, prefilter, hello_text_limit, stats
+        )
+    else:
+        reassembler = HandshakeReassembler(max_hello_bytes, reassembly_bytes)
+        sessions = _iter_native_sessions(
+            source,
+            name,
+            linktype,
+            pairer,
+            prefilter,
+            reassembler,
+            hello_text_limit,
+            stats,
+        )
+    if stats is not None:
+        sessions = stats.extract(sessions, "pair")
+    return sessions
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+@contextmanager
+def open_records(source, linktype=LINKTYPE_ETHERNET):
+    # The capture records of any source iter_sessions takes. Only files opened
+    # here are closed on the way out.
+    if _is_path(source):
+        with open_capture(source) as capture:
+            yield iter_records(capture)
+    elif isinstance(source, BUFFER_TYPES) or hasattr(source, "read"):
+        # Records of buffers are slices of them
+        yield iter_records(source)
+    else:
+        yield _iter_packet_records(source, linktype)
+
+
+def _iter_packet_records(packets, linktype):
+    for packet in packets:
+        if isinstance(packet, Record):
+            yield packet
+        else:
+            timestamp, data = packet
+            yield Record(None, timestamp, linktype, data)
+
+
+def _iter_native_sessions(
+    source, name, linktype, pairer, prefilter, reassembler, hello_text_limit, stats
+):
+    with open_records(source, linktype) as records:
+        pairs = iter_pairs(
+            records, StreamTracker(), reassembler, pairer, prefilter, stats
+        )
+        try:
+            for client_hello, server_hello in pairs:
+                yield get_native_session(
+                    name, client_hello, server_hello, hello_text_limit
+                )
+        finally:
+            # Lets go of the last records, so a memory mapped capture can be
+            # unmapped right away
+            pairs.close()
+    if stats is not None:
+        stats.add_capture(pairer, reassembler)
+
+
+def _iter_pyshark_sessions(
+    source, name, linktype, pairer, prefilter, hello_text_limit, stats
+):
+    if prefilter is not None:
+        streams = get_prefiltered_ssl_streams(
+            source, linktype, pairer, prefilter, stats
+        )
+    else:
+        cap = pyshark.FileCapture(source, display_filter="ssl")
+        streams = get_ssl_streams(cap, pairer, stats)
+    if stats is not None:
+        # Mostly get_field lookups
+        streams = stats.pair(streams, "dissect")
+    try:
+        for client_hello_pkt, server_hello_pkt in streams:
+            yield get_session(
+                name, client_hello_pkt, server_hello_pkt, hello_text_limit
+            )
+    finally:
+        if prefilter is None:
+            # Fix for asyncio bug with pyshark
+            cap.close()
+        else:
+            streams.close()
+    if stats is not None:
+        stats.add_capture(pairer)
+
+
+def get_ssl_streams(cap, pairer=None, stats=None):
+    if pairer is None:
+        pairer = HandshakePairer()
+    if stats is not None:
+        # tshark dissecting and pyshark building packets from its output
+        cap = stats.stage("dissect", cap)
+    for pkt in cap:
+        # try it for SSL packets
+        # try:
+        #     if (
+        #         pkt.highest_layer == "SSL"
+        #         and pkt.ssl.get_field("handshake") is not None
+        #     ) and (
+        #         "Client Hello" in pkt.ssl.get_field("handshake")
+        #         or "Server Hello" in pkt.ssl.get_field("handshake")
+        #     ):
+        #         ssl_handshake_packets.append(pkt)
+        # except Exception:
+        #     print("No SSL higher layers found")
+
+        # try it for TLS packets
+        if pkt.highest_layer != "TLS":
+            continue
+        handshake = pkt.tls.get_field("handshake")
+        if handshake is None:
+            continue
+        stream = int(pkt.tcp.stream)
+        ident = pkt.tls.get_field("handshake_random")
+        timestamp = float(pkt.sniff_timestamp)
+        if "Client Hello" in handshake:
+            if stats is not None:
+                stats.counters["client_hellos"] += 1
+            pairer.client_hello(stream, pkt, ident, timestamp)
+        elif "Server Hello" in handshake:
+            if stats is not None:
+                stats.counters["server_hellos"] += 1
+            pair = pairer.server_hello(stream, pkt, ident, timestamp)
+            if pair is not None:
+                yield pair
+
+
+def get_prefiltered_ssl_streams(
+    source, linktype=LINKTYPE_ETHERNET, pairer=None, prefilter=None, stats=None
+):
+    # Same as running the capture through tcpdump with the prefilter before
+    # handing it to pyshark, but streamed through a pipe
+    if prefilter is None:
+        prefilter = Prefilter()
+    with open_records(source, linktype) as records:
+        read_fd, feeder = open_prefiltered_pipe(records, prefilter)
+        with os.fdopen(read_fd, "rb") as pipe:
+            cap = pyshark.PipeCapture(pipe, display_filter="ssl")
+            try:
+                yield from get_ssl_streams(cap, pairer, stats)
+            finally:
+                # Fix for asyncio bug with pyshark
+                cap.close()
+        feeder.join()
+
+
+def get_handshake_field(pkt, field):
+    # tshark calls the layer ssl in versions before 3.0
+    for layer_name in ("tls", "ssl"):
+        layer = getattr(pkt, layer_name, None)
+        value = layer.get_field(field) if layer is not None else None
+        if value is not None:
+            return value
+    return None
+
+
+def get_handshake_values(pkt, field):
+    # Every occurrence of a field, e.g. each offered cipher suite
+    value = get_handshake_field(pkt, field)
+    if value is None:
+        return []
+    return [str(occurrence.show) for occurrence in value.all_fields]
+
+
+def get_handshake_id(pkt, field):
+    # Values are decimal or hex depending on the field, e.g. 0x00000303 for
+    # the version
+    value = get_handshake_field(pkt, field)
+    return int(str(value), 0) & 0xFFFF if value is not None else None
+
+
+def get_handshake_ids(pkt, field):
+    ids = (int(value, 0) & 0xFFFF for value in get_handshake_values(pkt, field))
+    return [value for value in ids if not is_grease(value)]
+
+
+def get_source_address(pkt):
+    ip = getattr(pkt, "ip", None) or getattr(pkt, "ipv6", None)
+    return str(ip.src) if ip is not None else None
+
+
+def get_negotiated_tls_version_id(pkt):
+    # TLS 1.3 is only told apart from 1.2 by supported_versions
+    version = get_handshake_id(pkt, "handshake_extensions_supported_version")
+    if version is None:
+        version = get_handshake_id(pkt, "handshake_version")
+    return version
+
+
+def get_negotiated_tls_version(pkt):
+    version = get_negotiated_tls_version_id(pkt)
+    return tls_version_name(version) if version is not None else "Unknown"
+
+
+def get_negotiated_cipher_suite(pkt):
+    cipher_suite = get_handshake_id(pkt, "handshake_ciphersuite")
+    return cipher_suite_name(cipher_suite) if cipher_suite is not None else "Unknown"
+
+
+def get_native_tls_version(hello):
+    return tls_version_name(get_negotiated_version(hello))
+
+
+def get_native_cipher_suite(hello):
+    return cipher_suite_name(hello.cipher_suite)
+
+
+def get_session(cap_file, client_hello_pkt, server_hello_pkt, hello_text_limit=0):
+    server_name = get_handshake_field(
+        client_hello_pkt, "handshake_extensions_server_name"
+    )
+    timestamp = float(client_hello_pkt.sniff_timestamp)
+    rtt = float(server_hello_pkt.sniff_timestamp) - timestamp
+    alpn = get_handshake_values(server_hello_pkt, "handshake_extensions_alpn_str")
+    # JA3 fields need tshark 4.2 or later
+    ja3 = get_handshake_field(client_hello_pkt, "handshake_ja3")
+    ja3s = get_handshake_field(server_hello_pkt, "handshake_ja3s")
+    client_text = server_text = None
+    if hello_text_limit != 0:
+        client_text = truncate_hello_text(str(client_hello_pkt.tls), hello_text_limit)
+        server_text = truncate_hello_text(str(server_hello_pkt.tls), hello_text_limit)
+    return Session(
+        capture_file=cap_file,
+        tcp_stream_id=int(client_hello_pkt.tcp.stream),
+        timestamp=round(timestamp, 6),
+        client_ip=get_source_address(client_hello_pkt),
+        client_port=int(client_hello_pkt.tcp.srcport),
+        server_ip=get_source_address(server_hello_pkt),
+        server_port=int(server_hello_pkt.tcp.srcport),
+        server_name=str(server_name) if server_name is not None else None,
+        negotiated_tls_version=get_negotiated_tls_version(server_hello_pkt),
+        negotiated_cipher_suite=get_negotiated_cipher_suite(server_hello_pkt),
+        negotiated_alpn=alpn[0] if alpn else None,
+        handshake_rtt_ms=round(rtt * 1000, 3),
+        offered_tls_versions=[
+            tls_version_name(version)
+            for version in get_handshake_ids(
+                client_hello_pkt, "handshake_extensions_supported_version"
+            )
+        ],
+        offered_cipher_suites=[
+            cipher_suite_name(cipher_suite)
+            for cipher_suite in get_handshake_ids(
+                client_hello_pkt, "handshake_ciphersuite"
+            )
+        ],
+        offered_alpn=get_handshake_values(
+            client_hello_pkt, "handshake_extensions_alpn_str"
+        ),
+        ja3=str(ja3) if ja3 is not None else None,
+        ja3s=str(ja3s) if ja3s is not None else None,
+        client_hello=client_text,
+        server_hello=server_text,
+        negotiated_tls_version_id=get_negotiated_tls_version_id(server_hello_pkt),
+        negotiated_cipher_suite_id=get_handshake_id(
+            server_hello_pkt, "handshake_ciphersuite"
+        ),
+    )
+
+
+def get_native_session(cap_file, client_hello, server_hello, hello_text_limit=0):
+    client, server = client_hello.hello, server_hello.hello
+    alpn = get_alpn(server)
+    client_text = server_text = None
+    if hello_text_limit != 0:
+        client_text = truncate_hello_text(format_hello(client), hello_text_limit)
+        server_text = truncate_hello_text(format_hello(server), hello_text_limit)
+    return Session(
+        capture_file=cap_file,
+        tcp_stream_id=client_hello.stream,
+        timestamp=round(client_hello.timestamp, 6),
+        client_ip=format_ip(client_hello.segment.src),
+        client_port=client_hello.segment.sport,
+        server_ip=format_ip(server_hello.segment.src),
+        server_port=server_hello.segment.sport,
+        server_name=get_server_name(client),
+        negotiated_tls_version=get_native_tls_version(server),
+        negotiated_cipher_suite=get_native_cipher_suite(server),
+        negotiated_alpn=alpn[0] if alpn else None,
+        handshake_rtt_ms=round(
+            (server_hello.timestamp - client_hello.timestamp) * 1000, 3
+        ),
+        offered_tls_versions=[
+            tls_version_name(version) for version in get_supported_versions(client)
+        ],
+        offered_cipher_suites=[
+            cipher_suite_name(cipher_suite)
+            for cipher_suite in client.cipher_suites
+            if not is_grease(cipher_suite)
+        ],
+        offered_alpn=get_alpn(client),
+        ja3=get_ja3(client),
+        ja3s=get_ja3s(server),
+        client_hello=client_text,
+        server_hello=server_text,
+        negotiated_tls_version_id=get_negotiated_version(server),
+        negotiated_cipher_suite_id=server.cipher_suite,
+    )
@@ -0,0 +1,249 @@
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+from tlsparser import ClientHello
+
+# Order stages are reported in. pyshark dissects in tshark and parses its
+# output in one go, parallel runs do everything up to pairing in the workers.
+STAGES = ("read", "prefilter", "dissect", "workers", "pair", "extract", "write")
+COUNTERS = (
+    "captures",
+    "packets",
+    "bytes",
+    "client_hellos",
+    "server_hellos",
+    "reassembled_hellos",
+    "partial_hellos",
+    "dropped_hellos",
+    "pairs",
+    "orphaned_client_hellos",
+    "sessions",
+)
+PROGRESS_INTERVAL = 1.0
+# Allocation sites listed by --profile-memory
+MEMORY_PROFILE_TOP = 50
+
+
+class PipelineStats:
+    # Counters and timers for the stages of a run. A stage is timed by
+    # wrapping its iterator, the time it takes to get an item out of it
+    # includes the stages it pulls from, which is taken off when reported.
+    # Nothing is wrapped without --stats, so other runs don't pay for it.
+
+    def __init__(self, progress=None):
+        # Where the progress line goes, if anywhere
+        self.progress = progress
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.inclusive = {}
+        self.upstream = {}
+        self.started = time.monotonic()
+        self._last_progress = self.started
+
+    def stage(self, name, items, upstream=None):
+        self.upstream[name] = upstream
+        return self._iter_timed(name, items)
+
+    def read(self, records):
+        self.upstream["read"] = None
+        counters = self.counters
+        for count, record in enumerate(self._iter_timed("read", records)):
+            counters["packets"] += 1
+            counters["bytes"] += len(record.data)
+            if not count & 0x3FF:
+                self.show_progress()
+            yield record
+
+    def dissect(self, handshakes, upstream):
+        self.upstream["dissect"] = upstream
+        counters = self.counters
+        for handshake in self._iter_timed("dissect", handshakes):
+            if isinstance(handshake.hello, ClientHello):
+                counters["client_hellos"] += 1
+            else:
+                counters["server_hellos"] += 1
+            yield handshake
+
+    def pair(self, pairs, upstream, name="pair"):
+        self.upstream[name] = upstream
+        counters = self.counters
+        for pair in self._iter_timed(name, pairs):
+            counters["pairs"] += 1
+            yield pair
+
+    def extract(self, rows, upstream):
+        self.upstream["extract"] = upstream
+        for row in self._iter_timed("extract", rows):
+            self.show_progress()
+            yield row
+
+    def _iter_timed(self, name, items):
+        clock = time.perf_counter
+        inclusive = self.inclusive
+        inclusive.setdefault(name, 0.0)
+        iterator = iter(items)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                inclusive[name] += clock() - start
+                return
+            inclusive[name] += clock() - start
+            yield item
+
+    def timed(self, name, function):
+        # Wraps a function called once per item, e.g. writing a row
+        self.upstream[name] = None
+        self.inclusive.setdefault(name, 0.0)
+        clock = time.perf_counter
+
+        def call(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.inclusive[name] += clock() - start
+
+        return call
+
+    def add_capture(self, pairer=None, reassembler=None, since=None):
+        # Takes the counts of the pairer and reassembler of a capture that
+        # was read to the end. A resumed capture is counted from `since`, what
+        # get_capture_counts returned when it was picked up again, so hellos
+        # left waiting by the last read are only counted again if they still
+        # wait, and taken back if they got what they waited for.
+        self.counters["captures"] += 1
+        counts = get_capture_counts(pairer, reassembler, final=True)
+        for name, value in counts.items():
+            self.counters[name] += value - (since or {}).get(name, 0)
+
+    def add_counts(self, counts):
+        # Takes counts gathered elsewhere, e.g. by worker processes
+        for name, value in counts.items():
+            self.counters[name] += value
+
+    def add_session(self):
+        self.counters["sessions"] += 1
+
+    def finish(self):
+        if self.progress is not None:
+            self.show_progress(force=True)
+            self.progress.write("\n")
+
+    def seconds(self):
+        # Time spent in each stage itself
+        seconds = {}
+        for name in STAGES:
+            if name not in self.inclusive:
+                continue
+            upstream = self.upstream.get(name)
+            own = self.inclusive[name] - self.inclusive.get(upstream, 0.0)
+            seconds[name] = max(own, 0.0)
+        return seconds
+
+    def show_progress(self, force=False):
+        if self.progress is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        elapsed = now - self.started
+        counters = self.counters
+        self.progress.write(
+            f"\r{elapsed:7.0f}s {counters['packets']:,} packets "
+            f"({counters['bytes'] / 1e6:,.1f} MB, "
+            f"{counters['packets'] / max(elapsed, 1e-9):,.0f}/s) "
+            f"{counters['sessions']:,} sessions "
+        )
+        self.progress.flush()
+
+    def to_dict(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "elapsed_seconds": elapsed,
+            "counters": dict(self.counters),
+            "stage_seconds": self.seconds(),
+            "packets_per_second": self.counters["packets"] / elapsed,
+            "sessions_per_second": self.counters["sessions"] / elapsed,
+        }
+
+    def summary(self):
+        data = self.to_dict()
+        elapsed = data["elapsed_seconds"]
+        lines = [f"Stats after {elapsed:.1f}s:"]
+        for name, seconds in data["stage_seconds"].items():
+            share = seconds / elapsed if elapsed else 0.0
+            lines.append(f"  {name:<24} {seconds:10.3f}s {share:7.1%}")
+        for name, value in data["counters"].items():
+            lines.append(f"  {name:<24} {value:11,}")
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+def get_capture_counts(pairer=None, reassembler=None, final=False):
+    # Counters of the pairer and reassembler of a capture. With final, the
+    # capture was read to the end, and hellos still waiting for an answer or
+    # for the rest of their segments are lost.
+    counts = {}
+    if pairer is not None:
+        counts["orphaned_client_hellos"] = pairer.orphaned
+        if final:
+            counts["orphaned_client_hellos"] += len(pairer.pending())
+    if reassembler is not None:
+        counts["reassembled_hellos"] = reassembler.reassembled
+        # Handed over without all of their segments
+        counts["partial_hellos"] = reassembler.overflowed + reassembler.taken
+        # Never handed over
+        counts["dropped_hellos"] = reassembler.evicted
+        if final:
+            counts["dropped_hellos"] += len(reassembler.flows)
+    return counts
+
+
+def open_stats(enabled, json_path=None):
+    # The stats of a run, or None when nobody asked for them. The progress
+    # line is only drawn on a terminal.
+    if not enabled and json_path is None:
+        return None
+    progress = sys.stderr if enabled and sys.stderr.isatty() else None
+    return PipelineStats(progress)
+
+
+class Profiler:
+    # Profiles everything run inside it with cProfile, and/or traces memory
+    # allocations with tracemalloc, and writes the results to the given paths
+    # on the way out. Does nothing without paths.
+
+    def __init__(self, profile_path=None, memory_path=None):
+        self.profile_path = profile_path
+        self.memory_path = memory_path
+        self.profile = None
+
+    def __enter__(self):
+        if self.memory_path is not None:
+            tracemalloc.start()
+        if self.profile_path is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+            # Readable with pstats, snakeviz and the like
+            self.profile.dump_stats(self.profile_path)
+        if self.memory_path is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(self.memory_path, "w") as f:
+                f.write(f"current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB\n")
+                for statistic in snapshot.statistics("lineno")[:MEMORY_PROFILE_TOP]:
+                    f.write(f"{statistic}\n")
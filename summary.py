@@ -0,0 +1,200 @@
+import csv
+import heapq
+import json
+import os
+from collections import Counter
+from operator import itemgetter
+from mappings import CIPHER_SUITES_BY_NAME, TLS_VERSIONS_BY_NAME
+
+DEFAULT_TOP = 10
+# Distinct servers and server names tracked before counts become estimates
+DEFAULT_CAPACITY = 10000
+
+
+class TopCounter:
+    # Counts the most frequent keys in bounded memory (Space-Saving). Once
+    # `capacity` keys are tracked, a new key replaces the least counted one
+    # and takes over its count, which is kept as the most it can be off by.
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # (count, key) for every tracked key, counts lag behind until the
+        # entry reaches the top
+        self._heap = []
+
+    def add(self, key):
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+            return
+        if len(counts) < self.capacity:
+            counts[key] = 1
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (1, key))
+            return
+        heap = self._heap
+        while heap[0][0] != counts[heap[0][1]]:
+            heapq.heapreplace(heap, (counts[heap[0][1]], heap[0][1]))
+        count, least = heap[0]
+        del counts[least]
+        del self.errors[least]
+        counts[key] = count + 1
+        self.errors[key] = count
+        heapq.heapreplace(heap, (count + 1, key))
+
+    def most_common(self, n):
+        # [(key, count, error)], counts are exact where the error is 0
+        top = heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+        return [(key, count, self.errors[key]) for key, count in top]
+
+
+class SessionSummary:
+    # The pivot of the report computed while it is written: exact counts per
+    # version and cipher suite, of which there are only so many, and the top
+    # servers and server names.
+
+    def __init__(self, top=DEFAULT_TOP, capacity=DEFAULT_CAPACITY):
+        self.top = top
+        self.sessions = 0
+        self.versions = Counter()
+        self.cipher_suites = Counter()
+        self.servers = TopCounter(capacity)
+        self.server_names = TopCounter(capacity)
+        self.no_server_name = 0
+
+    def add(self, session_data):
+        self.sessions += 1
+        self.versions[session_data.negotiated_tls_version] += 1
+        self.cipher_suites[session_data.negotiated_cipher_suite] += 1
+        server_ip = session_data.server_ip
+        if server_ip is not None:
+            if ":" in server_ip:
+                server_ip = f"[{server_ip}]"
+            self.servers.add(f"{server_ip}:{session_data.server_port}")
+        server_name = session_data.server_name
+        if server_name is None:
+            self.no_server_name += 1
+        else:
+            self.server_names.add(server_name)
+
+    def to_dict(self):
+        versions = []
+        deprecated = 0
+        for name, count in self.versions.most_common():
+            entry = TLS_VERSIONS_BY_NAME.get(name)
+            versions.append(
+                {
+                    "name": name,
+                    "count": count,
+                    "deprecated": entry.deprecated if entry else None,
+                }
+            )
+            if entry is not None and entry.deprecated:
+                deprecated += count
+        cipher_suites = []
+        insecure = 0
+        for name, count in self.cipher_suites.most_common():
+            entry = CIPHER_SUITES_BY_NAME.get(name)
+            cipher_suites.append(
+                {
+                    "name": name,
+                    "count": count,
+                    "insecure": entry.insecure if entry else None,
+                    "forward_secrecy": entry.forward_secrecy if entry else None,
+                    "aead": entry.aead if entry else None,
+                }
+            )
+            if entry is not None and entry.insecure:
+                insecure += count
+        return {
+            "sessions": self.sessions,
+            "deprecated_version_sessions": deprecated,
+            "insecure_cipher_suite_sessions": insecure,
+            "tls_versions": versions,
+            "cipher_suites": cipher_suites,
+            "top_servers": [
+                {"server": key, "count": count, "error": error}
+                for key, count, error in self.servers.most_common(self.top)
+            ],
+            "top_server_names": [
+                {"server_name": key, "count": count, "error": error}
+                for key, count, error in self.server_names.most_common(self.top)
+            ],
+            "sessions_without_server_name": self.no_server_name,
+        }
+
+
+def _summary_rows(summary):
+    # (section, name, count, notes)
+    data = summary.to_dict()
+    rows = [
+        ("total", "sessions", data["sessions"], ""),
+        ("total", "deprecated_version", data["deprecated_version_sessions"], ""),
+        ("total", "insecure_cipher_suite", data["insecure_cipher_suite_sessions"], ""),
+        ("total", "no_server_name", data["sessions_without_server_name"], ""),
+    ]
+    for version in data["tls_versions"]:
+        notes = "deprecated" if version["deprecated"] else ""
+        rows.append(("tls_version", version["name"], version["count"], notes))
+    for cipher_suite in data["cipher_suites"]:
+        notes = " ".join(
+            note
+            for note in ("insecure", "forward_secrecy", "aead")
+            if cipher_suite[note]
+        )
+        name = cipher_suite["name"]
+        rows.append(("cipher_suite", name, cipher_suite["count"], notes))
+    for section, key, top in (
+        ("server", "server", data["top_servers"]),
+        ("server_name", "server_name", data["top_server_names"]),
+    ):
+        for entry in top:
+            notes = f"+/- {entry['error']}" if entry["error"] else ""
+            rows.append((section, entry[key], entry["count"], notes))
+    return rows
+
+
+def write_json_summary(summary, f):
+    json.dump(summary.to_dict(), f, indent=2)
+    f.write("\n")
+
+
+def write_csv_summary(summary, f):
+    writer = csv.writer(f)
+    writer.writerow(["section", "name", "count", "notes"])
+    writer.writerows(_summary_rows(summary))
+
+
+def write_markdown_summary(summary, f):
+    f.write("# WhaTLS summary\n")
+    section = None
+    for row_section, name, count, notes in _summary_rows(summary):
+        if row_section != section:
+            section = row_section
+            f.write(f"\n## {section}\n\n| name | count | notes |\n|---|---:|---|\n")
+        f.write(f"| {name} | {count} | {notes} |\n")
+
+
+SUMMARY_WRITERS = {
+    "json": write_json_summary,
+    "csv": write_csv_summary,
+    "md": write_markdown_summary,
+}
+
+
+def get_summary_format(path):
+    # From the file extension, json without one
+    return os.path.splitext(path)[1].lstrip(".").lower() or "json"
+
+
+def write_summary(summary, path, summary_format=None):
+    if summary_format is None:
+        summary_format = get_summary_format(path)
+    if summary_format not in SUMMARY_WRITERS:
+        raise ValueError(f"Unsupported summary format: {summary_format}")
+    temp = f"{path}.tmp"
+    with open(temp, "w", newline="") as f:
+        SUMMARY_WRITERS[summary_format](summary, f)
+    os.replace(temp, path)
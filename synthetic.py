@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+import argparse
+import heapq
+import os
+import random
+import struct
+import sys
+from mappings import TLS_VERSIONS_BY_NAME, CIPHER_SUITES_BY_NAME
+from packets import LINKTYPE_ETHERNET, IPPROTO_TCP, TCP_FIN, TCP_SYN, TCP_ACK
+from pcapreader import Record
+from pcapwriter import PcapWriter, PcapngWriter
+
+# Synthetic captures for benchmarking: TLS flows with a given mix of versions
+# and cipher suites, application data after the handshakes, and some hellos
+# split over several segments or left without a Server Hello.
+
+# Weights of the negotiated versions and cipher suites by id
+DEFAULT_VERSIONS = {0x0301: 5, 0x0303: 60, 0x0304: 35}
+DEFAULT_CIPHER_SUITES = {
+    0x000A: 2,
+    0x002F: 5,
+    0x009C: 5,
+    0xC02F: 30,
+    0xC030: 20,
+    0xCCA8: 10,
+    0x1301: 40,
+    0x1302: 15,
+    0x1303: 10,
+}
+TLS13_CIPHER_SUITES = range(0x1301, 0x1306)
+# What a browser offers, in order
+OFFERED_CIPHER_SUITES = (
+    0x1301,
+    0x1302,
+    0x1303,
+    0xC02B,
+    0xC02F,
+    0xC02C,
+    0xC030,
+    0xCCA9,
+    0xCCA8,
+    0xC013,
+    0xC014,
+    0x009C,
+    0x009D,
+    0x002F,
+    0x0035,
+)
+SIGNATURE_ALGORITHMS = (0x0403, 0x0804, 0x0401, 0x0503, 0x0805, 0x0501, 0x0806, 0x0601)
+GREASE = 0x0A0A
+GROUP_X25519 = 0x001D
+GROUP_SECP256R1 = 0x0017
+GROUP_X25519_MLKEM768 = 0x11EC
+# A post-quantum key share is what pushes hellos past a single segment
+X25519_MLKEM768_SHARE_LEN = 1216
+
+TCP_PSH = 0x08
+MSS = 1448
+START_TIME = 1600000000.0
+FLOW_INTERVAL = 0.001
+RTT = 0.02
+SERVERS = 200
+ETHERNET_HEADER = bytes.fromhex("020000000002020000000001") + b"\x08\x00"
+
+
+def _extension(ext_type, data):
+    return struct.pack("!HH", ext_type, len(data)) + data
+
+
+def _vector(data, length_size=2):
+    return len(data).to_bytes(length_size, "big") + data
+
+
+def _ids(ids):
+    return struct.pack("!%dH" % len(ids), *ids)
+
+
+def _handshake_record(record_version, msg_type, body):
+    message = bytes([msg_type]) + len(body).to_bytes(3, "big") + body
+    return struct.pack("!BHH", 0x16, record_version, len(message)) + message
+
+
+def client_hello(rng, version, cipher_suite, server_name, split=False):
+    # Offers TLS 1.3 next to 1.2 whenever the version allows or a large key
+    # share is wanted, the server decides
+    offers_tls13 = version >= 0x0303 or split
+    cipher_suites = [GREASE] + list(OFFERED_CIPHER_SUITES)
+    if cipher_suite not in cipher_suites:
+        cipher_suites.append(cipher_suite)
+    groups = [GREASE, GROUP_X25519, GROUP_SECP256R1]
+    if split:
+        groups.insert(1, GROUP_X25519_MLKEM768)
+    name = server_name.encode("ascii")
+    extensions = [
+        _extension(GREASE, b""),
+        _extension(0, _vector(b"\x00" + _vector(name))),
+        _extension(23, b""),
+        _extension(65281, b"\x00"),
+        _extension(10, _vector(_ids(groups))),
+        _extension(11, b"\x01\x00"),
+        _extension(35, b""),
+        _extension(16, _vector(_vector(b"h2", 1) + _vector(b"http/1.1", 1))),
+        _extension(13, _vector(_ids(SIGNATURE_ALGORITHMS))),
+    ]
+    if offers_tls13:
+        shares = b""
+        if split:
+            share = rng.getrandbits(8 * X25519_MLKEM768_SHARE_LEN).to_bytes(
+                X25519_MLKEM768_SHARE_LEN, "big"
+            )
+            shares += struct.pack("!H", GROUP_X25519_MLKEM768) + _vector(share)
+        shares += struct.pack("!H", GROUP_X25519) + _vector(_random(rng))
+        extensions += [
+            _extension(51, _vector(shares)),
+            _extension(45, b"\x01\x01"),
+            _extension(43, _vector(_ids([GREASE, 0x0304, 0x0303]), 1)),
+        ]
+    body = (
+        struct.pack("!H", min(version, 0x0303))
+        + _random(rng)
+        + _vector(_random(rng), 1)
+        + _vector(_ids(cipher_suites))
+        + b"\x01\x00"
+        + _vector(b"".join(extensions))
+    )
+    return _handshake_record(0x0301, 1, body)
+
+
+def server_hello(rng, version, cipher_suite):
+    if version == 0x0304:
+        key_share = struct.pack("!H", GROUP_X25519) + _vector(_random(rng))
+        extensions = _extension(43, struct.pack("!H", 0x0304)) + _extension(
+            51, key_share
+        )
+    else:
+        extensions = (
+            _extension(65281, b"\x00")
+            + _extension(23, b"")
+            + _extension(16, _vector(_vector(b"h2", 1)))
+        )
+    body = (
+        struct.pack("!H", min(version, 0x0303))
+        + _random(rng)
+        + _vector(_random(rng), 1)
+        + struct.pack("!HB", cipher_suite, 0)
+        + _vector(extensions)
+    )
+    return _handshake_record(min(version, 0x0303), 2, body)
+
+
+def _random(rng):
+    return rng.getrandbits(256).to_bytes(32, "big")
+
+
+def _frame(src, dst, sport, dport, seq, ack, flags, payload=b""):
+    ip = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        0,
+        40 + len(payload),
+        0,
+        0x4000,
+        64,
+        IPPROTO_TCP,
+        0,
+        src,
+        dst,
+    )
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, seq, ack, 5 << 4, flags, 65535, 0, 0)
+    return ETHERNET_HEADER + ip + tcp + payload
+
+
+class _Flow:
+    # Both directions of a connection with their sequence numbers, SYN and
+    # FIN consume one
+
+    def __init__(self, rng, index, server):
+        self.client = bytes([10, index >> 16 & 0xFF, index >> 8 & 0xFF, index & 0xFF])
+        self.server = bytes([192, 0, 2, server % 250 + 1])
+        self.client_port = 1024 + index % 64000
+        self.client_seq = rng.getrandbits(32)
+        self.server_seq = rng.getrandbits(32)
+
+    def from_client(self, flags, payload=b"", consumes=0):
+        data = _frame(
+            self.client,
+            self.server,
+            self.client_port,
+            443,
+            self.client_seq,
+            self.server_seq,
+            flags,
+            payload,
+        )
+        self.client_seq = (self.client_seq + len(payload) + consumes) & 0xFFFFFFFF
+        return data
+
+    def from_server(self, flags, payload=b"", consumes=0):
+        data = _frame(
+            self.server,
+            self.client,
+            443,
+            self.client_port,
+            self.server_seq,
+            self.client_seq,
+            flags,
+            payload,
+        )
+        self.server_seq = (self.server_seq + len(payload) + consumes) & 0xFFFFFFFF
+        return data
+
+
+def _choose(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+
+def _flow_packets(rng, index, start, options, noise_data):
+    # (timestamp, frame) of one connection, from the SYN to the FIN
+    versions, cipher_suites, noise, split, missing = options
+    version = _choose(rng, versions)
+    tls13 = version == 0x0304
+    suites = {
+        suite: weight
+        for suite, weight in cipher_suites.items()
+        if (suite in TLS13_CIPHER_SUITES) == tls13
+    }
+    cipher_suite = _choose(rng, suites) if suites else 0x1301 if tls13 else 0xC02F
+    server = rng.randrange(SERVERS)
+    flow = _Flow(rng, index, server)
+    hello = client_hello(
+        rng, version, cipher_suite, f"service{server}.example.com", rng.random() < split
+    )
+    packets = [(start, flow.from_client(TCP_SYN, consumes=1))]
+    packets.append((start + RTT, flow.from_server(TCP_SYN | TCP_ACK, consumes=1)))
+    t = start + RTT
+    packets.append((t, flow.from_client(TCP_ACK)))
+    for pos in range(0, len(hello), MSS):
+        t += 0.000001
+        packets.append((t, flow.from_client(TCP_ACK | TCP_PSH, hello[pos : pos + MSS])))
+    t = start + 2 * RTT
+    if rng.random() >= missing:
+        hello = server_hello(rng, version, cipher_suite)
+        packets.append((t, flow.from_server(TCP_ACK | TCP_PSH, hello)))
+    for i in range(noise):
+        t += 0.001
+        size = rng.randint(100, MSS - 5)
+        pos = rng.randrange(len(noise_data) - size)
+        payload = struct.pack("!BHH", 0x17, 0x0303, size) + noise_data[pos : pos + size]
+        send = flow.from_server if i % 2 else flow.from_client
+        packets.append((t, send(TCP_ACK | TCP_PSH, payload)))
+    t += 0.001
+    packets.append((t, flow.from_client(TCP_FIN | TCP_ACK, consumes=1)))
+    packets.append((t + RTT, flow.from_server(TCP_FIN | TCP_ACK, consumes=1)))
+    packets.append((t + RTT, flow.from_client(TCP_ACK)))
+    return packets
+
+
+def iter_synthetic_records(
+    flows,
+    versions=None,
+    cipher_suites=None,
+    noise=4,
+    split=0.1,
+    missing=0.05,
+    seed=0,
+):
+    # Records of `flows` connections starting FLOW_INTERVAL apart, in capture
+    # order. `noise` application data packets follow each handshake, `split`
+    # and `missing` are the shares of Client Hellos larger than a segment and
+    # of handshakes without a Server Hello.
+    rng = random.Random(seed)
+    options = (
+        versions or DEFAULT_VERSIONS,
+        cipher_suites or DEFAULT_CIPHER_SUITES,
+        noise,
+        split,
+        missing,
+    )
+    noise_data = rng.getrandbits(8 * 65536).to_bytes(65536, "big")
+    # Packets of the connections still going, by timestamp
+    pending = []
+    count = 0
+    for index in range(flows):
+        start = START_TIME + index * FLOW_INTERVAL
+        while pending and pending[0][0] < start:
+            timestamp, _, data = heapq.heappop(pending)
+            yield Record(0, timestamp, LINKTYPE_ETHERNET, data)
+        for timestamp, data in _flow_packets(rng, index, start, options, noise_data):
+            heapq.heappush(pending, (timestamp, count, data))
+            count += 1
+    while pending:
+        timestamp, _, data = heapq.heappop(pending)
+        yield Record(0, timestamp, LINKTYPE_ETHERNET, data)
+
+
+def write_capture(path, records, pcapng=False):
+    # Returns the number of records written
+    count = 0
+    with open(path, "wb") as f:
+        writer = PcapngWriter(f) if pcapng else PcapWriter(f)
+        for record in records:
+            writer.write(record)
+            count += 1
+    return count
+
+
+def parse_mix(text, by_name):
+    # "TLSv1.2=60,TLSv1.3=40" or "0x0303=60,0x0304=40" into {id: weight}
+    mix = {}
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        key = key.strip()
+        entry = by_name.get(key)
+        try:
+            mix[entry.id if entry else int(key, 0)] = float(weight or 1)
+        except ValueError:
+            raise ValueError(f"Can't make sense of {item!r}")
+    return mix
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(args[0]),
+        description="Write a synthetic capture of TLS handshakes.",
+    )
+    parser.add_argument("output", help="capture file to write")
+    parser.add_argument(
+        "--flows", type=int, default=10000, help="connections (default: 10000)"
+    )
+    parser.add_argument(
+        "--versions",
+        help="negotiated versions and their weights, by name or id, e.g. "
+        "TLSv1.2=60,TLSv1.3=40",
+    )
+    parser.add_argument(
+        "--cipher-suites",
+        help="negotiated cipher suites and their weights, by name or id, e.g. "
+        "0xc02f=3,0x1301=1",
+    )
+    parser.add_argument(
+        "--noise",
+        type=int,
+        default=4,
+        help="application data packets per connection (default: 4)",
+    )
+    parser.add_argument(
+        "--split",
+        type=float,
+        default=0.1,
+        help="share of Client Hellos larger than a segment (default: 0.1)",
+    )
+    parser.add_argument(
+        "--missing",
+        type=float,
+        default=0.05,
+        help="share of handshakes without a Server Hello (default: 0.05)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--pcapng",
+        action="store_true",
+        help="write pcapng (default: pcap, unless the name ends in .pcapng)",
+    )
+    return parser.parse_args(args[1:])
+
+
+def main(args):
+    options = parse_args(args)
+    versions = cipher_suites = None
+    try:
+        if options.versions:
+            versions = parse_mix(options.versions, TLS_VERSIONS_BY_NAME)
+        if options.cipher_suites:
+            cipher_suites = parse_mix(options.cipher_suites, CIPHER_SUITES_BY_NAME)
+    except ValueError as e:
+        print(e)
+        return 1
+    records = iter_synthetic_records(
+        options.flows,
+        versions,
+        cipher_suites,
+        options.noise,
+        options.split,
+        options.missing,
+        options.seed,
+    )
+    pcapng = options.pcapng or options.output.endswith(".pcapng")
+    count = write_capture(options.output, records, pcapng)
+    print(f"Wrote {count} packets of {options.flows} connections to {options.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,58 @@
+import pytest
+from benchmark import format_results, STAGES
+
+
+def get_results(seconds=1.0, packets=1000, **settings):
+    settings = dict(
+        {"backend": "native", "format": "csv", "prefilter": False, "repeat": 3},
+        **settings,
+    )
+    return {
+        "capture": {
+            "path": "synthetic",
+            "bytes": 10**6,
+            "packets": packets,
+            "sessions": 10,
+        },
+        "settings": settings,
+        "stages": {stage: {"seconds": seconds, "rate": 1000.0} for stage in STAGES},
+        "end_to_end": {
+            "seconds": seconds,
+            "packets_per_second": packets / seconds,
+            "sessions_per_second": 10 / seconds,
+        },
+        "peak_rss_mb": None,
+    }
+
+
+def get_compared(lines):
+    # The names of the stages compared with the baseline
+    return {line[2:13].strip() for line in lines if " vs " in line}
+
+
+def test_slower_stages_are_regressions():
+    lines, regressions = format_results(get_results(2.0), get_results(1.0, repeat=1))
+    assert set(regressions) == set(STAGES) | {"end to end"}
+    assert not any(line.startswith("Warning") for line in lines)
+
+
+@pytest.mark.parametrize(
+    "settings, skipped",
+    [
+        ({"prefilter": True}, {"dissect", "end to end"}),
+        ({"format": "jsonl"}, {"write", "end to end"}),
+        ({"backend": "pyshark"}, set(STAGES) | {"end to end"}),
+        ({"synthetic": {"seed": 1}}, set(STAGES) | {"end to end"}),
+    ],
+)
+def test_stages_with_other_inputs_are_not_compared(settings, skipped):
+    lines, regressions = format_results(get_results(2.0), get_results(1.0, **settings))
+    assert set(regressions) == set(STAGES) - skipped | {"end to end"} - skipped
+    assert get_compared(lines) == set(regressions)
+    assert lines[-1].startswith("Warning: the baseline was measured with")
+
+
+def test_other_capture_is_not_compared():
+    lines, regressions = format_results(get_results(2.0), get_results(packets=5))
+    assert regressions == []
+    assert "Warning: the baseline was measured on a different capture" in lines
@@ -0,0 +1,93 @@
+import itertools
+import cache as cache_module
+import whatls
+from cache import ResultCache
+from synthetic import iter_synthetic_records, write_capture
+
+VARIANT = "variant"
+BLOB_SIZE = 100
+
+
+def write_captures(directory, count):
+    directory.mkdir()
+    paths = []
+    for seed in range(count):
+        path = directory / f"capture{seed}.pcap"
+        write_capture(str(path), iter_synthetic_records(20, seed=seed))
+        paths.append(str(path))
+    return paths
+
+
+def run(*args):
+    assert whatls.main(["whatls.py", *map(str, args)]) == 0
+
+
+def get_cached(path, captures):
+    cache = ResultCache(str(path))
+    variant = whatls.get_cache_variant(whatls.parse_args(["whatls.py", *captures]))
+    cached = [cache.contains(capture, variant) for capture in captures]
+    cache.close()
+    return cached
+
+
+def test_clearing_captures_leaves_the_others(tmp_path):
+    path = tmp_path / "results.sqlite"
+    captures = write_captures(tmp_path / "captures", 3)
+    (tmp_path / "empty").mkdir()
+    run("--cache", path, "-o", tmp_path / "report.csv", *captures)
+    assert get_cached(path, captures) == [True, True, True]
+
+    # Nothing to clear in an empty directory, rather than everything
+    run("--clear-cache", "--cache", path, tmp_path / "empty")
+    assert get_cached(path, captures) == [True, True, True]
+    run("--clear-cache", "--cache", path, captures[1])
+    assert get_cached(path, captures) == [True, False, True]
+    run("--clear-cache", "--cache", path)
+    assert get_cached(path, captures) == [False, False, False]
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(clock)))
+    captures = write_captures(tmp_path / "captures", 4)
+    cache = ResultCache(str(tmp_path / "results.sqlite"), max_size=3 * BLOB_SIZE)
+    for capture in captures[:3]:
+        cache.store(cache.file_digest(capture), VARIANT, b"x" * BLOB_SIZE)
+    # Used again, the second one is now the least recently used
+    assert cache.get(captures[0], VARIANT) is not None
+    cache.store(cache.file_digest(captures[3]), VARIANT, b"x" * BLOB_SIZE)
+    cached = [cache.contains(capture, VARIANT) for capture in captures]
+    assert cached == [True, False, True, True]
+    # Larger than the rest together
+    cache.store(cache.file_digest(captures[1]), VARIANT, b"x" * 3 * BLOB_SIZE)
+    cached = [cache.contains(capture, VARIANT) for capture in captures]
+    assert cached == [False, True, False, False]
+    cache.close()
+
+
+def test_other_report_options_miss(tmp_path, capsys):
+    path = tmp_path / "results.sqlite"
+    captures = write_captures(tmp_path / "captures", 2)
+    report = tmp_path / "report.csv"
+
+    def reused(*args):
+        capsys.readouterr()
+        run("--cache", path, "-o", report, *captures, *args)
+        lines = capsys.readouterr().out.splitlines()
+        return [line for line in lines if line.startswith("Reused")]
+
+    assert reused() == ["Reused cached results for 0 of 2 captures"]
+    expected = report.read_text()
+    assert reused() == ["Reused cached results for 2 of 2 captures"]
+    assert report.read_text() == expected
+    assert reused("--flow-timeout", "5") == [
+        "Reused cached results for 0 of 2 captures"
+    ]
+    assert reused("--hello-text", "full") == [
+        "Reused cached results for 0 of 2 captures"
+    ]
+    # Both kept, each under its own options
+    assert reused("--flow-timeout", "5") == [
+        "Reused cached results for 2 of 2 captures"
+    ]
+    assert reused() == ["Reused cached results for 2 of 2 captures"]
@@ -0,0 +1,132 @@
+import os
+import pytest
+import whatls
+from pcapreader import Record
+from synthetic import iter_synthetic_records, write_capture
+
+FLOWS = 300
+
+
+def get_capture(tmp_path, seed=4, shift=0.0):
+    # The bytes of a synthetic capture, with timestamps moved by `shift` so
+    # captures can be told apart by their first record
+    records = (
+        Record(record.offset, record.timestamp + shift, record.linktype, record.data)
+        for record in iter_synthetic_records(FLOWS, split=0.3, missing=0.1, seed=seed)
+    )
+    path = tmp_path / f"synthetic-{seed}.pcap"
+    write_capture(str(path), records)
+    data = path.read_bytes()
+    path.unlink()
+    return data
+
+
+def run(*args):
+    assert whatls.main(["whatls.py", *map(str, args)]) == 0
+
+
+def get_rows(capture, data, report):
+    # The rows of a single run over the whole capture, header first
+    capture.write_bytes(data)
+    run(capture, "-o", report)
+    rows = report.read_text().splitlines()
+    report.unlink()
+    return rows
+
+
+def write_in_place(path, data):
+    # Keeps the inode, as a capture rewritten by its writer would
+    with open(path, "r+b" if path.exists() else "wb") as f:
+        f.truncate(0)
+        f.write(data)
+
+
+def append(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize("cuts", [[0.5], [0.2, 0.55, 0.8]])
+def test_resumed_runs_over_a_growing_capture_match_a_single_run(tmp_path, cuts):
+    data = get_capture(tmp_path)
+    capture = tmp_path / "capture.pcap"
+    report = tmp_path / "report.csv"
+    checkpoint = tmp_path / "capture.ckpt"
+    expected = get_rows(capture, data, report)
+    assert len(expected) > FLOWS // 2
+    capture.unlink()
+
+    # Cut anywhere, mid record and mid hello included
+    written = 0
+    for cut in cuts + [1.0]:
+        end = int(len(data) * cut)
+        append(capture, data[written:end])
+        written = end
+        run(capture, "--checkpoint", checkpoint, "-o", report)
+    assert report.read_text().splitlines() == expected
+
+
+@pytest.mark.parametrize("truncated", [True, False])
+def test_capture_rewritten_in_place_is_read_from_the_start(tmp_path, truncated):
+    first = get_capture(tmp_path, seed=4)
+    if truncated:
+        # Starts the same, only its size gives it away
+        second = first[: len(first) // 3]
+    else:
+        # Longer, told apart by the timestamp of its first record
+        second = get_capture(tmp_path, seed=5, shift=3600.0)
+        second += second[24:]
+    capture = tmp_path / "capture.pcap"
+    report = tmp_path / "report.csv"
+    checkpoint = tmp_path / "capture.ckpt"
+    first_rows = get_rows(capture, first, report)
+    second_rows = get_rows(capture, second, report)
+    inode = capture.stat().st_ino
+
+    write_in_place(capture, first)
+    run(capture, "--checkpoint", checkpoint, "-o", report)
+    write_in_place(capture, second)
+    assert capture.stat().st_ino == inode
+    run(capture, "--checkpoint", checkpoint, "-o", report)
+    assert report.read_text().splitlines() == first_rows + second_rows[1:]
+
+
+def test_report_is_rolled_back_to_the_checkpoint(tmp_path):
+    data = get_capture(tmp_path)
+    capture = tmp_path / "capture.pcap"
+    report = tmp_path / "report.csv"
+    checkpoint = tmp_path / "capture.ckpt"
+    expected = get_rows(capture, data, report)
+
+    capture.write_bytes(data[: len(data) // 2])
+    run(capture, "--checkpoint", checkpoint, "-o", report)
+    # Rows written after the last save by a run that was then killed
+    saved = report.read_text()
+    with open(report, "a") as f:
+        f.write(saved.splitlines()[-1] + "\n")
+        f.write("half a row,")
+    append(capture, data[len(data) // 2 :])
+    run(capture, "--checkpoint", checkpoint, "-o", report)
+    assert report.read_text().splitlines() == expected
+
+
+def test_follow_skips_captures_rotated_away_meanwhile(tmp_path, monkeypatch):
+    data = get_capture(tmp_path)
+    directory = tmp_path / "captures"
+    directory.mkdir()
+    capture = directory / "capture.pcap"
+    report = tmp_path / "report.csv"
+    expected = get_rows(capture, data, report)
+
+    def expand_captures(paths, compressed=True):
+        # Lists a capture that is gone by the time it is read
+        return [str(directory / "rotated.pcap"), str(capture)]
+
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(whatls, "expand_captures", expand_captures)
+    monkeypatch.setattr(whatls.time, "sleep", interrupt)
+    run(directory, "--follow", "--checkpoint", tmp_path / "ckpt", "-o", report)
+    assert report.read_text().splitlines() == expected
+    assert os.listdir(directory) == ["capture.pcap"]
@@ -0,0 +1,85 @@
+from collections import Counter
+from live import ReplayCapture, run_live
+from sessions import iter_sessions
+from synthetic import iter_synthetic_records, write_capture
+from tlsparser import tls_version_name, cipher_suite_name
+
+FLOWS = 200
+
+
+class DroppingReplayCapture(ReplayCapture):
+    # Reports drops the way the kernel would for an interface, one for every
+    # `every` packets received, counted since the capture was opened
+
+    def __init__(self, path, every):
+        super().__init__(path)
+        self.every = every
+
+    def stats(self):
+        return self.received, self.received // self.every
+
+
+def write_synthetic_capture(path):
+    # Returns the number of packets
+    return write_capture(
+        str(path), iter_synthetic_records(FLOWS, split=0.2, missing=0.1, seed=5)
+    )
+
+
+def get_header(report):
+    # The counters of the first line of a report, after the time and label
+    return dict(item.split("=") for item in report.splitlines()[0].split()[3:])
+
+
+def test_replay_reports_the_sessions_of_the_capture(tmp_path):
+    path = tmp_path / "replay.pcap"
+    packets = write_synthetic_capture(path)
+    sessions = list(iter_sessions(str(path)))
+    reports = []
+    counters = run_live(ReplayCapture(str(path)), interval=3600, out=reports.append)
+
+    assert counters.sessions == len(sessions)
+    assert {
+        tls_version_name(version): count
+        for version, count in counters.total_versions.items()
+    } == Counter(session.negotiated_tls_version for session in sessions)
+    assert {
+        cipher_suite_name(cipher_suite): count
+        for cipher_suite, count in counters.total_cipher_suites.items()
+    } == Counter(session.negotiated_cipher_suite for session in sessions)
+    # Only the totals, the interval never came around
+    assert len(reports) == 1
+    assert " total:" in reports[0].splitlines()[0]
+    assert get_header(reports[0]) == {
+        "sessions": str(len(sessions)),
+        "packets": str(packets),
+        "dropped": "0",
+        # One Client Hello per connection, the rest never got an answer
+        "half_open": str(FLOWS - len(sessions)),
+    }
+    for version, count in Counter(
+        session.negotiated_tls_version for session in sessions
+    ).items():
+        assert f"  {version}: {count}" in reports[0].splitlines()
+
+
+def test_replay_reports_drops_and_rolls_intervals_over(tmp_path):
+    path = tmp_path / "replay.pcap"
+    packets = write_synthetic_capture(path)
+    reports = []
+    counters = run_live(
+        DroppingReplayCapture(str(path), every=7), interval=0, out=reports.append
+    )
+
+    *intervals, totals = [get_header(report) for report in reports]
+    assert len(intervals) == packets
+    # Every interval has the packets and drops since the one before
+    assert all(header["packets"] == "1" for header in intervals)
+    drops = [header["dropped"] for header in intervals]
+    assert drops[6:14] == ["1", "0", "0", "0", "0", "0", "0", "1"]
+    assert sum(map(int, drops)) == packets // 7
+    assert totals["dropped"] == str(packets // 7)
+    assert totals["packets"] == str(packets)
+    # Every session is reported in exactly one interval
+    assert sum(int(header["sessions"]) for header in intervals) == counters.sessions
+    assert totals["sessions"] == str(counters.sessions)
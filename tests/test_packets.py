@@ -0,0 +1,111 @@
+import struct
+import pytest
+from packets import (
+    decode_tcp,
+    LINKTYPE_ETHERNET,
+    LINKTYPE_NULL,
+    LINKTYPE_RAW,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+)
+from sessions import iter_sessions
+from synthetic import iter_synthetic_records
+
+FLOWS = 100
+IPV6_PREFIX = bytes.fromhex("20010db8000000000000000000000000")[:12]
+
+
+def get_records():
+    return list(iter_synthetic_records(FLOWS, split=0.2, missing=0.1, seed=7))
+
+
+def to_ipv6(frame, extension=False):
+    # The IPv4 packet of an Ethernet frame as IPv6, addresses kept in the low
+    # bits, optionally behind a hop-by-hop options header
+    ip, tcp = frame[14:34], frame[34:]
+    next_header = 6
+    if extension:
+        # Pad1 options up to 8 bytes
+        tcp = bytes([6, 0]) + bytes(6) + tcp
+        next_header = 0
+    header = struct.pack(
+        "!IHBB16s16s",
+        0x60000000,
+        len(tcp),
+        next_header,
+        64,
+        IPV6_PREFIX + ip[12:16],
+        IPV6_PREFIX + ip[16:20],
+    )
+    return frame[:12] + b"\x86\xdd" + header + tcp
+
+
+ENCAPSULATIONS = {
+    "vlan": lambda frame: (
+        LINKTYPE_ETHERNET,
+        frame[:12] + b"\x81\x00\x00\x64" + frame[12:],
+    ),
+    "qinq": lambda frame: (
+        LINKTYPE_ETHERNET,
+        frame[:12] + b"\x88\xa8\x00\x0a\x81\x00\x00\x64" + frame[12:],
+    ),
+    "raw": lambda frame: (LINKTYPE_RAW, frame[14:]),
+    "null": lambda frame: (LINKTYPE_NULL, struct.pack("=I", 2) + frame[14:]),
+    "sll": lambda frame: (
+        LINKTYPE_LINUX_SLL,
+        struct.pack("!HHH8s", 0, 1, 6, frame[6:12]) + frame[12:],
+    ),
+    "sll2": lambda frame: (
+        LINKTYPE_LINUX_SLL2,
+        frame[12:14] + struct.pack("!HIHBB8s", 0, 2, 1, 0, 6, frame[6:12]) + frame[14:],
+    ),
+}
+
+
+def get_sessions(records):
+    return list(iter_sessions(records, name="capture"))
+
+
+@pytest.mark.parametrize("encapsulation", sorted(ENCAPSULATIONS))
+def test_encapsulations_give_the_sessions_of_ethernet(encapsulation):
+    records = get_records()
+    expected = get_sessions(records)
+    assert len(expected) > FLOWS // 2
+    encapsulate = ENCAPSULATIONS[encapsulation]
+    encapsulated = []
+    for record in records:
+        linktype, data = encapsulate(record.data)
+        encapsulated.append(record._replace(linktype=linktype, data=data))
+    assert get_sessions(encapsulated) == expected
+
+
+@pytest.mark.parametrize("extension", [False, True])
+def test_ipv6_gives_the_sessions_of_ipv4(extension):
+    records = get_records()
+    expected = get_sessions(records)
+    sessions = get_sessions(
+        [record._replace(data=to_ipv6(record.data, extension)) for record in records]
+    )
+    assert len(sessions) == len(expected)
+    for session, ipv4_session in zip(sessions, expected):
+        assert session.client_ip.startswith("2001:db8::")
+        assert session.server_ip.startswith("2001:db8::")
+        addresses = {"client_ip": None, "server_ip": None}
+        assert session._replace(**addresses) == ipv4_session._replace(**addresses)
+
+
+def test_segments_are_decoded_without_ethernet_padding():
+    record = get_records()[0]
+    segment = decode_tcp(LINKTYPE_ETHERNET, record.data + bytes(6))
+    assert segment == decode_tcp(LINKTYPE_ETHERNET, record.data)
+    assert segment.payload == b""
+    assert (segment.sport, segment.dport) == (1024, 443)
+
+
+def test_only_first_fragments_are_decoded():
+    frame = bytearray(get_records()[0].data)
+    # More fragments, offset 0
+    frame[20:22] = b"\x20\x00"
+    assert decode_tcp(LINKTYPE_ETHERNET, bytes(frame)) is not None
+    frame[20:22] = b"\x00\x10"
+    assert decode_tcp(LINKTYPE_ETHERNET, bytes(frame)) is None
@@ -0,0 +1,127 @@
+import random
+import pytest
+from pairing import HandshakePairer
+from sessions import iter_sessions
+from synthetic import (
+    _Flow,
+    client_hello,
+    server_hello,
+    TCP_SYN,
+    TCP_ACK,
+    TCP_PSH,
+)
+from tlsparser import HELLO_RETRY_REQUEST_RANDOM
+
+
+def test_retransmitted_hellos_are_only_paired_once():
+    pairer = HandshakePairer()
+    pairer.client_hello("flow", "client", b"c1", 1.0, b"raw")
+    pairer.client_hello("flow", "client again", b"c1", 1.1, b"raw")
+    assert pairer.server_hello("flow", "server", b"s1", 1.2) == ("client", "server")
+    # Both hellos sent again after the pair
+    pairer.client_hello("flow", "client late", b"c1", 1.3, b"raw")
+    assert pairer.server_hello("flow", "server again", b"s1", 1.3) is None
+    assert pairer.pending() == []
+    assert (pairer.pairs, pairer.orphaned) == (1, 0)
+
+
+def test_client_hello_after_hello_retry_request_replaces_the_first():
+    pairer = HandshakePairer()
+    pairer.client_hello("flow", "first", b"c1", 1.0, b"first")
+    assert pairer.server_hello("flow", "retry", b"hrr", 1.1, retry=True) is None
+    # The first one sent again, then the second with the same random
+    pairer.client_hello("flow", "first again", b"c1", 1.15, b"first")
+    pairer.client_hello("flow", "second", b"c1", 1.2, b"second")
+    assert pairer.server_hello("flow", "server", b"s1", 1.3) == ("second", "server")
+    assert (pairer.pairs, pairer.orphaned) == (1, 0)
+
+
+def test_same_random_without_hello_retry_request_is_a_retransmission():
+    pairer = HandshakePairer()
+    pairer.client_hello("flow", "first", b"c1", 1.0, b"first")
+    pairer.client_hello("flow", "changed", b"c1", 1.1, b"changed")
+    assert pairer.server_hello("flow", "server", b"s1", 1.2) == ("first", "server")
+
+
+def test_flows_are_evicted_after_the_timeout():
+    pairer = HandshakePairer(timeout=10.0)
+    pairer.client_hello("old", "old client", b"c1", 1.0)
+    pairer.client_hello("recent", "recent client", b"c2", 5.0)
+    # Only "old" was quiet for longer than the timeout
+    pairer.client_hello("new", "new client", b"c3", 12.0)
+    assert [key for key, _ in pairer.pending()] == ["recent", "new"]
+    assert (pairer.orphaned, pairer.evicted) == (1, 1)
+    assert pairer.server_hello("old", "late server", b"s1", 12.5) is None
+    assert pairer.server_hello("recent", "server", b"s2", 13.0) == (
+        "recent client",
+        "server",
+    )
+
+
+def test_least_recently_used_flows_are_evicted_past_max_flows():
+    pairer = HandshakePairer(max_flows=2)
+    pairer.client_hello("a", "a client", b"c1")
+    pairer.client_hello("b", "b client", b"c2")
+    # Seen again, "b" is now the oldest
+    pairer.client_hello("a", "a client", b"c1")
+    pairer.client_hello("c", "c client", b"c3")
+    assert [key for key, _ in pairer.pending()] == ["a", "c"]
+    assert (pairer.orphaned, pairer.evicted) == (1, 1)
+    # Flows without a pending hello are evicted without counting
+    assert pairer.server_hello("a", "a server", b"s1") == ("a client", "a server")
+    pairer.client_hello("d", "d client", b"c4")
+    pairer.client_hello("e", "e client", b"c5")
+    assert [key for key, _ in pairer.pending()] == ["d", "e"]
+    assert (pairer.orphaned, pairer.evicted) == (2, 2)
+
+
+def test_handshakes_on_a_reused_flow_are_paired_in_turn():
+    pairer = HandshakePairer()
+    pairs = []
+    for i in range(3):
+        pairer.client_hello("flow", f"client {i}", f"c{i}".encode(), float(i))
+        pairs.append(pairer.server_hello("flow", f"server {i}", f"s{i}".encode()))
+    assert pairs == [(f"client {i}", f"server {i}") for i in range(3)]
+    # A Client Hello without an answer is orphaned by the next one
+    pairer.client_hello("flow", "unanswered", b"c3", 3.0)
+    pairer.client_hello("flow", "client 4", b"c4", 4.0)
+    assert pairer.server_hello("flow", "server 4", b"s4") == ("client 4", "server 4")
+    assert (pairer.pairs, pairer.orphaned) == (4, 1)
+
+
+def get_retried_handshake(retransmit):
+    # (timestamp, frame) of a TLS 1.3 connection whose first Client Hello is
+    # answered by a HelloRetryRequest, under another server name than the
+    # second one to tell them apart
+    rng = random.Random(1)
+    flow = _Flow(rng, 0, 1)
+    first = client_hello(rng, 0x0304, 0x1301, "first.example.com")
+    second = bytearray(client_hello(rng, 0x0304, 0x1301, "second.example.com"))
+    # Same random, past the record and handshake headers and the version
+    second[11:43] = first[11:43]
+    retry = bytearray(server_hello(rng, 0x0304, 0x1301))
+    retry[11:43] = HELLO_RETRY_REQUEST_RANDOM
+    frames = [
+        (1.0, flow.from_client(TCP_SYN, consumes=1)),
+        (1.0, flow.from_server(TCP_SYN | TCP_ACK, consumes=1)),
+        (1.0, flow.from_client(TCP_ACK)),
+        (1.001, flow.from_client(TCP_ACK | TCP_PSH, first)),
+        (1.011, flow.from_server(TCP_ACK | TCP_PSH, bytes(retry))),
+    ]
+    if retransmit:
+        flow.client_seq -= len(first)
+        frames.append((1.015, flow.from_client(TCP_ACK | TCP_PSH, first)))
+    frames += [
+        (1.021, flow.from_client(TCP_ACK | TCP_PSH, bytes(second))),
+        (1.031, flow.from_server(TCP_ACK | TCP_PSH, server_hello(rng, 0x0304, 0x1301))),
+    ]
+    return frames
+
+
+@pytest.mark.parametrize("retransmit", [False, True])
+def test_session_after_hello_retry_request_has_the_second_server_name(retransmit):
+    sessions = list(iter_sessions(get_retried_handshake(retransmit), name="retry"))
+    assert len(sessions) == 1
+    assert sessions[0].server_name == "second.example.com"
+    assert sessions[0].timestamp == 1.021
+    assert sessions[0].handshake_rtt_ms == pytest.approx(10.0)
@@ -0,0 +1,78 @@
+import pytest
+from packets import decode_tcp
+from parallel import get_chunk_tasks, iter_parallel_captures
+from sessions import (
+    iter_sessions,
+    get_native_session,
+    DEFAULT_FLOW_TIMEOUT,
+    DEFAULT_MAX_FLOWS,
+)
+from stats import PipelineStats
+from synthetic import iter_synthetic_records, write_capture
+from tlsparser import is_handshake_record
+
+# Small enough for hellos and handshakes to straddle many chunk boundaries
+CHUNK_SIZE = 32 * 1024
+
+
+def iter_retransmitting_records(flows, seed):
+    # Synthetic records with every third hello segment sent twice
+    hellos = 0
+    for record in iter_synthetic_records(flows, split=0.3, missing=0.1, seed=seed):
+        yield record
+        segment = decode_tcp(record.linktype, record.data)
+        if segment is not None and is_handshake_record(segment.payload):
+            hellos += 1
+            if hellos % 3 == 0:
+                yield record
+
+
+def get_serial_sessions(path):
+    stats = PipelineStats()
+    return list(iter_sessions(path, stats=stats)), stats.counters
+
+
+def get_parallel_sessions(path, jobs=3):
+    stats = PipelineStats()
+    sessions = []
+    for cap_file, pairs in iter_parallel_captures(
+        [path],
+        jobs,
+        CHUNK_SIZE,
+        DEFAULT_FLOW_TIMEOUT,
+        DEFAULT_MAX_FLOWS,
+        stats=stats,
+    ):
+        sessions.extend(
+            get_native_session(cap_file, client_hello, server_hello)
+            for client_hello, server_hello in pairs
+        )
+    return sessions, stats.counters
+
+
+@pytest.mark.parametrize("pcapng", [False, True])
+def test_chunked_run_matches_serial_run(tmp_path, pcapng):
+    path = str(tmp_path / ("chunked.pcapng" if pcapng else "chunked.pcap"))
+    write_capture(path, iter_retransmitting_records(400, seed=3), pcapng)
+    assert len(get_chunk_tasks(path, CHUNK_SIZE)) > 10
+
+    serial, serial_counters = get_serial_sessions(path)
+    parallel, parallel_counters = get_parallel_sessions(path)
+
+    # Same rows in the same order, stream ids included
+    assert parallel == serial
+    assert len({session.tcp_stream_id for session in serial}) == len(serial)
+    # Handshakes without a Server Hello, split and retransmitted hellos are
+    # counted the same
+    for name in (
+        "packets",
+        "client_hellos",
+        "server_hellos",
+        "reassembled_hellos",
+        "partial_hellos",
+        "dropped_hellos",
+        "orphaned_client_hellos",
+    ):
+        assert parallel_counters[name] == serial_counters[name], name
+    assert serial_counters["orphaned_client_hellos"] > 0
+    assert serial_counters["reassembled_hellos"] > 0
@@ -0,0 +1,122 @@
+import gzip
+import pytest
+from pcapreader import (
+    check_capture,
+    iter_records,
+    open_capture,
+    scan_chunks,
+    PCAP_HEADER_LEN,
+)
+from packets import LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL, LINKTYPE_RAW
+from pcapwriter import PcapngWriter
+from synthetic import iter_synthetic_records, write_capture
+
+FLOWS = 50
+
+
+def get_records():
+    return list(iter_synthetic_records(FLOWS, seed=6))
+
+
+def read_records(path, mapped=True):
+    with open_capture(str(path), mapped) as capture:
+        return [
+            (record.timestamp, record.linktype, bytes(record.data))
+            for record in iter_records(capture)
+        ]
+
+
+def expected_records(records):
+    return [
+        (pytest.approx(record.timestamp, abs=1e-6), record.linktype, record.data)
+        for record in records
+    ]
+
+
+@pytest.mark.parametrize("pcapng", [False, True])
+@pytest.mark.parametrize("mapped", [False, True])
+def test_records_read_back_as_written(tmp_path, pcapng, mapped):
+    records = get_records()
+    path = tmp_path / "capture"
+    assert write_capture(str(path), records, pcapng) == len(records)
+    assert read_records(path, mapped) == expected_records(records)
+
+
+def test_gzipped_capture_reads_like_the_plain_one(tmp_path):
+    records = get_records()
+    path = tmp_path / "capture.pcap"
+    write_capture(str(path), records)
+    gzipped = tmp_path / "capture.pcap.gz"
+    gzipped.write_bytes(gzip.compress(path.read_bytes()))
+    check_capture(str(gzipped))
+    assert read_records(gzipped) == read_records(path)
+
+
+def test_pcapng_interfaces_keep_their_link_types(tmp_path):
+    # Frames of other link types, only their link type matters here
+    records = get_records()[:30]
+    mixed = [
+        record._replace(linktype=linktype)
+        for record, linktype in zip(
+            records, [LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL, LINKTYPE_RAW] * 10
+        )
+    ]
+    path = tmp_path / "capture.pcapng"
+    with open(path, "wb") as f:
+        writer = PcapngWriter(f)
+        for record in mixed:
+            writer.write(record)
+    assert read_records(path) == expected_records(mixed)
+
+
+@pytest.mark.parametrize("pcapng", [False, True])
+def test_truncated_capture_ends_at_the_last_complete_record(tmp_path, pcapng):
+    records = get_records()
+    path = tmp_path / "capture"
+    write_capture(str(path), records, pcapng)
+    data = path.read_bytes()
+    # Cut into the last record
+    path.write_bytes(data[:-10])
+    with open_capture(str(path), mapped=False) as capture:
+        read = list(iter_records(capture))
+    assert len(read) == len(records) - 1
+    assert read[-1].data == records[-2].data
+
+
+@pytest.mark.parametrize("pcapng", [False, True])
+def test_chunks_split_at_record_boundaries(tmp_path, pcapng):
+    records = get_records()
+    path = tmp_path / "capture"
+    write_capture(str(path), records, pcapng)
+    with open(path, "rb") as f:
+        chunks = scan_chunks(f, 4096)
+    assert len(chunks) > 5
+    read = []
+    with open_capture(str(path)) as capture:
+        for start, end, state in chunks:
+            chunk = iter_records(capture, state, start, end)
+            read.extend(bytes(record.data) for record in chunk)
+    assert read == [record.data for record in records]
+
+
+@pytest.mark.parametrize(
+    "data, reason",
+    [
+        (b"", "Empty capture"),
+        (b"Just some notes\n", "Unsupported capture format"),
+        (b"\xd4\xc3\xb2\xa1\x02\x00", "Truncated pcap header"),
+    ],
+)
+def test_files_that_are_not_captures_are_refused(tmp_path, data, reason):
+    path = tmp_path / "capture.pcap"
+    path.write_bytes(data)
+    with pytest.raises(ValueError, match=reason):
+        check_capture(str(path))
+
+
+def test_capture_without_records_is_fine(tmp_path):
+    path = tmp_path / "capture.pcap"
+    write_capture(str(path), [])
+    assert len(path.read_bytes()) == PCAP_HEADER_LEN
+    check_capture(str(path))
+    assert read_records(path) == []
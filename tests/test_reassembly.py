@@ -0,0 +1,32 @@
+import random
+import pytest
+from sessions import iter_sessions
+from synthetic import _Flow, client_hello, server_hello, MSS, TCP_ACK, TCP_PSH
+
+
+def get_split_handshake(gap):
+    # (timestamp, frame) of a Client Hello of three segments `gap` seconds
+    # apart and the Server Hello 20 ms after the last one
+    rng = random.Random(2)
+    flow = _Flow(rng, 0, 1)
+    hello = client_hello(rng, 0x0304, 0x1301, "split.example.com", split=True)
+    segments = [hello[pos : pos + MSS] for pos in range(0, len(hello), MSS)]
+    assert len(segments) == 2
+    segments.insert(1, segments[0][MSS // 2 :])
+    segments[0] = segments[0][: MSS // 2]
+    frames = [
+        (10.0 + i * gap, flow.from_client(TCP_ACK | TCP_PSH, segment))
+        for i, segment in enumerate(segments)
+    ]
+    answer = server_hello(rng, 0x0304, 0x1301)
+    frames.append((frames[-1][0] + 0.02, flow.from_server(TCP_ACK | TCP_PSH, answer)))
+    return frames
+
+
+@pytest.mark.parametrize("gap", [0.005, 0.5])
+def test_split_hello_is_timed_from_its_first_segment(gap):
+    sessions = list(iter_sessions(get_split_handshake(gap), name="split"))
+    assert len(sessions) == 1
+    assert sessions[0].server_name == "split.example.com"
+    assert sessions[0].timestamp == 10.0
+    assert sessions[0].handshake_rtt_ms == pytest.approx(2 * gap * 1000 + 20.0)
@@ -0,0 +1,131 @@
+import http.client
+import json
+import os
+import struct
+import threading
+import time
+import pytest
+from pcapreader import PCAPNG_EPB
+from pcapwriter import PcapngWriter
+from service import AnalysisService, ServiceSettings, _Server, _Handler
+from synthetic import iter_synthetic_records, write_capture
+
+FIELDS = ["capture_file", "tcp_stream_id", "server_name", "negotiated_tls_version"]
+FLOWS = 20
+
+
+@pytest.fixture
+def service():
+    settings = ServiceSettings("csv", FIELDS, {}, {}, None, 10, None)
+    service = AnalysisService(settings, workers=1)
+    server = _Server(("127.0.0.1", 0), _Handler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield service, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def post(port, request):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("POST", "/jobs", json.dumps(request))
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def wait(service, job_id):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        job = service.get(job_id)
+        if job["state"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} still {job['state']}")
+
+
+def write_synthetic_capture(path):
+    write_capture(str(path), iter_synthetic_records(FLOWS, seed=1))
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_post_rejects_files_that_are_not_captures(tmp_path, service):
+    _, port = service
+    notes = tmp_path / "notes.txt"
+    notes.write_text("Keep me\n")
+    other = tmp_path / "other.conf"
+    other.write_text("keep = me\n")
+
+    status, response = post(port, {"capture": str(notes), "output": "other.conf"})
+    assert status == 400
+    assert response["error"].endswith("Unsupported capture format")
+    status, response = post(port, {"capture": str(tmp_path / "missing.pcap")})
+    assert status == 400
+    assert notes.read_text() == "Keep me\n"
+    assert other.read_text() == "keep = me\n"
+
+
+@pytest.mark.parametrize(
+    "output",
+    ["/tmp/report.csv", "../report.csv", "sub/../../report.csv", ".", 5, "in.pcap"],
+)
+def test_post_keeps_reports_inside_the_directory(tmp_path, service, output):
+    _, port = service
+    directory = tmp_path / "captures"
+    directory.mkdir()
+    capture = directory / "in.pcap"
+    write_synthetic_capture(capture)
+    before = read(capture)
+
+    status, _ = post(port, {"capture": str(capture), "output": output})
+    assert status == 400
+    assert read(capture) == before
+    assert sorted(os.listdir(tmp_path)) == ["captures"]
+    assert os.listdir(directory) == ["in.pcap"]
+
+
+def test_post_only_replaces_reports_of_the_service(tmp_path, service):
+    service, port = service
+    capture = tmp_path / "in.pcap"
+    write_synthetic_capture(capture)
+    existing = tmp_path / "existing.csv"
+    existing.write_text("Keep me\n")
+
+    status, _ = post(port, {"capture": str(capture), "output": "existing.csv"})
+    assert status == 400
+    assert existing.read_text() == "Keep me\n"
+    for _ in range(2):
+        status, job = post(port, {"capture": str(capture), "output": "report.csv"})
+        assert status == 202
+        job = wait(service, job["id"])
+        assert job["state"] == "done"
+    # Replaced rather than appended to
+    lines = (tmp_path / "report.csv").read_text().splitlines()
+    assert lines[0] == ",".join(FIELDS)
+    assert len(lines) == 1 + job["result"]["sessions"] > 1
+
+
+def test_failed_job_leaves_nothing_behind(tmp_path, service):
+    service, port = service
+    capture = tmp_path / "broken.pcapng"
+    # A packet of an interface that was never declared, the header is fine
+    with open(capture, "wb") as f:
+        writer = PcapngWriter(f)
+        writer._block(PCAPNG_EPB, struct.pack("<IIIII", 3, 0, 0, 4, 4) + b"\x00" * 4)
+
+    status, job = post(port, {"capture": str(capture)})
+    assert status == 202
+    job = wait(service, job["id"])
+    assert job["state"] == "failed"
+    assert os.listdir(tmp_path) == ["broken.pcapng"]
+    # A report of the same name can still be written once the capture is fixed
+    write_synthetic_capture(capture)
+    status, job = post(port, {"capture": str(capture)})
+    assert status == 202
+    assert wait(service, job["id"])["state"] == "done"
+    assert sorted(os.listdir(tmp_path)) == ["broken.csv", "broken.pcapng"]
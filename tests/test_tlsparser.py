@@ -0,0 +1,69 @@
+import hashlib
+import struct
+from synthetic import _extension, _vector, _ids, _handshake_record, GREASE
+from tlsparser import parse_hello, get_ja3, get_ja3s
+
+
+def build_client_hello(version, cipher_suites, extensions):
+    body = (
+        struct.pack("!H", version)
+        + bytes(32)
+        + _vector(b"", 1)
+        + _vector(_ids(cipher_suites))
+        + b"\x01\x00"
+    )
+    if extensions is not None:
+        body += _vector(b"".join(extensions))
+    return _handshake_record(0x0301, 1, body)
+
+
+def build_server_hello(version, cipher_suite, extensions):
+    body = (
+        struct.pack("!H", version)
+        + bytes(32)
+        + _vector(b"", 1)
+        + struct.pack("!HB", cipher_suite, 0)
+        + _vector(b"".join(extensions))
+    )
+    return _handshake_record(version, 2, body)
+
+
+def test_ja3_of_the_reference_client_hello():
+    # The example of the JA3 README, with GREASE values thrown in
+    hello = build_client_hello(
+        0x0301,
+        [GREASE, 47, 53, 5, 10, 49161, 49162, 49171, 49172, 50, 56, 19, 4],
+        [
+            _extension(0x1A1A, b""),
+            _extension(0, _vector(b"\x00" + _vector(b"example.com"))),
+            _extension(10, _vector(_ids([0x2A2A, 23, 24, 25]))),
+            _extension(11, b"\x01\x00"),
+        ],
+    )
+    assert get_ja3(parse_hello(hello)) == "ada70206e40642a3e4461f35503241d5"
+
+
+def test_ja3_of_a_client_hello_without_extensions():
+    # 769,4-5-10-9-100-98-3-6-19-18-99,,, from the JA3 README
+    hello = build_client_hello(
+        0x0301, [4, 5, 10, 9, 100, 98, 3, 6, 19, 18, 99], None
+    )
+    assert get_ja3(parse_hello(hello)) == "de350869b8c85de67a350c8d186f11e6"
+
+
+def test_ja3s_is_version_cipher_suite_and_extensions():
+    hello = build_server_hello(
+        0x0301,
+        47,
+        [
+            _extension(65281, b"\x00"),
+            _extension(0, b""),
+            _extension(11, b"\x01\x00"),
+            _extension(0xDADA, b""),
+            _extension(35, b""),
+            _extension(5, b""),
+            _extension(16, _vector(_vector(b"h2", 1))),
+        ],
+    )
+    expected = hashlib.md5(b"769,47,65281-0-11-35-5-16").hexdigest()
+    assert get_ja3s(parse_hello(hello)) == expected
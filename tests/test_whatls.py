@@ -0,0 +1,36 @@
+import whatls
+from synthetic import iter_synthetic_records, write_capture
+
+
+def run(*args):
+    return whatls.main(["whatls.py", *map(str, args)])
+
+
+def test_captures_that_cant_be_read_are_skipped(tmp_path, capsys):
+    good = tmp_path / "good.pcap"
+    write_capture(str(good), iter_synthetic_records(50, seed=8))
+    empty = tmp_path / "empty.pcap"
+    empty.write_bytes(b"")
+    notes = tmp_path / "notes.txt"
+    notes.write_text("Not a capture\n")
+    missing = tmp_path / "missing.pcap"
+    assert run(good, "-o", tmp_path / "expected.csv") == 0
+    capsys.readouterr()
+
+    assert run(empty, notes, missing, good, "-o", tmp_path / "report.csv") == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:3] == [
+        f"Skipping {empty}: Empty capture",
+        f"Skipping {notes}: Unsupported capture format",
+        f"Skipping {missing}: No such file or directory",
+    ]
+    expected = (tmp_path / "expected.csv").read_text()
+    assert (tmp_path / "report.csv").read_text() == expected
+
+
+def test_no_report_without_a_capture_to_read(tmp_path, capsys):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("Not a capture\n")
+    assert run(notes) == 1
+    assert capsys.readouterr().out == f"Skipping {notes}: Unsupported capture format\n"
+    assert not (tmp_path / "notes.csv").exists()
@@ -0,0 +1,358 @@
+import hashlib
+import struct
+from collections import namedtuple
+from mappings import TLS_VERSIONS, CIPHER_SUITES
+
+CONTENT_TYPE_HANDSHAKE = 0x16
+HANDSHAKE_CLIENT_HELLO = 1
+HANDSHAKE_SERVER_HELLO = 2
+RECORD_HEADER_LEN = 5
+HANDSHAKE_HEADER_LEN = 4
+# A TLS 1.3 HelloRetryRequest is a Server Hello carrying this fixed random
+HELLO_RETRY_REQUEST_RANDOM = bytes.fromhex(
+    "cf21ad74e59a6111be1d8c021e65b891c2a211167abb8c5e079e09e2c8a8339c"
+)
+
+EXTENSION_SERVER_NAME = 0
+EXTENSION_SUPPORTED_GROUPS = 10
+EXTENSION_EC_POINT_FORMATS = 11
+EXTENSION_ALPN = 16
+EXTENSION_SUPPORTED_VERSIONS = 43
+SERVER_NAME_HOST = 0
+
+EXTENSION_NAMES = {
+    0: "server_name",
+    5: "status_request",
+    10: "supported_groups",
+    11: "ec_point_formats",
+    13: "signature_algorithms",
+    16: "application_layer_protocol_negotiation",
+    18: "signed_certificate_timestamp",
+    21: "padding",
+    22: "encrypt_then_mac",
+    23: "extended_master_secret",
+    27: "compress_certificate",
+    35: "session_ticket",
+    41: "pre_shared_key",
+    43: "supported_versions",
+    45: "psk_key_exchange_modes",
+    51: "key_share",
+    65281: "renegotiation_info",
+}
+
+ClientHello = namedtuple(
+    "ClientHello",
+    [
+        "record_version",
+        "version",
+        "random",
+        "session_id",
+        "cipher_suites",
+        "compression_methods",
+        "extensions",
+        "raw",
+    ],
+)
+ServerHello = namedtuple(
+    "ServerHello",
+    [
+        "record_version",
+        "version",
+        "random",
+        "session_id",
+        "cipher_suite",
+        "compression_method",
+        "extensions",
+        "raw",
+    ],
+)
+
+
+def is_handshake_record(payload):
+    return (
+        len(payload) >= RECORD_HEADER_LEN
+        and payload[0] == CONTENT_TYPE_HANDSHAKE
+        and payload[1] == 3
+    )
+
+
+def is_hello_retry_request(hello):
+    return isinstance(hello, ServerHello) and hello.random == HELLO_RETRY_REQUEST_RANDOM
+
+
+def get_handshake_message(data):
+    # The first handshake message of a run of handshake records, as a single
+    # record parse_hello can take, or None while more bytes are needed. Large
+    # hellos span several TCP segments, and may be split over several records.
+    if len(data) < RECORD_HEADER_LEN + HANDSHAKE_HEADER_LEN:
+        return None
+    record_len = struct.unpack("!H", data[3:5])[0]
+    msg_len = HANDSHAKE_HEADER_LEN + struct.unpack("!I", b"\x00" + data[6:9])[0]
+    if record_len >= msg_len:
+        # The usual case, no need to copy anything
+        if len(data) < RECORD_HEADER_LEN + msg_len:
+            return None
+        return data
+    message = bytearray()
+    pos = 0
+    while len(message) < msg_len:
+        if len(data) < pos + RECORD_HEADER_LEN:
+            return None
+        if data[pos] != CONTENT_TYPE_HANDSHAKE:
+            # Not a fragmented handshake after all, let parse_hello make of it
+            # what it can
+            break
+        record_len = struct.unpack("!H", data[pos + 3 : pos + 5])[0]
+        fragment = data[pos + RECORD_HEADER_LEN : pos + RECORD_HEADER_LEN + record_len]
+        if len(fragment) < record_len and len(message) + len(fragment) < msg_len:
+            return None
+        message += fragment
+        pos += RECORD_HEADER_LEN + record_len
+    message = bytes(message[:msg_len])
+    return data[:3] + struct.pack("!H", len(message)) + message
+
+
+def get_handshake_length(payload):
+    # How many bytes of the TCP stream the first handshake message of the
+    # payload takes, counting the headers of the records it is split over
+    record_len = struct.unpack("!H", payload[3:5])[0]
+    if len(payload) < RECORD_HEADER_LEN + HANDSHAKE_HEADER_LEN or not record_len:
+        return RECORD_HEADER_LEN + record_len
+    msg_len = HANDSHAKE_HEADER_LEN + struct.unpack("!I", b"\x00" + payload[6:9])[0]
+    records = -(-msg_len // record_len)
+    return msg_len + records * RECORD_HEADER_LEN
+
+
+def parse_hello(payload):
+    # Decodes the first handshake message of a TLS record. Hellos cut short by
+    # the end of the segment are decoded as far as the available bytes go.
+    if not is_handshake_record(payload) or len(payload) < 6:
+        return None
+    record_version = struct.unpack("!H", payload[1:3])[0]
+    record_len = struct.unpack("!H", payload[3:5])[0]
+    msg_type = payload[5]
+    if msg_type not in (HANDSHAKE_CLIENT_HELLO, HANDSHAKE_SERVER_HELLO):
+        return None
+    raw = bytes(payload[RECORD_HEADER_LEN : RECORD_HEADER_LEN + record_len])
+    if len(raw) >= HANDSHAKE_HEADER_LEN:
+        msg_len = struct.unpack("!I", b"\x00" + raw[1:4])[0]
+        raw = raw[: HANDSHAKE_HEADER_LEN + msg_len]
+    body = raw[HANDSHAKE_HEADER_LEN:]
+    if msg_type == HANDSHAKE_CLIENT_HELLO:
+        return _parse_client_hello(record_version, body, raw)
+    return _parse_server_hello(record_version, body, raw)
+
+
+def _parse_client_hello(record_version, body, raw):
+    version = struct.unpack("!H", body[0:2])[0] if len(body) >= 2 else None
+    random = body[2:34]
+    pos = 34
+    session_id, pos = _read_vector(body, pos, 1)
+    suites, pos = _read_vector(body, pos, 2)
+    cipher_suites = tuple(
+        struct.unpack("!%dH" % (len(suites) // 2), suites[: len(suites) // 2 * 2])
+    )
+    compression, pos = _read_vector(body, pos, 1)
+    extensions = _parse_extensions(body, pos)
+    return ClientHello(
+        record_version,
+        version,
+        random,
+        session_id,
+        cipher_suites,
+        tuple(compression),
+        extensions,
+        raw,
+    )
+
+
+def _parse_server_hello(record_version, body, raw):
+    if len(body) < 35:
+        return None
+    version = struct.unpack("!H", body[0:2])[0]
+    random = body[2:34]
+    session_id, pos = _read_vector(body, 34, 1)
+    if len(body) < pos + 3:
+        return None
+    cipher_suite = struct.unpack("!H", body[pos : pos + 2])[0]
+    compression_method = body[pos + 2]
+    extensions = _parse_extensions(body, pos + 3)
+    return ServerHello(
+        record_version,
+        version,
+        random,
+        session_id,
+        cipher_suite,
+        compression_method,
+        extensions,
+        raw,
+    )
+
+
+def _read_vector(data, pos, length_size):
+    if len(data) < pos + length_size:
+        return b"", len(data)
+    length = int.from_bytes(data[pos : pos + length_size], "big")
+    start = pos + length_size
+    return data[start : start + length], start + length
+
+
+def _parse_extensions(body, pos):
+    block, _ = _read_vector(body, pos, 2)
+    extensions = []
+    pos = 0
+    while pos + 4 <= len(block):
+        ext_type, ext_len = struct.unpack("!HH", block[pos : pos + 4])
+        extensions.append((ext_type, block[pos + 4 : pos + 4 + ext_len]))
+        pos += 4 + ext_len
+    return tuple(extensions)
+
+
+def get_server_name(hello):
+    # The host name a Client Hello asks for (SNI), or None
+    for ext_type, ext_data in hello.extensions:
+        if ext_type != EXTENSION_SERVER_NAME:
+            continue
+        names, _ = _read_vector(ext_data, 0, 2)
+        pos = 0
+        while pos + 3 <= len(names):
+            name_type = names[pos]
+            name, pos = _read_vector(names, pos + 1, 2)
+            if name_type == SERVER_NAME_HOST:
+                return name.decode("ascii", "replace")
+    return None
+
+
+def get_extension(hello, ext_type):
+    for extension in hello.extensions:
+        if extension[0] == ext_type:
+            return extension[1]
+    return None
+
+
+def is_grease(value):
+    # RFC 8701 values clients sprinkle in to keep servers tolerant, 0x?a?a
+    return value & 0x0F0F == 0x0A0A and value >> 8 == value & 0xFF
+
+
+def _read_ids(data, length_size, id_format="H"):
+    ids, _ = _read_vector(data, 0, length_size)
+    size = struct.calcsize(id_format)
+    count = len(ids) // size
+    return struct.unpack("!%d%s" % (count, id_format), ids[: count * size])
+
+
+def get_alpn(hello):
+    # The protocols a Client Hello offers, or the one a Server Hello selects
+    data = get_extension(hello, EXTENSION_ALPN)
+    if data is None:
+        return []
+    protocols = []
+    names, _ = _read_vector(data, 0, 2)
+    pos = 0
+    while pos < len(names):
+        name, pos = _read_vector(names, pos, 1)
+        protocols.append(name.decode("ascii", "replace"))
+    return protocols
+
+
+def get_supported_versions(hello):
+    # The versions a Client Hello offers in supported_versions, without
+    # GREASE, or an empty list for clients that predate TLS 1.3
+    data = get_extension(hello, EXTENSION_SUPPORTED_VERSIONS)
+    if data is None:
+        return []
+    return [version for version in _read_ids(data, 1) if not is_grease(version)]
+
+
+def get_negotiated_version(hello):
+    # TLS 1.3 servers keep 0x0303 in the version field for the sake of
+    # middleboxes and select the actual version in supported_versions
+    data = get_extension(hello, EXTENSION_SUPPORTED_VERSIONS)
+    if data is not None and len(data) >= 2:
+        return struct.unpack("!H", data[:2])[0]
+    return hello.version
+
+
+def get_ja3(hello):
+    # JA3 fingerprint of a Client Hello: the MD5 of its version, cipher
+    # suites, extensions, groups and point formats in decimal, without GREASE
+    groups = get_extension(hello, EXTENSION_SUPPORTED_GROUPS)
+    formats = get_extension(hello, EXTENSION_EC_POINT_FORMATS)
+    fields = [
+        [hello.version or 0],
+        hello.cipher_suites,
+        [extension[0] for extension in hello.extensions],
+        _read_ids(groups, 2) if groups is not None else (),
+        _read_ids(formats, 1, "B") if formats is not None else (),
+    ]
+    return _fingerprint(fields)
+
+
+def get_ja3s(hello):
+    # JA3S fingerprint of a Server Hello: version, cipher suite and extensions
+    fields = [
+        [hello.version],
+        [hello.cipher_suite],
+        [extension[0] for extension in hello.extensions],
+    ]
+    return _fingerprint(fields)
+
+
+def _fingerprint(fields):
+    text = ",".join(
+        "-".join(str(value) for value in values if not is_grease(value))
+        for values in fields
+    )
+    return hashlib.md5(text.encode("ascii")).hexdigest()
+
+
+def tls_version_name(version):
+    entry = TLS_VERSIONS[version]
+    return entry.name if entry is not None else "0x%08x" % version
+
+
+def cipher_suite_name(cipher_suite):
+    entry = CIPHER_SUITES[cipher_suite]
+    return entry.name if entry is not None else hex(cipher_suite)
+
+
+def format_version(version):
+    if version is None:
+        return "Unknown"
+    entry = TLS_VERSIONS[version]
+    name = entry.name if entry is not None else "Unknown"
+    return f"{name} ({'0x%04x' % version})"
+
+
+def format_cipher_suite(cipher_suite):
+    entry = CIPHER_SUITES[cipher_suite]
+    name = entry.name if entry is not None else "Unknown"
+    return f"{name} ({'0x%04x' % cipher_suite})"
+
+
+def format_hello(hello):
+    # Renders a hello in the spirit of tshark's layer dump used by the
+    # pyshark backend for the client_hello/server_hello columns.
+    lines = [
+        "Layer TLS:",
+        f"\tContent Type: Handshake ({CONTENT_TYPE_HANDSHAKE})",
+        f"\tVersion: {format_version(hello.record_version)}",
+    ]
+    if isinstance(hello, ClientHello):
+        lines.append(f"\tHandshake Type: Client Hello ({HANDSHAKE_CLIENT_HELLO})")
+    else:
+        lines.append(f"\tHandshake Type: Server Hello ({HANDSHAKE_SERVER_HELLO})")
+    lines.append(f"\tVersion: {format_version(hello.version)}")
+    lines.append(f"\tRandom: {hello.random.hex()}")
+    lines.append(f"\tSession ID Length: {len(hello.session_id)}")
+    if isinstance(hello, ClientHello):
+        lines.append(f"\tCipher Suites ({len(hello.cipher_suites)} suites)")
+        for cipher_suite in hello.cipher_suites:
+            lines.append(f"\tCipher Suite: {format_cipher_suite(cipher_suite)}")
+    else:
+        lines.append(f"\tCipher Suite: {format_cipher_suite(hello.cipher_suite)}")
+    for ext_type, ext_data in hello.extensions:
+        name = EXTENSION_NAMES.get(ext_type, "Unknown type %d" % ext_type)
+        lines.append(f"\tExtension: {name} (len={len(ext_data)})")
+    return "\n".join(lines)
@@ -2,114 +2,784 @@
 
 import sys
 import os
-import pyshark
-import csv
-from mappings import TLS_VERSION_MAPPING, CIPHER_SUITE_MAPPING
-
-
-def get_ssl_streams(cap):
-    ssl_handshake_packets = []
-    handshake_tuples_list = []
-    for pkt in cap:
-        # try it for SSL packets
-        # try:
-        #     if (
-        #         pkt.highest_layer == "SSL"
-        #         and pkt.ssl.get_field("handshake") is not None
-        #     ) and (
-        #         "Client Hello" in pkt.ssl.get_field("handshake")
-        #         or "Server Hello" in pkt.ssl.get_field("handshake")
-        #     ):
-        #         ssl_handshake_packets.append(pkt)
-        # except Exception:
-        #     print("No SSL higher layers found")
-
-        # try it for TLS packets
-        if (
-            pkt.highest_layer == "TLS" and pkt.tls.get_field("handshake") is not None
-        ) and (
-            "Client Hello" in pkt.tls.get_field("handshake")
-            or "Server Hello" in pkt.tls.get_field("handshake")
-        ):
-            ssl_handshake_packets.append(pkt)
-
-    match = False
-    for i in ssl_handshake_packets:
-        client_hello_pkt = None
-        server_hello_pkt = None
-        if "Client Hello" in i.tls.get_field("handshake"):
-            client_hello_pkt = i
-            client_hello_stream = int(i.tcp.stream)
-            for j in ssl_handshake_packets:
-                if (
-                    "Server Hello" in j.tls.get_field("handshake")
-                    and int(j.tcp.stream) == client_hello_stream
-                ):
-                    server_hello_pkt = j
-                if client_hello_pkt is not None and server_hello_pkt is not None:
-                    handshake_tuples_list.append((client_hello_pkt, server_hello_pkt))
-                    match = True
-                    if match:
-                        break
-
-    return handshake_tuples_list
-
-
-def get_negotiated_tls_version(pkt):
-    try:
-        return TLS_VERSION_MAPPING[str(pkt.tls.get_field("handshake_version"))]
-    except KeyError:
-        return str(pkt.ssl.get_field("handshake_version"))
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from parallel import expand_captures, iter_parallel_captures
+from live import LiveCapture, ReplayCapture, run_live
+from bpf import SSL_FILTER_FILE, read_filter_file, compile_filter
+from prefilter import Prefilter
+from writers import open_writer, WRITERS, HELLO_TEXT_FIELDS, DEFAULT_ROW_GROUP_SIZE
+from cache import ResultCache, DEFAULT_CACHE_PATH
+from checkpoint import Checkpoint, iter_resumed_pairs
+from pcapreader import check_capture
+from reassembly import HandshakeReassembler
+from pairing import HandshakePairer
+from summary import (
+    SessionSummary,
+    write_summary,
+    get_summary_format,
+    SUMMARY_WRITERS,
+    DEFAULT_TOP,
+)
+from stats import open_stats, get_capture_counts, PipelineStats, Profiler
+from sessions import iter_sessions, get_native_session
+from service import (
+    AnalysisService,
+    ServiceSettings,
+    run_service,
+    format_job,
+    parse_address,
+    DEFAULT_PORT,
+    DEFAULT_QUEUE_SIZE,
+)
+
+try:
+    import pyshark
+except ImportError:
+    # pyshark is only needed for the tshark backend
+    pyshark = None
+
+try:
+    import pyarrow
+except ImportError:
+    # pyarrow is only needed for Parquet reports
+    pyarrow = None
+
+# Bump whenever a change to parsing or pairing changes the rows of a capture,
+# results cached by earlier versions are ignored from then on
+PARSER_VERSION = 8
+
+# Seconds between saves of the checkpoint while reading a capture
+CHECKPOINT_INTERVAL = 10.0
+
+FIELDS = [
+    "capture_file",
+    "tcp_stream_id",
+    "timestamp",
+    "client_ip",
+    "client_port",
+    "server_ip",
+    "server_port",
+    "server_name",
+    "negotiated_tls_version",
+    "negotiated_cipher_suite",
+    "negotiated_alpn",
+    "handshake_rtt_ms",
+    "offered_tls_versions",
+    "offered_cipher_suites",
+    "offered_alpn",
+    "ja3",
+    "ja3s",
+    "client_hello",
+    "server_hello",
+]
+
+
+def get_hello_text_limit(options):
+    if options.hello_text == "drop":
+        return 0
+    if options.hello_text == "truncate":
+        return options.hello_text_limit
+    return None
+
+
+def get_fields(options):
+    if options.hello_text == "drop":
+        return [field for field in FIELDS if field not in HELLO_TEXT_FIELDS]
+    return FIELDS
+
+
+def get_writer_options(options):
+    writer_options = {"flush_every": options.flush_every}
+    if options.format == "parquet":
+        writer_options["row_group_size"] = options.row_group_size
+    return writer_options
+
+
+def get_reassembler(options):
+    return HandshakeReassembler(
+        options.max_hello_size * 1024, options.reassembly_buffer * 1024 * 1024
+    )
+
+
+def get_prefilter(options):
+    if not options.prefilter:
+        return None
+    return Prefilter(read_filter_file(options.bpf_file))
+
+
+def get_session_options(options):
+    # iter_sessions arguments for the command line options
+    return {
+        "backend": options.backend,
+        "flow_timeout": options.flow_timeout,
+        "max_flows": options.max_flows,
+        "max_hello_bytes": options.max_hello_size * 1024,
+        "reassembly_bytes": options.reassembly_buffer * 1024 * 1024,
+        "hello_text_limit": get_hello_text_limit(options),
+    }
+
+
+def iter_session_data(cap_file, options, prefilter=None, stats=None):
+    return iter_sessions(
+        cap_file, prefilter=prefilter, stats=stats, **get_session_options(options)
+    )
+
+
+def get_capture_session_data(options, cap_file, counted=False):
+    # Runs in a worker, with counted the stats counters come back too
+    prefilter = get_prefilter(options)
+    stats = PipelineStats() if counted else None
+    rows = list(iter_session_data(cap_file, options, prefilter, stats))
+    kept, dropped = (prefilter.kept, prefilter.dropped) if prefilter else (0, 0)
+    return rows, kept, dropped, stats.counters if counted else None
+
+
+def iter_parallel_session_data(captures, options, prefilter=None, stats=None):
+    # Yields (capture, session rows) for each capture in order
+    if options.backend == "pyshark":
+        # tshark reads a capture front to back, so split the work by file
+        with ProcessPoolExecutor(options.jobs) as executor:
+            worker = partial(
+                get_capture_session_data, options, counted=stats is not None
+            )
+            results = executor.map(worker, captures)
+            for cap_file, (rows, kept, dropped, counters) in zip(captures, results):
+                if prefilter is not None:
+                    prefilter.kept += kept
+                    prefilter.dropped += dropped
+                if stats is not None:
+                    stats.add_counts(counters)
+                yield cap_file, iter(rows)
+        return
+    hello_text_limit = get_hello_text_limit(options)
+    captures = iter_parallel_captures(
+        captures,
+        options.jobs,
+        options.chunk_size * 1024 * 1024,
+        options.flow_timeout,
+        options.max_flows,
+        prefilter,
+        options.max_hello_size * 1024,
+        options.reassembly_buffer * 1024 * 1024,
+        stats,
+    )
+    for cap_file, pairs in captures:
+        if stats is not None:
+            # Waiting for the workers to read, dissect and pair
+            pairs = stats.pair(pairs, None, "workers")
+        rows = (
+            get_native_session(
+                cap_file, client_hello, server_hello, hello_text_limit
+            )
+            for client_hello, server_hello in pairs
+        )
+        if stats is not None:
+            rows = stats.extract(rows, "workers")
+        yield cap_file, rows
+
+
+def iter_capture_session_data(captures, options, prefilter=None, stats=None):
+    if options.jobs > 1:
+        yield from iter_parallel_session_data(captures, options, prefilter, stats)
+        return
+    for cap_file in captures:
+        yield cap_file, iter_session_data(cap_file, options, prefilter, stats)
+
+
+def get_cache_variant(options):
+    # Everything besides the capture itself that changes its rows
+    expression = read_filter_file(options.bpf_file) if options.prefilter else None
+    return json.dumps(
+        [
+            PARSER_VERSION,
+            options.backend,
+            options.flow_timeout,
+            options.max_flows,
+            get_hello_text_limit(options),
+            expression,
+            options.max_hello_size,
+            options.reassembly_buffer,
+        ]
+    )
+
 
+def iter_cached_session_data(captures, options, cache, prefilter=None, stats=None):
+    # Captures seen before are answered from the cache, the rest are analyzed
+    # and their rows stored once the whole capture has been read
+    variant = get_cache_variant(options)
+    cached = [cache.contains(cap_file, variant) for cap_file in captures]
+    analyzed = iter_capture_session_data(
+        [cap_file for cap_file, hit in zip(captures, cached) if not hit],
+        options,
+        prefilter,
+        stats,
+    )
+    for cap_file, hit in zip(captures, cached):
+        rows = cache.get(cap_file, variant) if hit else None
+        if rows is not None:
+            yield from rows
+            continue
+        if hit:
+            # Evicted since, by another run sharing the cache
+            rows = iter_session_data(cap_file, options, prefilter, stats)
+        else:
+            _, rows = next(analyzed)
+        entry = cache.entry(cap_file, variant)
+        for session_data in rows:
+            entry.add(session_data)
+            yield session_data
+        entry.commit()
 
-def get_negotiated_cipher_suite(pkt):
+
+def get_readable_captures(captures):
+    # Leaves out the captures that can't be read, before the report is opened
+    # and with a message, so the others still get reported
+    readable = []
+    for cap_file in captures:
+        try:
+            check_capture(cap_file)
+        except OSError as e:
+            print(f"Skipping {cap_file}: {e.strerror or e}")
+        except ValueError as e:
+            print(f"Skipping {cap_file}: {e}")
+        else:
+            readable.append(cap_file)
+    return readable
+
+
+def iter_resumed_session_data(
+    cap_file, options, checkpoint, prefilter=None, stats=None
+):
+    hello_text_limit = get_hello_text_limit(options)
+    progress = checkpoint.progress(
+        cap_file,
+        options.flow_timeout,
+        options.max_flows,
+        options.max_hello_size * 1024,
+        options.reassembly_buffer * 1024 * 1024,
+    )
+    since = get_capture_counts(progress.pairer, progress.reassembler, final=True)
+    for client_hello, server_hello in iter_resumed_pairs(
+        cap_file, progress, prefilter, stats
+    ):
+        yield get_native_session(
+            cap_file, client_hello, server_hello, hello_text_limit
+        )
+    if stats is not None:
+        stats.add_capture(progress.pairer, progress.reassembler, since)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(args[0]),
+        description="Report the TLS versions and cipher suites used in a capture.",
+    )
+    parser.add_argument(
+        "captures",
+        nargs="*",
+        metavar="capture",
+        help="pcap or pcapng files, or directories of them, to analyze",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["native", "pyshark"],
+        default="native",
+        help="parse the capture directly (default) or dissect it with tshark",
+    )
+    parser.add_argument(
+        "--flow-timeout",
+        type=float,
+        default=300.0,
+        help="seconds of capture time to wait for a Server Hello (default: 300)",
+    )
+    parser.add_argument(
+        "--max-flows",
+        type=int,
+        default=100000,
+        help="half-open handshakes to track before evicting the oldest",
+    )
+    parser.add_argument(
+        "--max-hello-size",
+        type=int,
+        default=16,
+        help="KB of a hello split over several packets to collect (default: 16)",
+    )
+    parser.add_argument(
+        "--reassembly-buffer",
+        type=int,
+        default=64,
+        help="MB of split hellos to hold before dropping the oldest (default: 64)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="report file (default: the capture name with the format extension, "
+        "or whatls_report for several captures)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(WRITERS),
+        default="csv",
+        help="report format (default: csv)",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=DEFAULT_ROW_GROUP_SIZE,
+        help="rows per row group of Parquet reports "
+        f"(default: {DEFAULT_ROW_GROUP_SIZE})",
+    )
+    parser.add_argument(
+        "--hello-text",
+        choices=["full", "truncate", "drop"],
+        default="drop",
+        help="add the client_hello/server_hello text dumps in full or truncated "
+        "(default: leave them out)",
+    )
+    parser.add_argument(
+        "--hello-text-limit",
+        type=int,
+        default=512,
+        help="characters kept per hello with --hello-text truncate (default: 512)",
+    )
+    parser.add_argument(
+        "--flush-every",
+        type=int,
+        default=100,
+        help="rows written between flushes of the report (default: 100)",
+    )
+    parser.add_argument(
+        "--summary",
+        metavar="PATH",
+        help="also write counts per version, cipher suite, server and server "
+        "name to PATH",
+    )
+    parser.add_argument(
+        "--summary-format",
+        choices=sorted(SUMMARY_WRITERS),
+        help="summary format (default: from the --summary extension, or json)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"servers and server names listed in the summary (default: {DEFAULT_TOP})",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="show a progress line instead of every session, and the counts and "
+        "time of each stage at the end",
+    )
+    parser.add_argument(
+        "--stats-json", metavar="PATH", help="save the counts and timings as JSON"
+    )
+    parser.add_argument(
+        "--profile", metavar="PATH", help="profile the run with cProfile into PATH"
+    )
+    parser.add_argument(
+        "--profile-memory",
+        metavar="PATH",
+        help="trace memory allocations and list the largest ones in PATH",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="worker processes to spread the captures over (default: 1)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="MB of a capture handed to each worker with --jobs (default: 64)",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        default=None,
+        help="drop packets that don't pass --bpf-file before parsing them "
+        "(default with --backend pyshark)",
+    )
+    parser.add_argument(
+        "--no-prefilter",
+        dest="prefilter",
+        action="store_false",
+        help="let pyshark read the whole capture",
+    )
+    parser.add_argument(
+        "--bpf-file",
+        default=SSL_FILTER_FILE,
+        help="filter for --prefilter and live capture (default: ssl_filter.bpf)",
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=DEFAULT_CACHE_PATH,
+        metavar="PATH",
+        help="reuse the results of captures analyzed before "
+        "(default location: ~/.cache/whatls/results.sqlite)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="MB of results to keep before dropping the least recently used "
+        "(default: 1024)",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="forget the cached results of the given captures, or of all "
+        "captures if none are given, and exit",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="PATH",
+        help="save how far each capture was read to PATH and continue from "
+        "there on the next run, appending to the report",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep reading captures as they grow, and new captures in the given "
+        "directories, until interrupted",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5.0,
+        help="seconds between checks for new data with --follow (default: 5)",
+    )
+    live = parser.add_argument_group("live capture")
+    live.add_argument(
+        "--live",
+        metavar="INTERFACE",
+        help="capture from an interface and report counters instead of sessions",
+    )
+    live.add_argument(
+        "--replay",
+        metavar="CAPTURE",
+        help="run live mode over a saved capture instead of an interface",
+    )
+    live.add_argument(
+        "--replay-speed",
+        type=float,
+        help="replay at this multiple of the recorded rate (default: unpaced)",
+    )
+    live.add_argument(
+        "--interval",
+        type=float,
+        default=10.0,
+        help="seconds between counter reports (default: 10)",
+    )
+    live.add_argument(
+        "--buffer-size",
+        type=int,
+        default=64,
+        help="MB of socket buffer before the kernel drops packets (default: 64)",
+    )
+    service = parser.add_argument_group("service")
+    service.add_argument(
+        "--serve",
+        nargs="?",
+        const=str(DEFAULT_PORT),
+        metavar="[HOST:]PORT",
+        help="take jobs and report on them over HTTP on localhost, or the given "
+        f"address (default port: {DEFAULT_PORT})",
+    )
+    service.add_argument(
+        "--spool",
+        metavar="DIRECTORY",
+        help="analyze the captures dropped in this directory, then move them to "
+        "its done or failed subdirectory",
+    )
+    service.add_argument(
+        "--report-dir",
+        metavar="DIRECTORY",
+        help="where jobs write their reports (default: next to the capture, or "
+        "the done subdirectory of the spool)",
+    )
+    service.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="jobs waiting for a worker before new ones are turned away "
+        f"(default: {DEFAULT_QUEUE_SIZE})",
+    )
+    options = parser.parse_args(args[1:])
+    serving = options.serve is not None or options.spool is not None
+    if not options.captures and not (
+        options.live or options.replay or options.clear_cache or serving
+    ):
+        parser.error("a capture, --live, --replay, --serve or --spool is required")
+    if serving:
+        if options.captures or options.output:
+            parser.error("--serve and --spool take captures as jobs instead")
+        if options.checkpoint or options.follow or options.cache or options.summary:
+            parser.error(
+                "--serve and --spool can't be used with --checkpoint, --follow, "
+                "--cache or --summary"
+            )
+        if options.serve is not None:
+            try:
+                parse_address(options.serve)
+            except ValueError as e:
+                parser.error(str(e))
+        if options.spool is not None and not os.path.isdir(options.spool):
+            parser.error(f"{options.spool} is not a directory")
+    if options.checkpoint or options.follow:
+        if options.backend == "pyshark":
+            parser.error("--checkpoint and --follow need --backend native")
+        if options.jobs > 1 or options.cache:
+            parser.error("--checkpoint and --follow can't be used with -j or --cache")
+        if options.format == "parquet":
+            parser.error("--checkpoint and --follow can't append to Parquet reports")
+    if options.summary and options.summary_format is None:
+        # Rather than after the captures were analyzed
+        options.summary_format = get_summary_format(options.summary)
+        if options.summary_format not in SUMMARY_WRITERS:
+            parser.error(
+                f"can't tell the summary format from {options.summary}, use "
+                "--summary-format"
+            )
+    if options.prefilter is None:
+        # pyshark misses sessions in captures that weren't filtered first
+        options.prefilter = options.backend == "pyshark"
+    return options
+
+
+def live_main(options):
+    pairer = HandshakePairer(options.flow_timeout, options.max_flows)
+    if options.replay:
+        capture = ReplayCapture(options.replay, options.replay_speed)
+    else:
+        program = compile_filter(read_filter_file(options.bpf_file))
+        capture = LiveCapture(
+            options.live, program, options.buffer_size * 1024 * 1024
+        )
     try:
-        return CIPHER_SUITE_MAPPING[str(hex(int(pkt.tls.get("handshake_ciphersuite"))))]
-    except KeyError:
-        return str(hex(int(pkt.ssl.get("handshake_ciphersuite"))))
+        run_live(capture, pairer, options.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def service_main(options):
+    # Every job is analyzed with the options of the command line
+    settings = ServiceSettings(
+        options.format,
+        get_fields(options),
+        {"flush_every": options.flush_every, "row_group_size": options.row_group_size},
+        get_session_options(options),
+        read_filter_file(options.bpf_file) if options.prefilter else None,
+        options.top,
+        options.report_dir,
+    )
+    service = AnalysisService(
+        settings,
+        options.jobs,
+        options.queue_size,
+        on_finished=lambda job: print(format_job(job)),
+    )
+    run_service(service, options.serve, options.spool, options.poll_interval)
+
+
+def print_session(session_data):
+    print(
+        f"Found TLS connection! TCP stream {session_data.tcp_stream_id} used {session_data.negotiated_tls_version} and {session_data.negotiated_cipher_suite}"
+    )
+
+
+def follow_main(options, output, fields, prefilter=None, summary=None, stats=None):
+    # Reads each capture from where the checkpoint left it, and with --follow
+    # keeps coming back for more until interrupted. The checkpoint is only
+    # saved between sessions, where the report and the capture state agree.
+    checkpoint = Checkpoint(options.checkpoint)
+    append = checkpoint.resume_report(output)
+    if summary is not None and append and checkpoint.summary is not None:
+        # Carry on counting the sessions already in the report. A checkpoint
+        # saved without --summary has none, then only new sessions count.
+        summary = checkpoint.summary
+        summary.top = options.top
+    with open_writer(
+        output,
+        options.format,
+        fields,
+        flush_every=options.flush_every,
+        append=append,
+    ) as writer:
+        write = writer.write if stats is None else stats.timed("write", writer.write)
+
+        def save():
+            writer.flush()
+            checkpoint.save(output, summary)
+            if summary is not None:
+                write_summary(summary, options.summary, options.summary_format)
+
+        try:
+            while True:
+                last_save = time.monotonic()
+                # Rotation often gzips captures that were already read, under
+                # a new inode, they would be reported twice
+                for cap_file in expand_captures(options.captures, compressed=False):
+                    rows = iter_resumed_session_data(
+                        cap_file, options, checkpoint, prefilter, stats
+                    )
+                    if stats is not None:
+                        rows = stats.extract(rows, "pair")
+                    try:
+                        for session_data in rows:
+                            write(session_data)
+                            report_session(session_data, options, stats)
+                            if summary is not None:
+                                summary.add(session_data)
+                            if time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+                                save()
+                                last_save = time.monotonic()
+                    except FileNotFoundError as e:
+                        if not options.follow:
+                            print(f"Skipping {cap_file}: {e.strerror}")
+                        # Under --follow, rotated away since the directory was
+                        # listed, it comes up under its new name
+                    except ValueError as e:
+                        if options.follow:
+                            # Most likely a capture whose header isn't written
+                            # yet
+                            print(f"Skipping {cap_file} for now: {e}")
+                        else:
+                            print(f"Skipping {cap_file}: {e}")
+                checkpoint.prune()
+                save()
+                if not options.follow:
+                    break
+                time.sleep(options.poll_interval)
+        except KeyboardInterrupt:
+            if not options.follow:
+                raise
+            # The usual way out of --follow, anything read since the last save
+            # is read again on the next run
+
+
+def report_session(session_data, options, stats=None):
+    if stats is not None:
+        stats.add_session()
+    if not options.stats:
+        # The progress line takes the place of these with --stats
+        print_session(session_data)
+
+
+def report_stats(stats, options):
+    stats.finish()
+    if options.stats:
+        print(stats.summary())
+    if options.stats_json:
+        stats.write_json(options.stats_json)
+        print(f"Saved stats to {options.stats_json}")
 
 
 def main(args):
-    cap_file = args[1]
-    filename, _ = os.path.splitext(args[1])
-    cap_file = args[1]
-    cap = pyshark.FileCapture(cap_file, display_filter="ssl")
-    ssl_streams = get_ssl_streams(cap)
-    # print(ssl_streams)
-    ssl_connections = []
-    for stream in ssl_streams:
-        client_hello_pkt = stream[0]
-        server_hello_pkt = stream[1]
-        session_data = {
-            "capture_file": cap_file,
-            "tcp_stream_id": str(client_hello_pkt.tcp.stream),
-            "client_hello": str(client_hello_pkt.tls),
-            "server_hello": str(server_hello_pkt.tls),
-            "negotiated_tls_version": get_negotiated_tls_version(server_hello_pkt),
-            "negotiated_cipher_suite": get_negotiated_cipher_suite(server_hello_pkt),
-        }
-        ssl_connections.append(session_data)
-        print(
-            f"Found TLS connection! TCP stream {client_hello_pkt.tcp.stream} used {session_data['negotiated_tls_version']} and {session_data['negotiated_cipher_suite']}"
+    options = parse_args(args)
+    with Profiler(options.profile, options.profile_memory):
+        return run(options)
+
+
+def run(options):
+    if options.backend == "pyshark" and pyshark is None:
+        print("The pyshark backend requires pyshark, see requirements.txt")
+        return 1
+    if options.format == "parquet" and pyarrow is None:
+        print("Parquet reports require pyarrow, install it with pip install pyarrow")
+        return 1
+    if options.live or options.replay:
+        live_main(options)
+        return 0
+    if options.serve is not None or options.spool is not None:
+        service_main(options)
+        return 0
+    captures = expand_captures(options.captures)
+    if options.clear_cache:
+        cache = ResultCache(options.cache or DEFAULT_CACHE_PATH)
+        # Everything only when no captures were given, not when the given
+        # directories hold none
+        cache.invalidate(captures if options.captures else None)
+        cache.close()
+        if options.captures:
+            print(f"Cleared cached results of {len(captures)} captures")
+        else:
+            print("Cleared cached results")
+        return 0
+    if len(options.captures) == 1 and captures == options.captures:
+        filename, _ = os.path.splitext(captures[0])
+    else:
+        filename = "whatls_report"
+    output = options.output or f"{filename}.{options.format}"
+    fields = get_fields(options)
+    prefilter = get_prefilter(options)
+    summary = SessionSummary(options.top) if options.summary else None
+    stats = open_stats(options.stats, options.stats_json)
+    if options.checkpoint or options.follow:
+        follow_main(options, output, fields, prefilter, summary, stats)
+        if prefilter is not None:
+            print(prefilter.summary())
+        if stats is not None:
+            report_stats(stats, options)
+        print(f"Saved data to {output}")
+        if summary is not None:
+            print(f"Saved summary to {options.summary}")
+        return 0
+    readable = get_readable_captures(captures)
+    if captures and not readable:
+        # Rather than an empty report in place of whatever was there
+        return 1
+    captures = readable
+    cache = None
+    if options.cache:
+        cache = ResultCache(options.cache, options.cache_size * 1024 * 1024)
+        sessions = iter_cached_session_data(
+            captures, options, cache, prefilter, stats
+        )
+    else:
+        sessions = (
+            session_data
+            for _, rows in iter_capture_session_data(
+                captures, options, prefilter, stats
+            )
+            for session_data in rows
         )
 
-    with open(filename + ".csv", "w") as f:
-        keys = ssl_connections[0].keys()
-        dict_writer = csv.DictWriter(f, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(ssl_connections)
+    with open_writer(
+        output, options.format, fields, **get_writer_options(options)
+    ) as writer:
+        write = writer.write if stats is None else stats.timed("write", writer.write)
+        for session_data in sessions:
+            write(session_data)
+            report_session(session_data, options, stats)
+            if summary is not None:
+                summary.add(session_data)
 
-    print(f"Saved data to {filename}.csv")
-    # Fix for asyncio bug with pyshark
-    cap.close()
-    # Fix for asyncio bug that keeps looping over capture
-    sys.exit()
+    if summary is not None:
+        write_summary(summary, options.summary, options.summary_format)
+    if cache is not None:
+        print(f"Reused cached results for {cache.hits} of {len(captures)} captures")
+        cache.close()
+    if prefilter is not None:
+        print(prefilter.summary())
+    if stats is not None:
+        report_stats(stats, options)
+    print(f"Saved data to {output}")
+    if summary is not None:
+        print(f"Saved summary to {options.summary}")
+    return 0
 
 
 if __name__ == "__main__":
-    while True:
-        try:
-            main(sys.argv)
-        except KeyboardInterrupt:
-            print("User canceled. Exiting...")
-            sys.exit(1)
+    try:
+        sys.exit(main(sys.argv))
+    except KeyboardInterrupt:
+        print("User canceled. Exiting...")
+        sys.exit(1)
@@ -0,0 +1,211 @@
+import csv
+import json
+import time
+from operator import attrgetter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # pyarrow is only needed for Parquet reports
+    pyarrow = None
+
+HELLO_TEXT_FIELDS = ("client_hello", "server_hello")
+# Joins list values, e.g. the offered cipher suites, into one CSV cell
+LIST_SEPARATOR = ";"
+# Rows per Parquet row group
+DEFAULT_ROW_GROUP_SIZE = 65536
+# Columns of numeric ids written next to the named ones in Parquet reports
+ID_FIELDS = {
+    "negotiated_tls_version": "negotiated_tls_version_id",
+    "negotiated_cipher_suite": "negotiated_cipher_suite_id",
+}
+
+
+class SessionWriter:
+    # Writes sessions as they are matched instead of collecting them, and
+    # flushes every few rows or seconds so a crash loses at most that much.
+    # With append, rows are added to an existing report. Rows are Sessions,
+    # or anything else with the fields as attributes.
+
+    binary = False
+
+    def __init__(
+        self, path, fields, flush_every=100, flush_interval=1.0, append=False
+    ):
+        self.path = path
+        self.fields = fields
+        self.values = _values_getter(fields)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.rows = 0
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        mode = "a" if append else "w"
+        if self.binary:
+            self.f = open(path, mode + "b")
+        else:
+            self.f = open(path, mode, newline="")
+
+    def write(self, row):
+        self._write(row)
+        self.rows += 1
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every or (
+            time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, row):
+        raise NotImplementedError
+
+
+def _values_getter(fields):
+    # Takes the values of the fields out of a row, always as a tuple
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda row: (getter(row),)
+    return getter
+
+
+class CsvSessionWriter(SessionWriter):
+    def __init__(self, path, fields, **kwargs):
+        super().__init__(path, fields, **kwargs)
+        self.csv_writer = csv.writer(self.f)
+        if not self.f.tell():
+            self.csv_writer.writerow(fields)
+
+    def _write(self, row):
+        self.csv_writer.writerow(
+            [
+                LIST_SEPARATOR.join(value) if type(value) is list else value
+                for value in self.values(row)
+            ]
+        )
+
+
+class JsonlSessionWriter(SessionWriter):
+    def _write(self, row):
+        self.f.write(json.dumps(dict(zip(self.fields, self.values(row)))))
+        self.f.write("\n")
+
+
+def _microseconds(timestamp):
+    return int(round(timestamp * 1000000))
+
+
+def _parquet_schema(fields):
+    # Strings unless listed. Columns with few distinct values are dictionary
+    # encoded, Parquet keeps the dictionary once per row group.
+    pa = pyarrow
+    category = pa.dictionary(pa.int32(), pa.string())
+    types = {
+        "capture_file": category,
+        "tcp_stream_id": pa.int64(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+        "client_port": pa.uint16(),
+        "server_port": pa.uint16(),
+        "server_name": category,
+        "negotiated_tls_version": category,
+        "negotiated_tls_version_id": pa.uint16(),
+        "negotiated_cipher_suite": category,
+        "negotiated_cipher_suite_id": pa.uint16(),
+        "negotiated_alpn": category,
+        "handshake_rtt_ms": pa.float64(),
+        "offered_tls_versions": pa.list_(pa.string()),
+        "offered_cipher_suites": pa.list_(pa.string()),
+        "offered_alpn": pa.list_(pa.string()),
+    }
+    columns = []
+    for field in fields:
+        columns.append((field, types.get(field, pa.string())))
+        if field in ID_FIELDS:
+            columns.append((ID_FIELDS[field], types[ID_FIELDS[field]]))
+    return pa.schema(columns)
+
+
+class ParquetSessionWriter(SessionWriter):
+    # Collects rows column by column and writes them out a row group at a
+    # time, so memory stays bounded by row_group_size. Rows only reach the
+    # file once their row group is full, or on close.
+
+    binary = True
+    conversions = {"timestamp": _microseconds}
+
+    def __init__(
+        self, path, fields, row_group_size=DEFAULT_ROW_GROUP_SIZE, **kwargs
+    ):
+        if kwargs.get("append"):
+            raise ValueError("Parquet reports can't be appended to")
+        super().__init__(path, fields, **kwargs)
+        self.row_group_size = row_group_size
+        self.schema = _parquet_schema(fields)
+        self.columns = [
+            (column.name, self.conversions.get(column.name)) for column in self.schema
+        ]
+        self.column_values = _values_getter(
+            [column for column, _ in self.columns]
+        )
+        self.batch = [[] for _ in self.columns]
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(self.f, self.schema)
+
+    def _write(self, row):
+        row_values = self.column_values(row)
+        for (_, convert), values, value in zip(self.columns, self.batch, row_values):
+            if convert is not None and value is not None:
+                value = convert(value)
+            values.append(value)
+        if len(self.batch[0]) >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        arrays = []
+        for column, values in zip(self.schema, self.batch):
+            if pyarrow.types.is_dictionary(column.type):
+                array = pyarrow.array(values, pyarrow.string()).dictionary_encode()
+            else:
+                array = pyarrow.array(values, column.type)
+            arrays.append(array)
+        table = pyarrow.Table.from_arrays(arrays, schema=self.schema)
+        self.parquet_writer.write_table(table)
+        self.batch = [[] for _ in self.columns]
+
+    def close(self):
+        if not self.f.closed:
+            if self.batch[0]:
+                self._write_row_group()
+            self.parquet_writer.close()
+        super().close()
+
+
+WRITERS = {
+    "csv": CsvSessionWriter,
+    "jsonl": JsonlSessionWriter,
+    "parquet": ParquetSessionWriter,
+}
+
+
+def open_writer(path, output_format, fields, **kwargs):
+    return WRITERS[output_format](path, fields, **kwargs)
+
+
+def truncate_hello_text(text, limit):
+    if limit is None or len(text) <= limit:
+        return text
+    return text[:limit] + "..."